@@ -1,47 +1,80 @@
-from state import State, KING, QUEEN, ROOK, BISHOP, KNIGNT, PAWN, unpack
+import time
+from numba import njit
+import numpy as np
+from state import State, KING, QUEEN, ROOK, BISHOP, KNIGNT, PAWN, NO_MOVE, IDX_TYPE
+from state import MAX_MOVES, MAX_PLY, ONGOING, CHECKMATE, EN_PASSANT, move_flag
+from tt import create_table, EXACT, LOWER_BOUND, UPPER_BOUND
+from state import PST_MG, PST_EG, PHASE
+from pst import MAX_PHASE, MG_VALUE, EG_VALUE
+from stats import NODES, QS_NODES, GEN_CALLS, CHECK_TESTS, CUTOFFS, FIRST_CUTOFFS
+from stats import TT_PROBES, TT_HITS, TT_CUTOFFS
 
 MAX_DEPTH = 3
 INF = 10 ** 5
+# Mate values are INF less the plies from the root to the mate, so that
+# shorter mates score higher. Values beyond MATE_BOUND are mates
+MATE_BOUND = INF - MAX_PLY
+# Number of nodes between two clock reads
+TIME_CHECK_INTERVAL = 256
+# Default transposition table size
+TT_SIZE_MB = 16
+# Score of a tablebase win, less the distance to mate
+TB_WIN = INF // 2
+
+
+PIECE_VALUE = {KING: 4, QUEEN: 9, ROOK: 5, BISHOP: 3, KNIGNT: 3, PAWN: 1}
+# Type to value map, for njit code
+PIECE_VALUES = np.int32([PIECE_VALUE[t] for t in range(6)])
+# Most a capture can gain by type, in material_evaluator (row 0) and
+# State.evaluate (row 1) units. Quiescence skips the captures that can't
+# raise alpha even with an extra margin of two pawns
+CAPTURE_GAIN = np.int32([PIECE_VALUES, np.maximum(MG_VALUE, EG_VALUE)])
+DELTA_MARGIN = 2 * CAPTURE_GAIN[:, PAWN]
 
 
 def baseline_evaluator(state, color):
     assert color != -1
-    PIECE_VALUE = {KING: 4, QUEEN: 9, ROOK: 5, BISHOP: 3, KNIGNT: 3, PAWN: 1}
     value = 0
     for idx, (i, j) in enumerate(state.pieces):
         if i < 0 or j < 0:
             continue
-        c, _, t = unpack(idx)
-        sign = 1 if c == color else -1
-        value += PIECE_VALUE[t] * sign
+        sign = 1 if idx // 16 == color else -1
+        value += PIECE_VALUE[state.types[idx]] * sign
     return value
 
 
-def min_max(state, depth=MAX_DEPTH, max_color=None):
+def min_max(state, depth=MAX_DEPTH, max_color=None, quiesce=False, ply=0):
+    """quiesce scores the leaves with a quiescence search, ply is the
+    distance to the root"""
     # Find maximizing color
     if max_color is None:
         max_color = state.get_player_color()
     curr_color = state.get_player_color()
     # Terminate if needed
-    if state.is_terminal(curr_color):
-        return None, INF if curr_color != max_color else -INF
+    status = state.game_status(curr_color)
+    if status != ONGOING:
+        value = terminal_value(status, ply)
+        return None, value if curr_color == max_color else -value
     if depth == 0:
+        if quiesce:
+            value = quiescence_value(state)
+            return None, value if curr_color == max_color else -value
         return None, baseline_evaluator(state, max_color)
-    player_actions = state.get_player_actions(curr_color)
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    n = state.gen_moves(curr_color, moves)
     seek_max = curr_color == max_color
     opt_value = -INF if seek_max else INF
     opt_action = None
-    for idx, actions in player_actions:
-        for action in actions:
-            # Simulate action
-            state.push_action(idx, action)
-            _, value = min_max(state, depth - 1, max_color)
-            value = max(opt_value, value) if seek_max else min(opt_value, value)
-            if value != opt_value:
-                opt_value = value
-                opt_action = (idx, action)
-            # Pop action
-            state.pop_action()
+    for move in moves[:n].tolist():
+        # Simulate action
+        state.push_move(move)
+        _, value = min_max(state, depth - 1, max_color, quiesce, ply + 1)
+        value = max(opt_value, value) if seek_max else min(opt_value, value)
+        if value != opt_value:
+            opt_value = value
+            opt_action = move
+        # Pop action
+        state.pop_action()
     # print(
     #     "D",
     #     depth,
@@ -57,6 +90,664 @@ def min_max(state, depth=MAX_DEPTH, max_color=None):
     return opt_action, opt_value
 
 
+def batch_evaluator(pieces, colors, types=None):
+    """Tapered material and piece-square score of N positions, as State.evaluate.
+    pieces is (N, 32, 2) like State.pieces, colors the (N,) points of view and
+    types the (N, 32) State.types, the types before promotion by default"""
+    pieces = np.asarray(pieces)
+    i, j = pieces[..., 0], pieces[..., 1]
+    alive = i >= 0
+    # Captured pieces read square 0 and are masked out
+    idx = np.arange(32)
+    code = idx // 16 * 6 + (IDX_TYPE if types is None else np.asarray(types))
+    row, col = np.where(alive, i, 0), np.where(alive, j, 0)
+    sign = np.where(alive, 1 - 2 * (idx // 16), 0)
+    mg = (PST_MG[code, row, col] * sign).sum(axis=1)
+    eg = (PST_EG[code, row, col] * sign).sum(axis=1)
+    phase = np.minimum((PHASE[code] * alive).sum(axis=1), MAX_PHASE)
+    score = (mg * phase + eg * (MAX_PHASE - phase)) // MAX_PHASE
+    return np.where(np.asarray(colors) == 0, score, -score)
+
+
+def pst_evaluator(state, color):
+    """batch_evaluator for a single state"""
+    return int(batch_evaluator(state.pieces[None], [color], state.types[None])[0])
+
+
+@njit(cache=True)
+def material_evaluator(state, color):
+    """njit baseline_evaluator"""
+    return state.material(PIECE_VALUES, color)
+
+
+@njit(cache=True)
+def captured_type(state, move):
+    """Type of the piece captured by a packed move, -1 for none"""
+    if move_flag(move) == EN_PASSANT:
+        return PAWN
+    dst = move % 64
+    return state.get_type(dst // 8, dst % 8)
+
+
+@njit(cache=True)
+def order_moves(state, moves, keys, n, first):
+    """Sort keys of n packed moves: the `first` move, captures by victim value,
+    then the others. The low bits of a key hold the move's generation index"""
+    for k in range(n):
+        move = moves[k]
+        victim = captured_type(state, move)
+        if move == first:
+            rank = 0
+        elif victim > -1:
+            rank = 10 - PIECE_VALUES[victim]
+        else:
+            rank = 10
+        keys[k] = rank * MAX_MOVES + k
+
+
+@njit("int64(int64[:], int64, int64)", cache=True)
+def pick_move(keys, start, n):
+    """Selection sort step: bring the smallest key of [start, n) to start and
+    return its generation index"""
+    best = start
+    for k in range(start + 1, n):
+        if keys[k] < keys[best]:
+            best = k
+    key = keys[best]
+    keys[best] = keys[start]
+    keys[start] = key
+    return key % MAX_MOVES
+
+
+@njit("int64(int64, int64)", cache=True)
+def terminal_value(status, ply):
+    """Value of a finished game ply plies from the root for the player up:
+    lost when mated, else drawn"""
+    return -(INF - ply) if status == CHECKMATE else 0
+
+
+@njit("int64(int64, int64)", cache=True)
+def score_to_table(score, ply):
+    """Mate scores are stored relative to the node, the table being shared
+    by nodes at any ply"""
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+@njit("int64(int64, int64)", cache=True)
+def score_from_table(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
+@njit(cache=True)
+def count(counters, row, ply):
+    """Increment a stats.SearchStats counter, compiled away when counters is None"""
+    if counters is not None:
+        counters[row, ply] += 1
+
+
+@njit(cache=True)
+def add_count(counters, row, ply, value):
+    if counters is not None:
+        counters[row, ply] += value
+
+
+@njit(cache=True)
+def check_tests(state, counters):
+    """In-check tests made by state, not read when counters is None"""
+    if counters is None:
+        return 0
+    return state.check_tests
+
+
+@njit(cache=True)
+def order_captures(state, moves, keys, n):
+    """MVV-LVA sort keys of n captures: most valuable victim first, then
+    least valuable attacker, the king last"""
+    for k in range(n):
+        move = moves[k]
+        src = move % 4096 // 64
+        victim = captured_type(state, move)
+        attacker = state.get_type(src // 8, src % 8)
+        attacker_rank = 10 if attacker == KING else PIECE_VALUES[attacker]
+        rank = (10 - PIECE_VALUES[victim]) * 16 + attacker_rank
+        keys[k] = rank * MAX_MOVES + k
+
+
+@njit(cache=True)
+def quiescence(state, ply, alpha, beta, moves, keys, nodes, tapered, counters):
+    """Fail-soft search of the captures only, with a stand-pat score and delta
+    pruning. Value from the perspective of the player up"""
+    count(counters, QS_NODES, ply)
+    color = state.get_player_color()
+    stand_pat = state.evaluate(color) if tapered else material_evaluator(state, color)
+    if stand_pat >= beta or ply >= MAX_PLY - 1:
+        return stand_pat
+    if stand_pat > alpha:
+        alpha = stand_pat
+    best = stand_pat
+    units = 1 if tapered else 0
+    tests = check_tests(state, counters)
+    n = state.gen_captures(color, moves[ply])
+    count(counters, GEN_CALLS, ply)
+    add_count(counters, CHECK_TESTS, ply, state.check_tests - tests)
+    order_captures(state, moves[ply], keys[ply], n)
+    for s in range(n):
+        move = moves[ply, pick_move(keys[ply], s, n)]
+        victim = captured_type(state, move)
+        # Delta pruning, the bound keeps the fail-soft value an upper bound
+        bound = stand_pat + CAPTURE_GAIN[units, victim] + DELTA_MARGIN[units]
+        if bound <= alpha:
+            best = max(best, bound)
+            continue
+        nodes[0] += 1
+        state.push_move(move)
+        args = (moves, keys, nodes, tapered, counters)
+        value = -quiescence(state, ply + 1, -beta, -alpha, *args)
+        state.pop_action()
+        if value > best:
+            best = value
+            if value > alpha:
+                alpha = value
+                if alpha >= beta:
+                    count(counters, CUTOFFS, ply)
+                    break
+    return best
+
+
+def quiescence_value(state, tapered=False):
+    """Full window quiescence value of state, for the player up"""
+    moves = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int16)
+    keys = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int64)
+    nodes = np.zeros(1, dtype=np.int64)
+    return quiescence(state, 0, -INF, INF, moves, keys, nodes, tapered, None)
+
+
+@njit("boolean(int64, int64, int64, int64)", cache=True)
+def tt_cutoff(bound, score, alpha, beta):
+    """Does a deep enough table entry end the search of a node"""
+    if bound == EXACT:
+        return True
+    if bound == LOWER_BOUND:
+        return score >= beta
+    return bound == UPPER_BOUND and score <= alpha
+
+
+class SearchTimeout(Exception):
+    """Raised when the time or node budget of a search is exhausted"""
+
+
+class AlphaBeta:
+    """Alpha-beta search with move ordering and iterative deepening"""
+
+    def __init__(
+        self,
+        state,
+        max_time=None,
+        max_nodes=None,
+        table=None,
+        tapered=False,
+        stop=None,
+        on_progress=None,
+        tablebase=None,
+        quiesce=False,
+        stats=None,
+    ):
+        """stop is an optional threading.Event ending the search, on_progress
+        an optional callback receiving a dict after each completed iteration.
+        Positions of the optional tablebase.Tablebase are scored exactly, the
+        optional stats.SearchStats collects counters"""
+        self.state = state
+        # Leaves scored by State.evaluate rather than material only
+        self.tapered = tapered
+        # Leaves scored by a quiescence search
+        self.quiesce = quiesce
+        self.stop = stop
+        self.on_progress = on_progress
+        self.tablebase = tablebase
+        self.stats = stats
+        self.counters = stats.counters if stats is not None else None
+        self.max_time = max_time
+        self.max_nodes = max_nodes
+        self.table = table if table is not None else create_table(TT_SIZE_MB)
+        # One move buffer per ply, reused across nodes
+        self.moves = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int16)
+        self.keys = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int64)
+        self.qs_nodes = np.zeros(1, dtype=np.int64)
+        self.root_idx = 0
+        self.start = time.time()
+        # The limits apply once the first iteration is complete
+        self.limited = False
+        self.interrupt = None
+        self.nodes = 0
+
+    def ordered_moves(self, color, first=NO_MOVE):
+        """(generation index, packed move) in search order"""
+        ply = self.state.action_idx - self.root_idx
+        moves, keys = self.moves[ply], self.keys[ply]
+        counters = self.counters
+        if counters is None:
+            n = self.state.gen_moves(color, moves)
+        else:
+            tests = self.state.check_tests
+            n = self.state.gen_moves(color, moves)
+            counters[GEN_CALLS, ply] += 1
+            counters[CHECK_TESTS, ply] += self.state.check_tests - tests
+        order_moves(self.state, moves, keys, n, first)
+        keys = np.sort(keys[:n]) % MAX_MOVES
+        return [(k, moves[k]) for k in keys.tolist()]
+
+    def set_max_time(self, max_time):
+        """Finish within max_time seconds from now, before or while run()
+        searches, e.g. from another thread"""
+        # A single field update, read consistently by check_limits
+        self.max_time = time.time() - self.start + max_time
+
+    def check_limits(self):
+        if not self.limited:
+            return
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            raise SearchTimeout()
+        if self.nodes % TIME_CHECK_INTERVAL == 0:
+            max_time = self.max_time
+            if max_time is not None and time.time() > self.start + max_time:
+                raise SearchTimeout()
+            if self.interrupt is not None and self.interrupt.is_set():
+                raise SearchTimeout()
+
+    def negamax(self, depth, alpha, beta):
+        """Fail-soft alpha-beta, value from the perspective of the player up"""
+        self.nodes += 1
+        self.check_limits()
+        state = self.state
+        color = state.get_player_color()
+        if self.tablebase is not None:
+            result = self.tablebase.probe(state)
+            if result is not None:
+                return tablebase_score(*result)
+        ply = state.action_idx - self.root_idx
+        counters = self.counters
+        if counters is None:
+            status = state.game_status(color)
+        else:
+            counters[NODES, ply] += 1
+            tests = state.check_tests
+            status = state.game_status(color)
+            counters[CHECK_TESTS, ply] += state.check_tests - tests
+        if status != ONGOING:
+            return terminal_value(status, ply)
+        if depth == 0:
+            if self.quiesce:
+                return self.quiescence(alpha, beta)
+            return state.evaluate(color) if self.tapered else baseline_evaluator(state, color)
+        # Transposition table
+        key = np.uint64(state.zobrist)
+        found, tt_depth, tt_score, tt_bound, tt_move = self.table.lookup(key)
+        tt_score = score_from_table(tt_score, ply)
+        cutoff = found and tt_depth >= depth and tt_cutoff(tt_bound, tt_score, alpha, beta)
+        if counters is not None:
+            counters[TT_PROBES, ply] += 1
+            counters[TT_HITS, ply] += found
+            counters[TT_CUTOFFS, ply] += cutoff
+        if cutoff:
+            return tt_score
+        alpha_orig = alpha
+        best, best_move = -INF, NO_MOVE
+        for s, (_, move) in enumerate(self.ordered_moves(color, tt_move)):
+            state.push_move(move)
+            value = -self.negamax(depth - 1, -beta, -alpha)
+            state.pop_action()
+            if value > best:
+                best = value
+                best_move = move
+                if value > alpha:
+                    alpha = value
+                    if alpha >= beta:
+                        if counters is not None:
+                            counters[CUTOFFS, ply] += 1
+                            counters[FIRST_CUTOFFS, ply] += s == 0
+                        break
+        if best <= alpha_orig:
+            bound = UPPER_BOUND
+        elif best >= beta:
+            bound = LOWER_BOUND
+        else:
+            bound = EXACT
+        # best_move is NO_MOVE or a numpy int16, int() keeps a single compiled store
+        self.table.store(key, depth, score_to_table(best, ply), bound, int(best_move))
+        return best
+
+    def quiescence(self, alpha, beta):
+        ply = self.state.action_idx - self.root_idx
+        self.qs_nodes[0] = 0
+        args = (self.moves, self.keys, self.qs_nodes, self.tapered, self.counters)
+        value = quiescence(self.state, ply, alpha, beta, *args)
+        self.nodes += int(self.qs_nodes[0])
+        return value
+
+    def search_root(self, depth, moves):
+        """Search all root moves, breaking ties on generation order like min_max"""
+        state = self.state
+        best_value, best_k, best_move = -INF, len(moves), NO_MOVE
+        for k, move in moves:
+            # Integer scores: a window lowered by one detects an exact tie
+            alpha = best_value - 1 if k < best_k else best_value
+            state.push_move(move)
+            value = -self.negamax(depth - 1, -INF - 1, -alpha)
+            state.pop_action()
+            if value > best_value or (value == best_value and k < best_k):
+                best_value, best_k, best_move = value, k, move
+        return best_move, best_value
+
+    def run(self, depth=MAX_DEPTH):
+        """Iterative deepening up to `depth`, returning the result of the
+        deepest completed iteration once the budget runs out"""
+        state = self.state
+        self.root_idx = state.action_idx
+        color = state.get_player_color()
+        self.start = time.time()
+        self.nodes = 0
+        self.limited = False
+        self.interrupt = None
+        if self.stats is not None:
+            self.stats.reset()
+        # Finished games have no move, like min_max
+        status = state.game_status(color)
+        if status != ONGOING:
+            return None, terminal_value(status, 0)
+        state.count_checks = self.stats is not None
+        try:
+            return self.deepen(depth)
+        finally:
+            state.count_checks = False
+
+    def deepen(self, depth):
+        """Iterations of run, check tests counted when collecting statistics"""
+        state = self.state
+        color = state.get_player_color()
+        start = self.start
+        best_move, best_value = NO_MOVE, -INF
+        for d in range(1, depth + 1):
+            if self.interrupt is not None and self.interrupt.is_set():
+                break
+            if self.counters is not None:
+                self.counters[NODES, 0] += 1
+            moves = self.ordered_moves(color, best_move)
+            if not moves:
+                break
+            try:
+                best_move, best_value = self.search_root(d, moves)
+            except SearchTimeout:
+                # Unwind the moves left on the stack by the interrupted search
+                while state.action_idx > self.root_idx:
+                    state.pop_action()
+                break
+            # The first iteration always completes so a move is available
+            if d == 1:
+                self.limited = True
+                self.interrupt = self.stop
+            if self.stats is not None:
+                self.stats.end_iteration(d)
+            if self.on_progress is not None:
+                info = {
+                    "depth": d,
+                    "move": int(best_move),
+                    "value": int(best_value),
+                    "nodes": self.nodes,
+                    "time": time.time() - start,
+                }
+                self.on_progress(info)
+        if best_move == NO_MOVE:
+            return None, best_value
+        return int(best_move), best_value
+
+
+def principal_variation(state, table, move, max_length=MAX_DEPTH):
+    """Packed moves of the line starting with move, then following the best
+    moves of the table while they are legal and don't repeat a position"""
+    buf = np.zeros(MAX_MOVES, dtype=np.int16)
+    line, seen = [], set()
+    while move != NO_MOVE and len(line) < max_length:
+        n = state.gen_moves(state.get_player_color(), buf)
+        if move not in buf[:n]:
+            break
+        state.push_move(move)
+        line.append(int(move))
+        key = np.uint64(state.zobrist)
+        if key in seen:
+            break
+        seen.add(key)
+        found, _, _, _, move = table.lookup(key)
+        if not found:
+            break
+    for _ in line:
+        state.pop_action()
+    return line
+
+
+@njit(cache=True)
+def tablebase_score(wdl, dtm):
+    """Search value of a tablebase result, quicker mates scoring higher"""
+    if wdl == 0:
+        return 0
+    return wdl * (TB_WIN - dtm)
+
+
+@njit(cache=True)
+def tablebase_index(state):
+    """(type of the other piece, table index) of a state with the two kings
+    and one other piece, (-1, -1) for other states. Black pieces are looked
+    up with the colors swapped and the board flipped"""
+    t, c, sq, n, white_king, black_king = -1, -1, -1, 0, -1, -1
+    for k in range(64):
+        tk = state.get_type(k // 8, k % 8)
+        if tk < 0:
+            continue
+        n += 1
+        if n > 3:
+            return -1, -1
+        if tk == KING and state.get_color(k // 8, k % 8) == 0:
+            white_king = k
+        elif tk == KING:
+            black_king = k
+        else:
+            t, c, sq = tk, state.get_color(k // 8, k % 8), k
+    if n != 3:
+        return -1, -1
+    index = state.get_player_color() ^ c
+    own, other = (black_king, white_king) if c else (white_king, black_king)
+    for k in (own, other, sq):
+        index = index * 64 + (7 - k // 8 if c else k // 8) * 8 + k % 8
+    return t, index
+
+
+@njit(cache=True)
+def probe_tablebase(state, wdl, dtm):
+    """(found, search value) of state in the tables of tablebase.Tablebase.arrays"""
+    t, index = tablebase_index(state)
+    if t < 0 or wdl[t].shape[0] == 0:
+        return False, 0
+    return True, tablebase_score(wdl[t][index], dtm[t][index])
+
+
+def book_move(state, book):
+    """Packed book move of state, None without book or book move"""
+    if book is None:
+        return None
+    move = book.pick_move(state)
+    return None if move == NO_MOVE else int(move)
+
+
+def alpha_beta(
+    state,
+    depth=MAX_DEPTH,
+    max_time=None,
+    max_nodes=None,
+    table=None,
+    tapered=False,
+    book=None,
+    tablebase=None,
+    quiesce=False,
+    stats=None,
+):
+    """Same result as min_max at equal depth and quiesce unless tapered or with
+    a tablebase, within an optional budget. Positions of the optional
+    book.OpeningBook are not searched, their book move comes with a value of 0"""
+    move = book_move(state, book)
+    if move is not None:
+        return move, 0
+    args = (max_time, max_nodes, table, tapered)
+    search = AlphaBeta(state, *args, tablebase=tablebase, quiesce=quiesce, stats=stats)
+    return search.run(depth)
+
+
+@njit(cache=True)
+def negamax(
+    state, table, depth, ply, alpha, beta, moves, keys, nodes, tapered, quiesce, tablebase, counters
+):
+    """Fail-soft alpha-beta, value from the perspective of the player up.
+    moves and keys are per-ply buffers, tapered scores leaves with State.evaluate
+    and quiesce with a quiescence search. tablebase is the (wdl, dtm) of
+    tablebase.Tablebase.arrays or None, counters a stats.SearchStats counters
+    array or None"""
+    nodes[0] += 1
+    count(counters, NODES, ply)
+    if tablebase is not None:
+        found, value = probe_tablebase(state, tablebase[0], tablebase[1])
+        if found:
+            return value
+    color = state.get_player_color()
+    tests = check_tests(state, counters)
+    status = state.game_status(color)
+    add_count(counters, CHECK_TESTS, ply, state.check_tests - tests)
+    if status != ONGOING:
+        return terminal_value(status, ply)
+    if depth == 0:
+        if quiesce:
+            return quiescence(state, ply, alpha, beta, moves, keys, nodes, tapered, counters)
+        return state.evaluate(color) if tapered else material_evaluator(state, color)
+    # Transposition table
+    key = state.zobrist
+    found, tt_depth, tt_score, tt_bound, tt_move = table.lookup(key)
+    tt_score = score_from_table(tt_score, ply)
+    count(counters, TT_PROBES, ply)
+    if found:
+        count(counters, TT_HITS, ply)
+    if found and tt_depth >= depth and tt_cutoff(tt_bound, tt_score, alpha, beta):
+        count(counters, TT_CUTOFFS, ply)
+        return tt_score
+    alpha_orig = alpha
+    best, best_move = -INF, NO_MOVE
+    tests = check_tests(state, counters)
+    n = state.gen_moves(color, moves[ply])
+    count(counters, GEN_CALLS, ply)
+    add_count(counters, CHECK_TESTS, ply, state.check_tests - tests)
+    order_moves(state, moves[ply], keys[ply], n, tt_move)
+    for s in range(n):
+        move = moves[ply, pick_move(keys[ply], s, n)]
+        state.push_move(move)
+        args = (moves, keys, nodes, tapered, quiesce, tablebase, counters)
+        value = -negamax(state, table, depth - 1, ply + 1, -beta, -alpha, *args)
+        state.pop_action()
+        if value > best:
+            best = value
+            best_move = move
+            if value > alpha:
+                alpha = value
+                if alpha >= beta:
+                    count(counters, CUTOFFS, ply)
+                    if s == 0:
+                        count(counters, FIRST_CUTOFFS, ply)
+                    break
+    if best <= alpha_orig:
+        bound = UPPER_BOUND
+    elif best >= beta:
+        bound = LOWER_BOUND
+    else:
+        bound = EXACT
+    table.store(key, depth, score_to_table(best, ply), bound, best_move)
+    return best
+
+
+@njit(cache=True)
+def search_depth(
+    state, table, depth, best_move, moves, keys, nodes, tapered, quiesce, tablebase, counters
+):
+    """One iterative deepening iteration, searching best_move first. Root ties
+    are broken on generation order like min_max. Returns (packed move, value)"""
+    count(counters, NODES, 0)
+    tests = check_tests(state, counters)
+    n = state.gen_moves(state.get_player_color(), moves[0])
+    count(counters, GEN_CALLS, 0)
+    add_count(counters, CHECK_TESTS, 0, state.check_tests - tests)
+    order_moves(state, moves[0], keys[0], n, best_move)
+    best_value, best_k = -INF, n
+    for s in range(n):
+        k = pick_move(keys[0], s, n)
+        # Integer scores: a window lowered by one detects an exact tie
+        alpha = best_value - 1 if k < best_k else best_value
+        state.push_move(moves[0, k])
+        args = (moves, keys, nodes, tapered, quiesce, tablebase, counters)
+        value = -negamax(state, table, depth - 1, 1, -INF - 1, -alpha, *args)
+        state.pop_action()
+        if value > best_value or (value == best_value and k < best_k):
+            best_value, best_k = value, k
+            best_move = moves[0, k]
+    return best_move, best_value
+
+
+def jit_search(
+    state,
+    depth=MAX_DEPTH,
+    table=None,
+    tapered=False,
+    book=None,
+    quiesce=False,
+    stats=None,
+    tablebase=None,
+):
+    """Search run in nopython mode, same result as min_max unless tapered or
+    with a tablebase. Checks the optional book first, like alpha_beta. The
+    optional stats.SearchStats collects counters, positions of the optional
+    tablebase.Tablebase are scored exactly"""
+    move = book_move(state, book)
+    if move is not None:
+        return move, 0
+    status = state.game_status(state.get_player_color())
+    if status != ONGOING:
+        return None, terminal_value(status, 0)
+    if table is None:
+        table = create_table(TT_SIZE_MB)
+    moves = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int16)
+    keys = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int64)
+    nodes = np.zeros(1, dtype=np.int64)
+    tables = tablebase.arrays() if tablebase is not None else None
+    counters = None
+    if stats is not None:
+        stats.reset()
+        counters = stats.counters
+    move, value = NO_MOVE, -INF
+    state.count_checks = stats is not None
+    try:
+        for d in range(1, depth + 1):
+            args = (moves, keys, nodes, tapered, quiesce, tables, counters)
+            move, value = search_depth(state, table, d, move, *args)
+            if stats is not None:
+                stats.end_iteration(d)
+    finally:
+        state.count_checks = False
+    if move == NO_MOVE:
+        return None, value
+    return int(move), value
+
+
 if __name__ == "__main__":
     state = State()
     result = min_max(state, depth=4)
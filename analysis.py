@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import numpy as np
+from state import NO_MOVE, create_state
+from tt import create_table
+from ai import MAX_DEPTH, AlphaBeta, jit_search
+from dataset import decode_board, encode_boards, open_dataset
+from pgn import START_FEN, load_fen, set_position
+from startup import warm_pool
+from tablebase import Tablebase
+
+# Shared slot of a position: the packed board and side to move of
+# dataset.RECORD_DTYPE in, the search score and packed move out
+SLOT_DTYPE = np.dtype([("board", "u1", 32), ("color", "i1"), ("score", "<i4"), ("move", "<i2")])
+# Positions per block, the unit of work sent to a worker
+BLOCK_SIZE = 64
+# Table size of each worker, cleared before every position
+ANALYSIS_TT_MB = 4
+# Seconds the collector waits for a block before checking the workers are alive
+WORKER_CHECK_INTERVAL = 1.0
+
+
+def analyze_position(state, table, slot, depth, max_time, tapered, quiesce, tablebase):
+    """Search the position of a slot on state and write the results to it.
+    tablebase is a tablebase.Tablebase or None"""
+    set_position(state, decode_board(slot["board"]), int(slot["color"]))
+    table.clear()
+    options = {"tapered": tapered, "quiesce": quiesce, "tablebase": tablebase}
+    if max_time is None:
+        move, value = jit_search(state, depth, table, **options)
+    else:
+        move, value = AlphaBeta(state, max_time, table=table, **options).run(depth)
+    slot["score"] = value
+    slot["move"] = NO_MOVE if move is None else move
+
+
+def worker_loop(shm, n_slots, tasks, done, backend, table_mb, options):
+    """Analyze the blocks of tasks until a None task. Posts (block, None) to
+    done, or (block, traceback) if the analysis of the block raised. options
+    are the (tapered, quiesce, tablebase directory) of the service"""
+    slots = np.ndarray(n_slots, dtype=SLOT_DTYPE, buffer=shm.buf)
+    state = create_state(backend)
+    table = create_table(table_mb)
+    tapered, quiesce, tablebase_dir = options
+    tablebase = Tablebase(tablebase_dir) if tablebase_dir is not None else None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        block, n, depth, max_time = task
+        start = block * BLOCK_SIZE
+        try:
+            for k in range(start, start + n):
+                args = (depth, max_time, tapered, quiesce, tablebase)
+                analyze_position(state, table, slots[k], *args)
+        except Exception:
+            done.put((block, traceback.format_exc()))
+            continue
+        done.put((block, None))
+    del slots
+
+
+class AnalysisService:
+    """Persistent pool of warmed up workers analyzing batches of positions.
+    Positions and results go through a shared memory array of blocks. submit()
+    queues a job and returns a Future, so it can be called from any thread.
+    A worker dying loses its block, the service is then broken: pending and
+    later jobs fail with BrokenProcessPool. Positions in the tables of the
+    optional tablebase_dir are scored exactly"""
+
+    def __init__(
+        self,
+        workers=None,
+        backend="array",
+        blocks=None,
+        table_mb=ANALYSIS_TT_MB,
+        tapered=False,
+        quiesce=False,
+        tablebase_dir=None,
+    ):
+        self.workers = workers or os.cpu_count()
+        self.backend = backend
+        # Enough blocks for every worker to have one queued behind the current one
+        self.n_blocks = blocks or 2 * self.workers
+        n_slots = self.n_blocks * BLOCK_SIZE
+        self.shm = shared_memory.SharedMemory(create=True, size=n_slots * SLOT_DTYPE.itemsize)
+        self.slots = np.ndarray(n_slots, dtype=SLOT_DTYPE, buffer=self.shm.buf)
+        self.free = queue.Queue()
+        for block in range(self.n_blocks):
+            self.free.put(block)
+        # Block -> (job, offset in the job, count)
+        self.pending = {}
+        # Guards pending, broken and the completion of the Futures
+        self.lock = threading.RLock()
+        self.broken = False
+        self.closing = False
+        self.requests = queue.Queue()
+        options = (tapered, quiesce, tablebase_dir)
+        context = warm_pool(warmup=lambda: self.warmup(*options))
+        self.tasks = context.Queue()
+        self.done = context.Queue()
+        args = (self.shm, n_slots, self.tasks, self.done, backend, table_mb, options)
+        self.processes = []
+        for _ in range(self.workers):
+            process = context.Process(target=worker_loop, args=args)
+            process.start()
+            self.processes.append(process)
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.dispatcher.start()
+        self.collector.start()
+
+    def warmup(self, tapered, quiesce, tablebase_dir):
+        """Compile the worker code, run by warm_pool"""
+        slot = np.zeros(1, dtype=SLOT_DTYPE)[0]
+        state = load_fen(create_state(self.backend), START_FEN)
+        slot["board"] = encode_boards(state.mat[None], state.types[None])[0]
+        table = create_table(1)
+        tablebase = Tablebase(tablebase_dir) if tablebase_dir is not None else None
+        for max_time in (None, 1.0):
+            args = (2, max_time, tapered, quiesce, tablebase)
+            analyze_position(create_state(self.backend), table, slot, *args)
+
+    def submit(self, boards, colors, depth=MAX_DEPTH, max_time=None):
+        """Queue the analysis of (n, 32) packed boards, with colors to move.
+        max_time, in seconds per position, switches to the interruptible
+        AlphaBeta search. The Future's result is a dict of score and move
+        arrays, scores from the side to move"""
+        n = len(boards)
+        job = {
+            "future": Future(),
+            "boards": np.asarray(boards, dtype=np.uint8).reshape(n, 32),
+            "colors": np.asarray(colors, dtype=np.int8).reshape(n),
+            "depth": depth,
+            "max_time": max_time,
+            "score": np.zeros(n, dtype=np.int32),
+            "move": np.zeros(n, dtype=np.int16),
+            "left": n,
+            "lock": threading.Lock(),
+        }
+        if self.check_workers():
+            raise BrokenProcessPool("An analysis worker died")
+        if n == 0:
+            job["future"].set_result({"score": job["score"], "move": job["move"]})
+        else:
+            self.requests.put(job)
+        return job["future"]
+
+    def analyze(self, boards, colors, depth=MAX_DEPTH, max_time=None):
+        return self.submit(boards, colors, depth, max_time).result()
+
+    def dispatch(self):
+        """Copy queued jobs into free blocks and hand the blocks to the workers"""
+        while True:
+            job = self.requests.get()
+            if job is None:
+                break
+            n = len(job["boards"])
+            for offset in range(0, n, BLOCK_SIZE):
+                count = min(BLOCK_SIZE, n - offset)
+                block = self.free.get()
+                if self.broken:
+                    self.free.put(block)
+                    self.settle(job, BrokenProcessPool("An analysis worker died"))
+                    break
+                start = block * BLOCK_SIZE
+                slots = self.slots[start : start + count]
+                slots["board"] = job["boards"][offset : offset + count]
+                slots["color"] = job["colors"][offset : offset + count]
+                with self.lock:
+                    self.pending[block] = (job, offset, count)
+                self.tasks.put((block, count, job["depth"], job["max_time"]))
+
+    def collect(self):
+        """Copy finished blocks out, free them and complete the jobs"""
+        while True:
+            try:
+                item = self.done.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                self.check_workers()
+                continue
+            if item is None:
+                break
+            block, error = item
+            with self.lock:
+                entry = self.pending.pop(block, None)
+            # Jobs of a broken service are already failed
+            if entry is None:
+                continue
+            job, offset, count = entry
+            start = block * BLOCK_SIZE
+            slots = self.slots[start : start + count]
+            job["score"][offset : offset + count] = slots["score"]
+            job["move"][offset : offset + count] = slots["move"]
+            self.free.put(block)
+            with job["lock"]:
+                job["left"] -= count
+                finished = job["left"] == 0
+            if error is not None:
+                self.settle(job, RuntimeError("Analysis worker error\n" + error))
+            elif finished:
+                self.settle(job)
+
+    def settle(self, job, error=None):
+        """Complete the Future of a job with its results, or error. Only the
+        first call of a job has an effect"""
+        with self.lock:
+            future = job["future"]
+            if future.done():
+                return
+            if error is None:
+                future.set_result({"score": job["score"], "move": job["move"]})
+            else:
+                future.set_exception(error)
+
+    def check_workers(self):
+        """Break the service if a worker died: fail the pending jobs and free
+        their blocks. Returns whether the service is broken"""
+        with self.lock:
+            if self.broken or self.closing:
+                return self.broken
+            if all(process.is_alive() for process in self.processes):
+                return False
+            self.broken = True
+        self.fail_pending()
+        return True
+
+    def fail_pending(self):
+        """Fail the jobs of the blocks not collected yet and free the blocks,
+        which unblocks the dispatcher"""
+        with self.lock:
+            jobs = [job for job, _, _ in self.pending.values()]
+            for block in self.pending:
+                self.free.put(block)
+            self.pending.clear()
+        for job in jobs:
+            self.settle(job, BrokenProcessPool("An analysis worker died"))
+
+    def close(self):
+        self.check_workers()
+        self.requests.put(None)
+        self.dispatcher.join()
+        with self.lock:
+            self.closing = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.done.put(None)
+        self.collector.join()
+        # Blocks lost by a worker dying during the shutdown
+        self.fail_pending()
+        del self.slots
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch analysis of a position dataset")
+    parser.add_argument("dataset", help="file of dataset.RECORD_DTYPE records")
+    parser.add_argument("--depth", type=int, default=MAX_DEPTH)
+    parser.add_argument("--max-time", type=float, default=None, help="seconds per position")
+    parser.add_argument("--limit", type=int, default=None, help="analyze the first positions only")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    parser.add_argument("--tapered", action="store_true")
+    parser.add_argument("--quiesce", action="store_true")
+    parser.add_argument("--tablebase", help="directory of endgame tables")
+    parser.add_argument("--output", help="write the scores and moves as .npz")
+    args = parser.parse_args()
+    records = open_dataset(args.dataset)[: args.limit]
+    start = time.time()
+    options = {"tapered": args.tapered, "quiesce": args.quiesce, "tablebase_dir": args.tablebase}
+    with AnalysisService(args.workers, args.backend, **options) as service:
+        ready = time.time()
+        result = service.analyze(records["board"], records["color"], args.depth, args.max_time)
+        elapsed = time.time() - ready
+    print(
+        "{} positions in {:.2f}s, {:.0f} positions/s, {:.2f}s start up".format(
+            len(records), elapsed, len(records) / max(elapsed, 1e-6), ready - start
+        )
+    )
+    if args.output:
+        np.savez(args.output, **result)
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+import numba as nb
+from numba import njit
+from numba.experimental import structref
+import numpy as np
+from utils import bind_methods
+from state import STATE_TYPE, alloc_state, new_state, MAX_MOVES, MAX_PLY, NO_MOVE, UNDO_SIZE
+
+@structref.register
+class BatchType(nb.types.StructRef):
+    """numba type of StateBatch"""
+
+
+spec = [
+    ("n", nb.int64),
+    ("mat", nb.int8[:, :, ::1]),
+    ("pieces", nb.int8[:, :, ::1]),
+    ("types", nb.int8[:, ::1]),
+    ("actions", nb.int16[:, :, ::1]),
+    ("action_idx", nb.int16[::1]),
+    ("zobrist", nb.uint64[::1]),
+    ("castling", nb.int8[::1]),
+    ("ep", nb.int8[::1]),
+    ("halfmove", nb.int16[::1]),
+    ("mg", nb.int32[:, ::1]),
+    ("eg", nb.int32[:, ::1]),
+    ("phase", nb.int32[::1]),
+    ("start", STATE_TYPE),
+    ("state", STATE_TYPE),
+]
+BATCH_TYPE = BatchType(spec)
+
+
+@njit(cache=True)
+def new_batch(n, max_plies):
+    batch = structref.new(BATCH_TYPE)
+    batch.n = n
+    batch.mat = np.empty((n, 8, 8), dtype=np.int8)
+    batch.pieces = np.empty((n, 32, 2), dtype=np.int8)
+    batch.types = np.empty((n, 32), dtype=np.int8)
+    # One more slot per game for the legality probes, as State.actions
+    batch.actions = np.zeros((n, max_plies + 1, UNDO_SIZE), dtype=np.int16)
+    batch.action_idx = np.zeros(n, dtype=np.int16)
+    batch.zobrist = np.zeros(n, dtype=np.uint64)
+    batch.castling = np.empty(n, dtype=np.int8)
+    batch.ep = np.empty(n, dtype=np.int8)
+    batch.halfmove = np.empty(n, dtype=np.int16)
+    batch.mg = np.empty((n, 2), dtype=np.int32)
+    batch.eg = np.empty((n, 2), dtype=np.int32)
+    batch.phase = np.empty(n, dtype=np.int32)
+    batch.start = new_state(max_plies)
+    batch.state = new_state(max_plies)
+    for k in range(n):
+        reset(batch, k)
+    return batch
+
+
+@njit(cache=True)
+def reset(batch, k):
+    """Put game k back to the start position"""
+    batch.mat[k] = batch.start.mat
+    batch.pieces[k] = batch.start.pieces
+    batch.types[k] = batch.start.types
+    batch.action_idx[k] = 0
+    batch.zobrist[k] = batch.start.zobrist
+    batch.castling[k] = batch.start.castling
+    batch.ep[k] = batch.start.ep
+    batch.halfmove[k] = batch.start.halfmove
+    batch.mg[k] = batch.start.mg
+    batch.eg[k] = batch.start.eg
+    batch.phase[k] = batch.start.phase
+
+
+@njit(cache=True)
+def bind(batch, k):
+    """Scratch State viewing game k, to be followed by store(batch, k)"""
+    state = batch.state
+    state.mat = batch.mat[k]
+    state.pieces = batch.pieces[k]
+    state.types = batch.types[k]
+    state.actions = batch.actions[k]
+    state.mg = batch.mg[k]
+    state.eg = batch.eg[k]
+    state.action_idx = batch.action_idx[k]
+    state.zobrist = batch.zobrist[k]
+    state.castling = batch.castling[k]
+    state.ep = batch.ep[k]
+    state.halfmove = batch.halfmove[k]
+    state.phase = batch.phase[k]
+    return state
+
+
+@njit(cache=True)
+def store(batch, k):
+    """Write back the scalar members of the scratch State to game k"""
+    batch.action_idx[k] = batch.state.action_idx
+    batch.zobrist[k] = batch.state.zobrist
+    batch.castling[k] = batch.state.castling
+    batch.ep[k] = batch.state.ep
+    batch.halfmove[k] = batch.state.halfmove
+    batch.phase[k] = batch.state.phase
+
+
+@njit(cache=True)
+def push(batch, moves):
+    """Play moves[k] in game k, games with NO_MOVE are left untouched"""
+    for k in range(batch.n):
+        if moves[k] == NO_MOVE:
+            continue
+        if batch.action_idx[k] >= batch.actions.shape[1] - 1:
+            raise IndexError("Action stack full")
+        bind(batch, k).push_move(moves[k])
+        store(batch, k)
+
+
+@njit(cache=True)
+def pop(batch, mask):
+    """Undo the last move of the games where mask is set"""
+    for k in range(batch.n):
+        if not mask[k] or batch.action_idx[k] == 0:
+            continue
+        bind(batch, k).pop_action()
+        store(batch, k)
+
+
+@njit(cache=True)
+def gen_moves(batch, buf, counts):
+    """Write the legal packed moves of the side to move of game k to buf[k] and
+    their number to counts[k]"""
+    for k in range(batch.n):
+        state = bind(batch, k)
+        counts[k] = state.gen_moves(state.get_player_color(), buf[k])
+
+
+@njit(cache=True)
+def is_terminal(batch, out):
+    """State.is_terminal of the side to move, for every game"""
+    for k in range(batch.n):
+        state = bind(batch, k)
+        out[k] = state.is_terminal(state.get_player_color())
+
+
+@njit(cache=True)
+def player_colors(batch, out):
+    for k in range(batch.n):
+        out[k] = bind(batch, k).get_player_color()
+
+
+@njit(cache=True)
+def evaluate(batch, out):
+    """State.evaluate from the side to move, for every game"""
+    for k in range(batch.n):
+        state = bind(batch, k)
+        out[k] = state.evaluate(state.get_player_color())
+
+
+@njit(cache=True)
+def to_state(batch, k):
+    """Standalone State copy of game k"""
+    state = alloc_state(batch.actions.shape[1] - 1)
+    state.mat[:, :] = batch.mat[k]
+    state.pieces[:, :] = batch.pieces[k]
+    state.types[:] = batch.types[k]
+    n = batch.action_idx[k]
+    state.actions[:n] = batch.actions[k, :n]
+    state.action_idx = n
+    state.zobrist = batch.zobrist[k]
+    state.castling = batch.castling[k]
+    state.ep = batch.ep[k]
+    state.halfmove = batch.halfmove[k]
+    state.mg[:] = batch.mg[k]
+    state.eg[:] = batch.eg[k]
+    state.phase = batch.phase[k]
+    return state
+
+
+@njit(cache=True)
+def get_n(batch):
+    return batch.n
+
+
+@njit(cache=True)
+def get_action_idx(batch):
+    return batch.action_idx
+
+
+class StateBatch(structref.StructRefProxy):
+    """N games stored as arrays, the first axis being the game. The kernels
+    run State code on one game at a time through a scratch State whose
+    arrays are rebound to views of the batch"""
+
+    def __new__(cls, n, max_plies):
+        return new_batch(n, max_plies)
+
+    n = property(get_n)
+    action_idx = property(get_action_idx)
+
+
+structref.define_boxing(BatchType, StateBatch)
+bind_methods(
+    BatchType,
+    StateBatch,
+    {
+        "reset": reset,
+        "bind": bind,
+        "store": store,
+        "push": push,
+        "pop": pop,
+        "gen_moves": gen_moves,
+        "is_terminal": is_terminal,
+        "player_colors": player_colors,
+        "evaluate": evaluate,
+        "to_state": to_state,
+    },
+)
+
+
+def create_batch(n, max_plies=MAX_PLY):
+    """StateBatch of n games in the start position, holding max_plies moves each"""
+    return StateBatch(n, max_plies)
+
+
+@njit("void(int64)", cache=True)
+def seed_random(seed):
+    """Seed the random generator of njit code"""
+    np.random.seed(seed)
+
+
+@njit("void(int16[:, :], int32[:], int16[:])", cache=True)
+def pick_random(buf, counts, moves):
+    """Uniformly random move among the counts[k] first of buf[k], NO_MOVE if none"""
+    for k in range(counts.shape[0]):
+        moves[k] = buf[k, np.random.randint(counts[k])] if counts[k] > 0 else NO_MOVE
+
+
+@njit(cache=True)
+def random_games(batch, plies, buf, counts, moves):
+    """Play up to plies random moves in every game of the batch, restarting
+    the games that run out of moves or stack. Returns the positions reached"""
+    positions = 0
+    for _ in range(plies):
+        for k in range(batch.n):
+            if batch.action_idx[k] == batch.actions.shape[1] - 1:
+                batch.reset(k)
+        batch.gen_moves(buf, counts)
+        for k in range(batch.n):
+            if counts[k] == 0:
+                batch.reset(k)
+        pick_random(buf, counts, moves)
+        batch.push(moves)
+        for k in range(batch.n):
+            positions += moves[k] != NO_MOVE
+    return positions
+
+
+def self_play_rate(n=1024, plies=256, seed=0):
+    """Random self-play positions generated per hour over a batch of n games"""
+    batch = create_batch(n)
+    buf = np.zeros((n, MAX_MOVES), dtype=np.int16)
+    counts = np.zeros(n, dtype=np.int32)
+    moves = np.zeros(n, dtype=np.int16)
+    seed_random(seed)
+    # Compile
+    random_games(create_batch(1), 1, buf[:1], counts[:1], moves[:1])
+    start = time.time()
+    positions = random_games(batch, plies, buf, counts, moves)
+    return positions / (time.time() - start) * 3600
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched random self-play throughput")
+    parser.add_argument("--games", type=int, default=1024)
+    parser.add_argument("--plies", type=int, default=256)
+    args = parser.parse_args()
+    print("{:.3g} positions per hour".format(self_play_rate(args.games, args.plies)))
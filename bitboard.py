@@ -0,0 +1,864 @@
+#!/usr/bin/python3
+
+import numba as nb
+from numba import njit
+from numba.experimental import structref
+import numpy as np
+from utils import bind_methods, timeit
+from state import (
+    KING,
+    QUEEN,
+    BISHOP,
+    KNIGNT,
+    ROOK,
+    PAWN,
+    PIECE_TYPE,
+    IDX_TYPE,
+    KING_IDX,
+    ONGOING,
+    CHECKMATE,
+    STALEMATE,
+    INSUFFICIENT_MATERIAL,
+    FIFTY_MOVES,
+    FIFTY_MOVE_PLIES,
+    NORMAL,
+    CASTLE,
+    EN_PASSANT,
+    PROMOTION,
+    ALL_CASTLING,
+    CASTLING_MASK,
+    UNDO_SIZE,
+    STACK_SIZE,
+    MAX_PIECE_MOVES,
+    MAX_MOVES,
+    OMNIDIRECTIONAL,
+    JUMPS,
+    ZOBRIST,
+    ZOBRIST_TURN,
+    ZOBRIST_CASTLING,
+    ZOBRIST_EP,
+    POSITION_METHODS,
+    PositionProxy,
+    unpack,
+    pack_move_flag,
+    move_flag,
+    in_bounds,
+    init_position,
+    update_castling,
+    update_ep,
+    add_scores,
+    stack_full,
+    get_player_color,
+)
+
+# Bitboard constants, typed to keep numba in unsigned arithmetic
+ZERO = np.uint64(0)
+ONE = np.uint64(1)
+ALL = ~ZERO
+DEBRUIJN = np.uint64(0x03F79D71B4CB0A89)
+DEBRUIJN_SHIFT = np.uint64(58)
+# Kindergarten slider lookups: the 6 inner squares of a line are gathered in
+# the top byte by a multiplication, then looked up in LINE_ATTACKS
+FILL = np.uint64(0x0101010101010101)
+FILE_A = np.uint64(0x0101010101010101)
+# Moves bit 8 * i of the A file to bit 56 + i, without carries
+FILE_MAGIC = np.uint64(sum(1 << (56 - 7 * i) for i in range(8)))
+INNER = np.uint64(63)
+INNER_SHIFT = np.uint64(57)
+# Population count masks
+POP_1 = np.uint64(0x5555555555555555)
+POP_2 = np.uint64(0x3333333333333333)
+POP_4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+POP_SHIFTS = np.uint64([1, 2, 4, 56])
+
+
+def _build_tables():
+    square = np.uint64(1) << np.arange(64, dtype=np.uint64)
+    knight = np.zeros(64, dtype=np.uint64)
+    king = np.zeros(64, dtype=np.uint64)
+    pawn = np.zeros((2, 64), dtype=np.uint64)
+    # Diagonal and anti-diagonal through each square, the square excluded
+    diagonal = np.zeros((2, 64), dtype=np.uint64)
+    for i in range(8):
+        for j in range(8):
+            sq = i * 8 + j
+            for di, dj in JUMPS:
+                if 0 <= i + di < 8 and 0 <= j + dj < 8:
+                    knight[sq] |= square[(i + di) * 8 + j + dj]
+            for di, dj in OMNIDIRECTIONAL:
+                if 0 <= i + di < 8 and 0 <= j + dj < 8:
+                    king[sq] |= square[(i + di) * 8 + j + dj]
+            for ip in range(8):
+                for jp in range(8):
+                    if ip != i and ip - i == jp - j:
+                        diagonal[0, sq] |= square[ip * 8 + jp]
+                    if ip != i and ip - i == j - jp:
+                        diagonal[1, sq] |= square[ip * 8 + jp]
+            for c in range(2):
+                ip = i + c * 2 - 1
+                for jp in (j - 1, j + 1):
+                    if 0 <= ip < 8 and 0 <= jp < 8:
+                        pawn[c, sq] |= square[ip * 8 + jp]
+    # line[k, o]: squares of a line of 8 attacked from position k, the inner
+    # occupancy o holding positions 1 to 6
+    line = np.zeros((8, 64), dtype=np.uint8)
+    for k in range(8):
+        for o in range(64):
+            occ = o << 1
+            for step in (-1, 1):
+                kp = k + step
+                while 0 <= kp < 8:
+                    line[k, o] |= 1 << kp
+                    if occ & 1 << kp:
+                        break
+                    kp += step
+    # Byte b spread along the A file, bit k to rank k
+    spread = np.zeros(256, dtype=np.uint64)
+    for b in range(256):
+        for k in range(8):
+            if b & 1 << k:
+                spread[b] |= square[k * 8]
+    # lsb lookup, indexed by the top 6 bits of isolated bit * DEBRUIJN
+    debruijn = np.zeros(64, dtype=np.int8)
+    debruijn[(square * DEBRUIJN) >> DEBRUIJN_SHIFT] = np.arange(64)
+    # Squares between the king and rook of each color and castling side
+    path = np.zeros((2, 2), dtype=np.uint64)
+    for c in range(2):
+        i = 7 if c == 0 else 0
+        path[c, 0] = square[i * 8 + 5] | square[i * 8 + 6]
+        path[c, 1] = square[i * 8 + 1] | square[i * 8 + 2] | square[i * 8 + 3]
+    # Squares strictly between two squares of a line, and the whole line
+    # through them, both empty for squares not on a common line
+    between = np.zeros((64, 64), dtype=np.uint64)
+    through = np.zeros((64, 64), dtype=np.uint64)
+    for sq in range(64):
+        i, j = divmod(sq, 8)
+        for di, dj in OMNIDIRECTIONAL:
+            full = square[sq]
+            for k in range(-7, 8):
+                if 0 <= i + di * k < 8 and 0 <= j + dj * k < 8:
+                    full |= square[(i + di * k) * 8 + j + dj * k]
+            ray = np.uint64(0)
+            for k in range(1, 8):
+                if not (0 <= i + di * k < 8 and 0 <= j + dj * k < 8):
+                    break
+                sqp = (i + di * k) * 8 + j + dj * k
+                between[sq, sqp] = ray
+                through[sq, sqp] = full
+                ray |= square[sqp]
+    return square, knight, king, pawn, diagonal, line, spread, debruijn, path, between, through
+
+
+(
+    SQUARE_BB,
+    KNIGHT_ATTACKS,
+    KING_ATTACKS,
+    PAWN_ATTACKS,
+    DIAGONAL_MASK,
+    LINE_ATTACKS,
+    FILE_SPREAD,
+    DEBRUIJN_IDX,
+    CASTLING_PATH,
+    BETWEEN_BB,
+    LINE_BB,
+) = _build_tables()
+
+
+@njit("int64(uint64)", cache=True)
+def lsb(b):
+    """Index of the least significant bit"""
+    return DEBRUIJN_IDX[((b & (~b + ONE)) * DEBRUIJN) >> DEBRUIJN_SHIFT]
+
+
+@njit("int64(uint64)", cache=True)
+def popcount(b):
+    b -= (b >> POP_SHIFTS[0]) & POP_1
+    b = (b & POP_2) + ((b >> POP_SHIFTS[1]) & POP_2)
+    b = (b + (b >> POP_SHIFTS[2])) & POP_4
+    return (b * FILL) >> POP_SHIFTS[3]
+
+
+@njit("uint64(int64, uint64, uint64)", cache=True)
+def diagonal_attacks(sq, occ, mask):
+    """Squares reached from sq along the diagonal mask, blockers included"""
+    o = (((occ & mask) * FILL) >> INNER_SHIFT) & INNER
+    return (np.uint64(LINE_ATTACKS[sq % 8, o]) * FILL) & mask
+
+
+@njit("uint64(int64, uint64)", cache=True)
+def bishop_attacks(sq, occ):
+    return diagonal_attacks(sq, occ, DIAGONAL_MASK[0, sq]) | diagonal_attacks(
+        sq, occ, DIAGONAL_MASK[1, sq]
+    )
+
+
+@njit("uint64(int64, uint64)", cache=True)
+def rook_attacks(sq, occ):
+    i, j = np.uint64(sq // 8), np.uint64(sq % 8)
+    shift = np.uint64(8) * i
+    rank = np.uint64(LINE_ATTACKS[j, (occ >> (shift + ONE)) & INNER]) << shift
+    o = ((((occ >> j) & FILE_A) * FILE_MAGIC) >> INNER_SHIFT) & INNER
+    return rank | FILE_SPREAD[LINE_ATTACKS[i, o]] << j
+
+
+@structref.register
+class BitboardType(nb.types.StructRef):
+    """numba type of BitboardState"""
+
+
+# The position is held by the bitboards of each piece code c * 6 + type and a
+# board of codes by square only: the mat, pieces and types arrays of
+# state.State are derived from them on demand, by piece_list
+spec = [
+    ("bb", nb.uint64[::1]),
+    ("occ", nb.uint64[::1]),
+    ("board", nb.int8[::1]),
+    ("actions", nb.int16[:, ::1]),
+    ("action_idx", nb.int16),
+    ("zobrist", nb.uint64),
+    ("castling", nb.int8),
+    ("ep", nb.int8),
+    ("halfmove", nb.int16),
+    ("scratch", nb.int16[::1]),
+    ("check_tests", nb.int64),
+    ("count_checks", nb.boolean),
+    ("mg", nb.int32[::1]),
+    ("eg", nb.int32[::1]),
+    ("phase", nb.int32),
+    ("first_color", nb.int8),
+]
+BITBOARD_TYPE = BitboardType(spec)
+
+
+@njit(cache=True)
+def put_piece(state, code, sq):
+    """Put a piece of code on the empty square sq"""
+    state.bb[code] ^= SQUARE_BB[sq]
+    state.occ[code // 6] ^= SQUARE_BB[sq]
+    state.board[sq] = code
+    state.zobrist ^= ZOBRIST[code, sq // 8, sq % 8]
+    add_scores(state, code, sq // 8, sq % 8, 1)
+
+
+@njit(cache=True)
+def take_piece(state, sq):
+    """Remove the piece on sq, return its code"""
+    code = state.board[sq]
+    state.bb[code] ^= SQUARE_BB[sq]
+    state.occ[code // 6] ^= SQUARE_BB[sq]
+    state.board[sq] = -1
+    state.zobrist ^= ZOBRIST[code, sq // 8, sq % 8]
+    add_scores(state, code, sq // 8, sq % 8, -1)
+    return code
+
+
+@njit(cache=True)
+def set_piece(state, c, p, i, j, t):
+    """Put a piece of color c and type t on (i, j). Pieces have no index on
+    bitboards, so p is ignored: piece_list numbers them"""
+    put_piece(state, c * 6 + t, i * 8 + j)
+
+
+@njit(cache=True)
+def clear_board(state):
+    """Empty board and move history, white to move"""
+    state.bb[:] = 0
+    state.occ[:] = 0
+    state.board[:] = -1
+    state.action_idx = 0
+    state.zobrist = 0
+    state.castling = 0
+    state.ep = -1
+    state.halfmove = 0
+    state.mg[:] = 0
+    state.eg[:] = 0
+    state.phase = 0
+    state.first_color = 0
+
+
+@njit(cache=True)
+def push_move(state, move):
+    if stack_full(state):
+        raise IndexError("Undo stack full")
+    make_move(state, move)
+
+
+@njit(cache=True)
+def make_move(state, move):
+    """Play a packed move and push its undo record, without checking the
+    stack has room"""
+    src, dst, flag = move % 4096 // 64, move % 64, move // 4096
+    code = state.board[src]
+    c, t = code // 6, code % 6
+    # En passant captures the pawn next to the moving one
+    captured_sq = src // 8 * 8 + dst % 8 if flag == EN_PASSANT else dst
+    captured = state.board[captured_sq]
+    ep_file = state.ep % 8 + 1 if state.ep > -1 else 0
+    record = state.actions[state.action_idx]
+    record[0] = move
+    record[1] = (captured + 1) | np.int64(state.castling) << 6 | ep_file << 10
+    record[2] = state.halfmove
+    if captured > -1:
+        take_piece(state, captured_sq)
+    take_piece(state, src)
+    put_piece(state, c * 6 + flag - PROMOTION if flag > PROMOTION else code, dst)
+    if flag == CASTLE:
+        rook_src, rook_dst = (src + 3, src + 1) if dst > src else (src - 4, src - 1)
+        put_piece(state, take_piece(state, rook_src), rook_dst)
+    update_castling(state, state.castling & CASTLING_MASK[src] & CASTLING_MASK[dst])
+    update_ep(state, (src + dst) // 2 if t == PAWN and abs(dst - src) == 16 else -1)
+    state.halfmove = 0 if t == PAWN or captured > -1 else state.halfmove + 1
+    state.zobrist ^= ZOBRIST_TURN
+    state.action_idx += 1
+
+
+@njit(cache=True)
+def unmake_move(state):
+    """Pop the last undo record and restore the position before its move"""
+    if state.action_idx == 0:
+        print("Empty action stack")
+        return
+    state.action_idx -= 1
+    move, info, halfmove = state.actions[state.action_idx, :]
+    src, dst, flag = move % 4096 // 64, move % 64, move // 4096
+    code = take_piece(state, dst)
+    c = code // 6
+    put_piece(state, c * 6 + PAWN if flag > PROMOTION else code, src)
+    if flag == CASTLE:
+        rook_src, rook_dst = (src + 3, src + 1) if dst > src else (src - 4, src - 1)
+        put_piece(state, take_piece(state, rook_dst), rook_src)
+    captured = info % 64 - 1
+    if captured > -1:
+        put_piece(state, captured, src // 8 * 8 + dst % 8 if flag == EN_PASSANT else dst)
+    update_castling(state, info >> 6 & ALL_CASTLING)
+    # The en passant square is behind a pawn of the opponent of c
+    ep_file = info >> 10 & 15
+    update_ep(state, (2 if c == 0 else 5) * 8 + ep_file - 1 if ep_file > 0 else -1)
+    state.halfmove = halfmove
+    state.zobrist ^= ZOBRIST_TURN
+
+
+@njit(cache=True)
+def attackers(state, sq, c, occ):
+    """Pieces of color c attacking sq, the sliders blocked by occ"""
+    if state.count_checks:
+        state.check_tests += 1
+    bb, base = state.bb, c * 6
+    return (
+        (KNIGHT_ATTACKS[sq] & bb[base + KNIGNT])
+        | (KING_ATTACKS[sq] & bb[base + KING])
+        | (PAWN_ATTACKS[1 - c, sq] & bb[base + PAWN])
+        | (bishop_attacks(sq, occ) & (bb[base + BISHOP] | bb[base + QUEEN]))
+        | (rook_attacks(sq, occ) & (bb[base + ROOK] | bb[base + QUEEN]))
+    )
+
+
+@njit(cache=True)
+def square_attacked(state, sq, c):
+    """Is sq attacked by color c"""
+    return attackers(state, sq, c, state.occ[0] | state.occ[1]) != ZERO
+
+
+@njit(cache=True)
+def is_square_attacked(state, i, j, c):
+    """Is (i, j) attacked by the opponent of color c"""
+    return square_attacked(state, i * 8 + j, 1 - c)
+
+
+@njit(cache=True)
+def pinned_pieces(state, c, king_sq, occ):
+    """Pieces of color c pinned to its king on king_sq: the only piece between
+    the king and an opponent slider seeing it through the pieces of c"""
+    bb, base = state.bb, (1 - c) * 6
+    others = state.occ[1 - c]
+    snipers = bishop_attacks(king_sq, others) & (bb[base + BISHOP] | bb[base + QUEEN])
+    snipers |= rook_attacks(king_sq, others) & (bb[base + ROOK] | bb[base + QUEEN])
+    pinned = ZERO
+    while snipers:
+        between = BETWEEN_BB[king_sq, lsb(snipers)] & occ
+        snipers &= snipers - ONE
+        if between and between & (between - ONE) == ZERO:
+            pinned |= between
+    return pinned
+
+
+@njit(cache=True)
+def ep_target(state, c):
+    """Bitboard of the en passant square pawns of color c can capture on"""
+    if state.ep < 0 or state.ep // 8 != (2 if c == 0 else 5):
+        return ZERO
+    return SQUARE_BB[state.ep]
+
+
+@njit(cache=True)
+def is_legal_en_passant(state, c, sq, king_sq):
+    """Is the en passant capture of the pawn of color c on sq legal: with both
+    pawns off their squares, nothing attacks the king. This covers the pins
+    along the row of the pawns"""
+    if state.count_checks:
+        state.check_tests += 1
+    captured = SQUARE_BB[sq // 8 * 8 + state.ep % 8]
+    occ = (state.occ[0] | state.occ[1]) ^ SQUARE_BB[sq] ^ captured | SQUARE_BB[state.ep]
+    bb, base = state.bb, (1 - c) * 6
+    attacks = bishop_attacks(king_sq, occ) & (bb[base + BISHOP] | bb[base + QUEEN])
+    attacks |= rook_attacks(king_sq, occ) & (bb[base + ROOK] | bb[base + QUEEN])
+    attacks |= KNIGHT_ATTACKS[king_sq] & bb[base + KNIGNT]
+    attacks |= PAWN_ATTACKS[c, king_sq] & bb[base + PAWN] & ~captured
+    return attacks == ZERO
+
+
+@njit(cache=True)
+def write_targets(buf, n, sq, targets):
+    """Write the moves from sq to each of targets to buf from index n, return
+    the new count"""
+    while targets:
+        buf[n] = sq * 64 + lsb(targets)
+        targets &= targets - ONE
+        n += 1
+    return n
+
+
+@njit(cache=True)
+def write_pawn_targets(buf, n, sq, targets):
+    """write_targets of a pawn, as its four promotions on the last rows"""
+    while targets:
+        dst = lsb(targets)
+        targets &= targets - ONE
+        if dst < 8 or dst >= 56:
+            for t in range(QUEEN, ROOK + 1):
+                buf[n] = (PROMOTION + t) * 4096 + sq * 64 + dst
+                n += 1
+        else:
+            buf[n] = sq * 64 + dst
+            n += 1
+    return n
+
+
+@njit(cache=True)
+def write_pawn_moves(state, c, captures, targets, pinned, king_sq, buf, n, limit):
+    """Write the legal pawn moves of color c to the targets squares, see
+    write_moves"""
+    forward = 8 if c else -8
+    ep = ep_target(state, c)
+    pawns = state.bb[c * 6 + PAWN]
+    while pawns:
+        sq = lsb(pawns)
+        pawns &= pawns - ONE
+        moves = PAWN_ATTACKS[c, sq] & state.occ[1 - c]
+        if not captures and state.board[sq + forward] < 0:
+            moves |= SQUARE_BB[sq + forward]
+            if sq // 8 == (1 if c else 6) and state.board[sq + 2 * forward] < 0:
+                moves |= SQUARE_BB[sq + 2 * forward]
+        moves &= targets
+        if pinned & SQUARE_BB[sq]:
+            moves &= LINE_BB[king_sq, sq]
+        n = write_pawn_targets(buf, n, sq, moves)
+        if PAWN_ATTACKS[c, sq] & ep and is_legal_en_passant(state, c, sq, king_sq):
+            buf[n] = EN_PASSANT * 4096 + sq * 64 + state.ep
+            n += 1
+        if n >= limit:
+            return n
+    return n
+
+
+@njit(cache=True)
+def write_castles(state, c, king_sq, occ, buf, n):
+    """Write the castling moves of color c, not in check, as state.write_castles"""
+    i = 7 if c == 0 else 0
+    rights = state.castling >> 2 * c
+    if rights & 3 == 0 or king_sq != i * 8 + 4:
+        return n
+    for side in range(2):
+        # Kingside, then queenside
+        rook_j, step = (7, 1) if side == 0 else (0, -1)
+        if rights & (1 << side) == 0 or state.board[i * 8 + rook_j] != c * 6 + ROOK:
+            continue
+        if occ & CASTLING_PATH[c, side]:
+            continue
+        # The king crosses one square and lands on the next
+        if attackers(state, king_sq + step, 1 - c, occ):
+            continue
+        if attackers(state, king_sq + 2 * step, 1 - c, occ):
+            continue
+        buf[n] = CASTLE * 4096 + king_sq * 64 + king_sq + 2 * step
+        n += 1
+    return n
+
+
+@njit(cache=True)
+def write_moves(state, c, captures, buf, limit):
+    """Write the legal packed moves of color c to buf, only the captures if
+    captures is set, return their count. Checkers and pins are found once, so
+    only the king moves and en passant test for attacks. Returns early, after
+    the moves of a piece, once the count reaches limit"""
+    bb, base = state.bb, c * 6
+    own, others = state.occ[c], state.occ[1 - c]
+    occ = own | others
+    king_sq = lsb(bb[base + KING])
+    checkers = attackers(state, king_sq, 1 - c, occ)
+    targets = others if captures else ~own
+    n = 0
+    # Only the king moves out of a double check
+    if checkers & (checkers - ONE) == ZERO:
+        # Single check must be blocked or captured
+        mask = targets & (BETWEEN_BB[king_sq, lsb(checkers)] | checkers if checkers else ALL)
+        pinned = pinned_pieces(state, c, king_sq, occ)
+        for t in (KNIGNT, BISHOP, ROOK, QUEEN):
+            pieces = bb[base + t]
+            while pieces:
+                sq = lsb(pieces)
+                pieces &= pieces - ONE
+                if t == KNIGNT:
+                    moves = KNIGHT_ATTACKS[sq]
+                elif t == BISHOP:
+                    moves = bishop_attacks(sq, occ)
+                elif t == ROOK:
+                    moves = rook_attacks(sq, occ)
+                else:
+                    moves = bishop_attacks(sq, occ) | rook_attacks(sq, occ)
+                moves &= mask
+                # Pinned pieces stay on the line of the king and the pinner
+                if pinned & SQUARE_BB[sq]:
+                    moves &= LINE_BB[king_sq, sq]
+                n = write_targets(buf, n, sq, moves)
+                if n >= limit:
+                    return n
+        n = write_pawn_moves(state, c, captures, mask, pinned, king_sq, buf, n, limit)
+        if n >= limit:
+            return n
+    # The king doesn't shield the squares behind it from sliders
+    moves = KING_ATTACKS[king_sq] & targets
+    occ_without_king = occ ^ SQUARE_BB[king_sq]
+    while moves:
+        dst = lsb(moves)
+        moves &= moves - ONE
+        if not attackers(state, dst, 1 - c, occ_without_king):
+            buf[n] = king_sq * 64 + dst
+            n += 1
+    if not captures and not checkers:
+        n = write_castles(state, c, king_sq, occ, buf, n)
+    return n
+
+
+@njit(cache=True)
+def gen_moves(state, color, buf):
+    """Write all legal packed moves of color to buf, return the count"""
+    return write_moves(state, color, False, buf, MAX_MOVES)
+
+
+@njit(cache=True)
+def gen_captures(state, color, buf):
+    """Write the legal captures of color to buf, return the count"""
+    return write_moves(state, color, True, buf, MAX_MOVES)
+
+
+@njit(cache=True)
+def has_legal_move(state, color):
+    """Does color have a legal move, stopping after the first piece with one"""
+    return write_moves(state, color, False, state.scratch, 1) > 0
+
+
+@njit(cache=True)
+def is_insufficient(state):
+    """state.insufficient_material on the bitboards"""
+    bb = state.bb
+    for t in (QUEEN, ROOK, PAWN):
+        if bb[t] | bb[6 + t]:
+            return False
+    minors = bb[BISHOP] | bb[KNIGNT] | bb[6 + BISHOP] | bb[6 + KNIGNT]
+    return minors & (minors - ONE) == ZERO
+
+
+@njit(cache=True)
+def game_status(state, color):
+    """ONGOING, CHECKMATE, STALEMATE, INSUFFICIENT_MATERIAL or FIFTY_MOVES,
+    color to move"""
+    if is_insufficient(state):
+        return INSUFFICIENT_MATERIAL
+    if not has_legal_move(state, color):
+        checked = square_attacked(state, lsb(state.bb[color * 6 + KING]), 1 - color)
+        return CHECKMATE if checked else STALEMATE
+    if state.halfmove >= FIFTY_MOVE_PLIES:
+        return FIFTY_MOVES
+    return ONGOING
+
+
+@njit(cache=True)
+def material(state, values, color):
+    """Sum of values[type] over the pieces of color, minus the opponent's"""
+    value = 0
+    for t in range(6):
+        count = popcount(state.bb[color * 6 + t]) - popcount(state.bb[(1 - color) * 6 + t])
+        value += values[t] * count
+    return value
+
+
+@njit(cache=True)
+def position_zobrist(state):
+    """Zobrist key computed from scratch"""
+    key = np.uint64(0)
+    for sq in range(64):
+        if state.board[sq] > -1:
+            key ^= ZOBRIST[state.board[sq], sq // 8, sq % 8]
+    if get_player_color(state) == 1:
+        key ^= ZOBRIST_TURN
+    key ^= ZOBRIST_CASTLING[state.castling]
+    if state.ep > -1:
+        key ^= ZOBRIST_EP[state.ep % 8]
+    return key
+
+
+# The piece indices of the state.State API, numbered from the board
+
+
+@njit(cache=True)
+def piece_list(state):
+    """(mat, pieces, types) arrays of state.State, numbering the pieces as
+    pgn.set_position does: by slot of their type in board order, the pieces
+    beyond the slots of their type in the free pawn slots"""
+    mat = np.full((8, 8), -1, dtype=np.int8)
+    pieces = np.full((32, 2), -1, dtype=np.int8)
+    types = IDX_TYPE.copy()
+    for promoted in (False, True):
+        for sq in range(64):
+            code = state.board[sq]
+            i, j = sq // 8, sq % 8
+            if code < 0 or mat[i, j] > -1:
+                continue
+            c, t = code // 6, code % 6
+            for p in range(16):
+                idx = c * 16 + p
+                slot = PIECE_TYPE[p] == (PAWN if promoted else t)
+                if slot and pieces[idx, 0] < 0:
+                    mat[i, j] = idx
+                    pieces[idx, 0] = i
+                    pieces[idx, 1] = j
+                    types[idx] = t
+                    break
+    return mat, pieces, types
+
+
+@njit(cache=True)
+def get_mat(state):
+    return piece_list(state)[0]
+
+
+@njit(cache=True)
+def get_pieces(state):
+    return piece_list(state)[1]
+
+
+@njit(cache=True)
+def get_types(state):
+    return piece_list(state)[2]
+
+
+@njit(cache=True)
+def get_idx(state, i, j):
+    return get_mat(state)[i, j] if in_bounds(state, i, j) else np.int8(-1)
+
+
+@njit(cache=True)
+def get_piece(state, i, j):
+    """(color, piece, type) on (i, j)"""
+    c, p, _ = unpack(get_idx(state, i, j))
+    return c, p, get_type(state, i, j)
+
+
+@njit(cache=True)
+def get_color(state, i, j):
+    code = state.board[i * 8 + j] if in_bounds(state, i, j) else -1
+    return code // 6 if code > -1 else -1
+
+
+@njit(cache=True)
+def get_type(state, i, j):
+    """Type on (i, j), -1 if empty"""
+    code = state.board[i * 8 + j] if in_bounds(state, i, j) else -1
+    return code % 6 if code > -1 else -1
+
+
+@njit(cache=True)
+def piece_code(state, idx):
+    """Piece code c * 6 + type of idx"""
+    return idx // 16 * 6 + get_types(state)[idx]
+
+
+@njit(cache=True)
+def is_pieced_checked(state, idx):
+    c = idx // 16
+    if idx % 16 == KING_IDX:
+        return square_attacked(state, lsb(state.bb[c * 6 + KING]), 1 - c)
+    i, j = get_pieces(state)[idx]
+    return i > -1 and square_attacked(state, i * 8 + j, 1 - c)
+
+
+@njit(cache=True)
+def action_move(state, idx, ip, jp):
+    """Packed move of idx to (ip, jp): castling when the king moves two
+    columns, en passant when a pawn captures an empty square, and
+    promotion to a queen"""
+    i, j = get_pieces(state)[idx]
+    t = get_type(state, i, j)
+    flag = NORMAL
+    if t == KING and abs(jp - j) == 2:
+        flag = CASTLE
+    elif t == PAWN and jp != j and state.board[ip * 8 + jp] < 0:
+        flag = EN_PASSANT
+    elif t == PAWN and (ip == 0 or ip == 7):
+        flag = PROMOTION + QUEEN
+    return pack_move_flag(i, j, ip, jp, flag)
+
+
+@njit(cache=True)
+def push_action(state, idx, action):
+    ip, jp = action
+    push_move(state, action_move(state, idx, ip, jp))
+
+
+@njit(cache=True)
+def actions_list(buf, n, sq):
+    """Target squares of the moves from sq among the first n of buf, as
+    get_actions returns. Promotions are listed once, as a queen promotion"""
+    pos = []  # [(np.int8(0), np.int8(0)) for _ in range(0)]
+    for k in range(n):
+        move = buf[k]
+        if move % 4096 // 64 != sq or move_flag(move) > PROMOTION + QUEEN:
+            continue
+        dst = move % 64
+        pos.append(np.int8((dst // 8, dst % 8)))
+    return pos
+
+
+@njit(cache=True)
+def get_actions(state, idx):
+    # list [(i, j)]
+    i, j = get_pieces(state)[idx]
+    buf = np.zeros(MAX_MOVES, dtype=np.int16)
+    n = gen_moves(state, idx // 16, buf)
+    return actions_list(buf, n, i * 8 + j if i > -1 else -1)
+
+
+@njit(cache=True)
+def get_player_actions(state, color):
+    player_actions = []
+    pieces = get_pieces(state)
+    buf = np.zeros(MAX_MOVES, dtype=np.int16)
+    n = gen_moves(state, color, buf)
+    for p in range(16):
+        idx = color * 16 + p
+        i, j = pieces[idx]
+        actions = actions_list(buf, n, i * 8 + j if i > -1 else -1)
+        if actions:
+            player_actions.append((idx, actions))
+    return player_actions
+
+
+@njit(cache=True)
+def alloc_state(stack_size):
+    """Empty BitboardState holding stack_size plies of moves"""
+    state = structref.new(BITBOARD_TYPE)
+    state.bb = np.zeros(12, dtype=np.uint64)
+    state.occ = np.zeros(2, dtype=np.uint64)
+    state.board = np.full(64, -1, dtype=np.int8)
+    state.actions = np.zeros((stack_size + 1, UNDO_SIZE), dtype=np.int16)
+    state.action_idx = 0
+    state.zobrist = 0
+    state.castling = 0
+    state.ep = -1
+    state.halfmove = 0
+    state.scratch = np.zeros(MAX_PIECE_MOVES, dtype=np.int16)
+    # In-check tests made while count_checks is set by a search with statistics
+    state.check_tests = 0
+    state.count_checks = False
+    state.mg = np.zeros(2, dtype=np.int32)
+    state.eg = np.zeros(2, dtype=np.int32)
+    state.phase = 0
+    state.first_color = 0
+    return state
+
+
+@njit(cache=True)
+def new_state(stack_size):
+    """BitboardState in the start position, holding stack_size plies of moves"""
+    state = alloc_state(stack_size)
+    init_position(state)
+    return state
+
+
+@njit(cache=True)
+def copy_state(state):
+    """Independent BitboardState with the same position, move history and stack
+    size"""
+    dst = alloc_state(state.actions.shape[0] - 1)
+    dst.bb[:] = state.bb
+    dst.occ[:] = state.occ
+    dst.board[:] = state.board
+    dst.actions[:, :] = state.actions
+    dst.action_idx = state.action_idx
+    dst.zobrist = state.zobrist
+    dst.castling = state.castling
+    dst.ep = state.ep
+    dst.halfmove = state.halfmove
+    dst.mg[:] = state.mg
+    dst.eg[:] = state.eg
+    dst.phase = state.phase
+    dst.first_color = state.first_color
+    return dst
+
+
+class BitboardState(PositionProxy):
+    """State backend with (color, type) bitboards, same API as state.State.
+    Make, unmake and move generation use the bitboards and the board of codes
+    only, the piece indices of the API are derived when asked for"""
+
+    def __new__(cls, stack_size=STACK_SIZE):
+        return new_state(stack_size)
+
+    mat = property(get_mat)
+    pieces = property(get_pieces)
+    types = property(get_types)
+
+
+structref.define_boxing(BitboardType, BitboardState)
+bind_methods(
+    BitboardType,
+    BitboardState,
+    dict(
+        POSITION_METHODS,
+        get_idx=get_idx,
+        get_piece=get_piece,
+        get_color=get_color,
+        get_type=get_type,
+        code=piece_code,
+        clear=clear_board,
+        set_piece=set_piece,
+        copy=copy_state,
+        compute_zobrist=position_zobrist,
+        action_move=action_move,
+        push_action=push_action,
+        push_move=push_move,
+        pop_action=unmake_move,
+        game_status=game_status,
+        material=material,
+        is_square_attacked=is_square_attacked,
+        is_pieced_checked=is_pieced_checked,
+        get_actions=get_actions,
+        gen_moves=gen_moves,
+        gen_captures=gen_captures,
+        has_legal_move=has_legal_move,
+        get_player_actions=get_player_actions,
+    ),
+)
+
+
+if __name__ == "__main__":
+    """Unit test"""
+    state = BitboardState()
+    for k in range(32):
+        print(k, "actions:", state.get_actions(k))
+    timeit(state.get_actions, (1,), 1000)
+
+    # Player actions
+    print("player actions", state.get_player_actions(0))
+    timeit(state.get_player_actions, (1,), 1000)
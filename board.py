@@ -1,9 +1,15 @@
+import collections
 import tkinter as tk
 from PIL import Image, ImageTk
 import itertools
-from state import State
 import math
 
+ATLAS_PATH = "pieces.png"
+# Size of a piece in the atlas, in pixels
+ATLAS_TILE = 170
+# Number of square sizes whose sprites are kept
+SPRITE_CACHE_SIZE = 4
+
 
 class Board(tk.Canvas):
     def __init__(self, root, size=64, on_update=None):
@@ -22,58 +28,112 @@ class Board(tk.Canvas):
         self.bind("<Button-1>", self.on_click)
 
         # Load pieces
-        self.load_pieces()
+        self.atlas = Image.open(ATLAS_PATH).convert("RGBA")
+        self.sprite_cache = collections.OrderedDict()
+        self.piece_img = self.load_pieces(self.size)
+
+        # Canvas items are created once, then moved and recolored in place
+        self.squares = [[self.draw_rect(i, j) for j in range(8)] for i in range(8)]
+        self.square_colors = [[None] * 8 for _ in range(8)]
+        self.piece_items = {}
+        # Square each piece item is drawn on, None when hidden, and its
+        # (color, type) sprite, which changes on promotion
+        self.piece_squares = {}
+        self.piece_sprites = {}
+        self.layout()
 
         # Init game command
         self.selected = -1
         self.actions = []
 
-    def load_pieces(self):
-        img = Image.open("pieces.png").convert("RGBA")
-        width = 170
-        self.piece_img = {}
+    def load_pieces(self, size):
+        """Piece sprites at a square size, kept in an LRU cache"""
+        if size in self.sprite_cache:
+            self.sprite_cache.move_to_end(size)
+            return self.sprite_cache[size]
+        width = ATLAS_TILE
+        sprites = {}
         for i, j in itertools.product(range(2), range(6)):
             area = (j * width, i * width, (j + 1) * width, (i + 1) * width)
-            cropped = img.crop(area)
-            cropped = cropped.resize((self.size, self.size), Image.ANTIALIAS)
-            self.piece_img[(i, j)] = ImageTk.PhotoImage(cropped)
+            cropped = self.atlas.crop(area)
+            cropped = cropped.resize((size, size), Image.LANCZOS)
+            sprites[(i, j)] = ImageTk.PhotoImage(cropped)
+        self.sprite_cache[size] = sprites
+        if len(self.sprite_cache) > SPRITE_CACHE_SIZE:
+            self.sprite_cache.popitem(last=False)
+        return sprites
 
-    def draw_rect(self, i, j, color):
-        self.create_rectangle(
+    def draw_rect(self, i, j):
+        return self.create_rectangle(
             j * self.size,
             i * self.size,
             (j + 1) * self.size,
             (i + 1) * self.size,
             outline="black",
-            fill=color,
             tags="square",
         )
 
+    def layout(self):
+        """Place every item for the current square size"""
+        size = self.size
+        self.piece_img = self.load_pieces(size)
+        for i, j in itertools.product(range(8), range(8)):
+            self.coords(self.squares[i][j], j * size, i * size, (j + 1) * size, (i + 1) * size)
+        for idx, item in self.piece_items.items():
+            self.itemconfig(item, image=self.piece_img[self.piece_sprites[idx]])
+            square = self.piece_squares[idx]
+            if square is not None:
+                self.coords(item, square[1] * size, square[0] * size)
+
+    def square_color(self, i, j):
+        if (i, j) in self.actions:
+            return self.color_action
+        if self.selected >= 0 and (i, j) == tuple(self.state.pieces[self.selected]):
+            return self.color_selected
+        return self.color_white if (i + j) % 2 else self.color_tile
+
+    def refresh(self):
+        """Recolor the squares and move the pieces that changed"""
+        for i, j in itertools.product(range(8), range(8)):
+            color = self.square_color(i, j)
+            if color != self.square_colors[i][j]:
+                self.itemconfig(self.squares[i][j], fill=color)
+                self.square_colors[i][j] = color
+        if self.state is None:
+            return
+        types = self.state.types.tolist()
+        for idx, (i, j) in enumerate(self.state.pieces.tolist()):
+            square = (i, j) if i >= 0 else None
+            sprite = (idx // 16, types[idx])
+            if idx not in self.piece_items:
+                item = self.create_image(0, 0, image=self.piece_img[sprite], anchor="nw")
+                self.piece_items[idx] = item
+                self.piece_squares[idx] = None
+                self.piece_sprites[idx] = sprite
+                self.itemconfig(item, state="hidden")
+            if sprite != self.piece_sprites[idx]:
+                self.itemconfig(self.piece_items[idx], image=self.piece_img[sprite])
+                self.piece_sprites[idx] = sprite
+            if square == self.piece_squares[idx]:
+                continue
+            item = self.piece_items[idx]
+            if square is None:
+                self.itemconfig(item, state="hidden")
+            else:
+                self.coords(item, j * self.size, i * self.size)
+                self.itemconfig(item, state="normal")
+            self.piece_squares[idx] = square
+
     def redraw(self, event=None):
-        """Redraw the board, possibly in response to window being resized"""
+        """Update the board, possibly in response to window being resized"""
         if event:
             xsize = int((event.width - 1) / 8)
             ysize = int((event.height - 1) / 8)
-            self.size = min(xsize, ysize)
-        self.delete("all")
-        # Draw the board
-        for i, j in itertools.product(range(8), range(8)):
-            color = self.color_white if (i + j) % 2 else self.color_tile
-            self.draw_rect(i, j, color)
-
-        # Draw selection
-        if self.selected >= 0:
-            i, j = self.state.pieces[self.selected]
-            self.draw_rect(i, j, self.color_selected)
-            for i, j in self.actions:
-                self.draw_rect(i, j, self.color_action)
-
-        # Draw the pieces
-        if self.state:
-            for idx, (i, j) in enumerate(self.state.pieces):
-                c, p, t = State.unpack(idx)
-                image = self.piece_img[(c, t)]
-                self.create_image(j * self.size, i * self.size, image=image, anchor="nw")
+            size = max(1, min(xsize, ysize))
+            if size != self.size:
+                self.size = size
+                self.layout()
+        self.refresh()
 
         # Trigger callback
         if self.on_update:
@@ -88,11 +148,13 @@ class Board(tk.Canvas):
             # Commit move
             self.state.push_action(self.selected, (i, j))
             self.selected = -1
+            self.actions = []
             # self.state.print()
         elif c >= 0:
             # Select piece
             self.selected = idx
-            self.actions = self.state.get_actions(idx)
+            self.actions = [(int(ip), int(jp)) for ip, jp in self.state.get_actions(idx)]
         else:
             self.selected = -1
+            self.actions = []
         self.redraw()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import os
+from numba import njit
+import numpy as np
+from state import MAX_MOVES, NO_MOVE, create_state
+from notation import legal_move, move_name, play_moves
+
+# One record per (position, move), sorted by key then by decreasing weight
+BOOK_DTYPE = np.dtype([("key", "<u8"), ("move", "<i2"), ("weight", "<u2")])
+MAX_WEIGHT = np.iinfo(np.uint16).max
+
+
+@njit(cache=True)
+def key_range(keys, key):
+    """[start, end) of the records of key in sorted keys, by binary searches
+    reading O(log n) keys. keys is the strided key field of the records, which
+    np.searchsorted would first copy whole"""
+    lo, hi = 0, keys.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[mid] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    start, hi = lo, keys.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[mid] <= key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return start, lo
+
+
+def book_records(games, max_plies=16, min_count=1):
+    """Sorted records of the moves played in games, move lists such as
+    "e2e4 e7e5", over their first max_plies plies"""
+    counts = collections.Counter()
+    for game in games:
+        state = create_state()
+        for text in game.split()[:max_plies]:
+            key = state.zobrist
+            try:
+                move = int(legal_move(state, text))
+            except ValueError:
+                break
+            state.push_move(move)
+            counts[(key, move)] += 1
+    records = np.array(
+        [(key, move, min(n, MAX_WEIGHT)) for (key, move), n in counts.items() if n >= min_count],
+        dtype=BOOK_DTYPE,
+    )
+    order = np.lexsort((-records["weight"].astype(np.int64), records["key"]))
+    return records[order]
+
+
+def build_book(games, path, max_plies=16, min_count=1):
+    """Write the book of games to path, return its number of records"""
+    records = book_records(games, max_plies, min_count)
+    records.tofile(path)
+    return len(records)
+
+
+class OpeningBook:
+    """Book file opened with numpy.memmap, so its records are only read
+    from disk when a binary search touches them"""
+
+    def __init__(self, path):
+        # numpy cannot map an empty file, a book of no games
+        if os.path.getsize(path) == 0:
+            self.records = np.zeros(0, dtype=BOOK_DTYPE)
+        else:
+            self.records = np.memmap(path, dtype=BOOK_DTYPE, mode="r")
+        self.keys = self.records["key"]
+
+    def __len__(self):
+        return len(self.records)
+
+    def probe(self, key):
+        """(packed move, weight) entries of a position key, heaviest first"""
+        start, end = key_range(self.keys, np.uint64(key))
+        return [(int(r["move"]), int(r["weight"])) for r in self.records[start:end]]
+
+    def pick_move(self, state, rng=None):
+        """Book move of state, NO_MOVE if none. The heaviest move unless a
+        numpy Generator is given to draw one by weight. Moves are checked to
+        be legal to rule out hash collisions"""
+        moves = np.zeros(MAX_MOVES, dtype=np.int16)
+        n = state.gen_moves(state.get_player_color(), moves)
+        legal = set(moves[:n].tolist())
+        entries = [(m, w) for m, w in self.probe(state.zobrist) if m in legal]
+        if not entries:
+            return NO_MOVE
+        if rng is None:
+            return entries[0][0]
+        weights = np.float64([w for _, w in entries])
+        return entries[rng.choice(len(entries), p=weights / weights.sum())][0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Opening book tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build a book from games, one move list per line")
+    build.add_argument("games")
+    build.add_argument("book")
+    build.add_argument("--plies", type=int, default=16)
+    build.add_argument("--min-count", type=int, default=1)
+    probe = commands.add_parser("probe", help="list the book moves after a move list")
+    probe.add_argument("book")
+    probe.add_argument("moves", nargs="?", default="")
+    args = parser.parse_args()
+    if args.command == "build":
+        with open(args.games) as f:
+            n = build_book(f, args.book, args.plies, args.min_count)
+        print("%d records written to %s" % (n, args.book))
+    else:
+        state = play_moves(create_state(), args.moves)
+        for move, weight in OpeningBook(args.book).probe(state.zobrist):
+            print(move_name(move), weight)
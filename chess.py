@@ -1,19 +1,70 @@
+import argparse
+import queue
+import threading
+import time
 import tkinter as tk
 from board import Board
-from state import State
-from ai import baseline_evaluator, min_max
+from state import WHITE, create_state
+from ai import AlphaBeta, alpha_beta, baseline_evaluator
+from tt import create_table
+from notation import move_name
+
+# Engine thinking time and depth limit
+THINK_TIME = 5
+THINK_DEPTH = 32
+# Delay between two polls of the engine thread, in ms
+POLL_MS = 100
+
+
+class SearchThread(threading.Thread):
+    """AlphaBeta on a copy of the state, reporting progress through a queue"""
+
+    def __init__(self, state, table, max_time=None, depth=THINK_DEPTH):
+        super().__init__(daemon=True)
+        self.state = state.copy()
+        # Key of the position searched
+        self.key = state.zobrist
+        self.depth = depth
+        self.stop_event = threading.Event()
+        self.progress = queue.Queue()
+        # Last completed iteration
+        self.info = None
+        self.start_time = time.time()
+        self.search = AlphaBeta(
+            self.state, max_time, table=table, stop=self.stop_event, on_progress=self.progress.put
+        )
+        self.result = None
+
+    def run(self):
+        self.start_time = time.time()
+        self.result = self.search.run(self.depth)
+
+    def stop(self):
+        """End the search, keeping the result of the deepest completed iteration"""
+        self.stop_event.set()
+
+
+def warm_up(backend):
+    """Compile the engine code before the first search"""
+    alpha_beta(create_state(backend).copy(), 2)
 
 
 class Chess:
-    def __init__(self):
+    def __init__(self, backend="array"):
         self.root = tk.Tk()
         # Create frame
         frame = tk.Frame(self.root)
         frame.pack(fill=tk.BOTH)
         # Create board
         self.board = Board(frame, on_update=self.on_update)
-        self.state = State()
+        self.state = create_state(backend)
         self.board.state = self.state
+        # Engine, shared by searches and pondering one at a time
+        self.table = create_table()
+        self.search = None
+        self.pondering = False
+        self.cancelled = False
+        threading.Thread(target=warm_up, args=(backend,), daemon=True).start()
         # Show frame
         self.board.pack(side=tk.LEFT, fill=tk.BOTH, padx=2, pady=2)
         self.create_menu(frame)
@@ -30,10 +81,23 @@ class Chess:
         # Eval label
         self.eval_lbl = tk.Label(menu_frame, fg="dark green")
         self.eval_lbl.pack(side=tk.TOP)
+        # Search progress label
+        self.search_lbl = tk.Label(menu_frame, fg="dark green", justify=tk.LEFT)
+        self.search_lbl.pack(side=tk.TOP)
         self.on_update()
-        # Min max btn
-        minmax_btn = tk.Button(menu_frame, width=16, text="MinMax", command=self.minmax)
-        minmax_btn.pack(side=tk.TOP)
+        # Think btn
+        think_btn = tk.Button(menu_frame, width=16, text="Think", command=self.think)
+        think_btn.pack(side=tk.TOP)
+        # Move now btn
+        move_now_btn = tk.Button(menu_frame, width=16, text="Move now", command=self.move_now)
+        move_now_btn.pack(side=tk.TOP)
+        # Cancel btn
+        cancel_btn = tk.Button(menu_frame, width=16, text="Cancel", command=self.cancel)
+        cancel_btn.pack(side=tk.TOP)
+        # Ponder checkbox
+        self.ponder_var = tk.BooleanVar(value=False)
+        ponder_chk = tk.Checkbutton(menu_frame, text="Ponder", variable=self.ponder_var)
+        ponder_chk.pack(side=tk.TOP)
         # Take back btn
         take_back_btn = tk.Button(menu_frame, width=16, text="Take back", command=self.take_back)
         take_back_btn.pack(side=tk.TOP)
@@ -41,21 +105,90 @@ class Chess:
         exit_btn = tk.Button(menu_frame, width=16, text="Exit", command=self.root.destroy)
         exit_btn.pack(side=tk.BOTTOM)
 
-    def minmax(self):
-        (idx, action), value = min_max(self.state)
-        print((idx, action), value)
-        self.state.push_action(idx, action)
-        self.board.redraw()
+    def start_search(self, pondering):
+        max_time = None if pondering else THINK_TIME
+        self.search = SearchThread(self.state, self.table, max_time)
+        self.pondering = pondering
+        self.cancelled = False
+        self.search.start()
+        self.root.after(POLL_MS, self.poll, self.search)
+
+    def abort(self):
+        """Stop and drop the running search, if any"""
+        if self.search is not None:
+            self.search.stop()
+            self.search.join()
+            self.search = None
+            self.search_lbl.config(text="")
+
+    def stop_pondering(self):
+        if self.pondering:
+            self.abort()
+
+    def think(self):
+        """Search the position in the background, then play the best move"""
+        self.stop_pondering()
+        if self.search is None:
+            self.start_search(pondering=False)
+
+    def move_now(self):
+        if self.search is not None and not self.pondering:
+            self.search.stop()
+
+    def cancel(self):
+        if self.search is not None and not self.pondering:
+            self.cancelled = True
+            self.search.stop()
+
+    def poll(self, search):
+        """Show the search progress, and play its move once done"""
+        if search is not self.search:
+            return
+        # Pondering ends as soon as the position changes
+        if self.pondering and search.key != self.state.zobrist:
+            self.abort()
+            return
+        while not search.progress.empty():
+            search.info = search.progress.get()
+        self.show_progress(search)
+        if search.is_alive():
+            self.root.after(POLL_MS, self.poll, search)
+            return
+        self.search = None
+        move, _ = search.result
+        if self.pondering or self.cancelled or move is None:
+            return
+        # The position may have changed while the engine was thinking
+        if search.key == self.state.zobrist:
+            self.state.push_move(move)
+            self.board.redraw()
+            if self.ponder_var.get():
+                self.start_search(pondering=True)
+
+    def show_progress(self, search):
+        lines = ["pondering"] if self.pondering else []
+        info = search.info
+        if info is not None:
+            lines.append("depth %d" % info["depth"])
+            lines.append("best " + move_name(info["move"]))
+            lines.append("value %d" % info["value"])
+        elapsed = max(time.time() - search.start_time, 1e-6)
+        lines.append("%.0f nodes/s" % (search.search.nodes / elapsed))
+        self.search_lbl.config(text="\n".join(lines))
 
     def take_back(self):
+        self.abort()
         self.state.pop_action()
         self.board.redraw()
 
     def on_update(self):
         # Redraw label
-        value = baseline_evaluator(self.state, State.WHITE)
+        value = baseline_evaluator(self.state, WHITE)
         self.eval_lbl.config(text="eval: " + str(value))
 
 
 if __name__ == "__main__":
-    chess = Chess()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    args = parser.parse_args()
+    chess = Chess(args.backend)
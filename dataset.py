@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+import numpy as np
+from state import IDX_TYPE, create_state
+from pgn import read_games, split_movetext, game_result, play_game, set_position
+
+# One 34 bytes record per position: the 64 squares as 4 bit codes, 0 for
+# empty and 1 + c * 6 + type otherwise, two squares per byte, then the side
+# to move and the game result from white's point of view. Castling rights and
+# the en passant square are not stored
+RECORD_DTYPE = np.dtype([("board", "u1", 32), ("color", "i1"), ("result", "i1")])
+
+
+def encode_boards(mats, types=None):
+    """(n, 8, 8) State.mat and (n, 32) State.types arrays -> (n, 32) packed
+    boards. types defaults to the types before promotion"""
+    idx = mats.reshape(len(mats), 64).astype(np.int64)
+    if types is None:
+        types = np.broadcast_to(IDX_TYPE, (len(mats), 32))
+    # Empty squares read piece 0 and are masked out
+    t = np.take_along_axis(np.asarray(types), np.maximum(idx, 0), axis=1)
+    codes = np.where(idx >= 0, 1 + idx // 16 * 6 + t, 0).astype(np.uint8)
+    return codes[:, 0::2] | codes[:, 1::2] << 4
+
+
+def decode_board(board):
+    """Packed board -> 8x8 array of c * 6 + type codes, -1 when empty"""
+    codes = np.empty(64, dtype=np.int8)
+    codes[0::2] = board & 15
+    codes[1::2] = board >> 4
+    return (codes - 1).reshape(8, 8)
+
+
+def load_record(state, record):
+    """Set up the position of a record on state"""
+    return set_position(state, decode_board(record["board"]), int(record["color"]))
+
+
+class DatasetWriter:
+    """Appends records to a file, buffered in chunks"""
+
+    def __init__(self, path, chunk=1 << 16):
+        self.file = open(path, "ab")
+        self.mats = np.empty((chunk, 8, 8), dtype=np.int8)
+        self.types = np.empty((chunk, 32), dtype=np.int8)
+        self.records = np.zeros(chunk, dtype=RECORD_DTYPE)
+        self.n = 0
+        self.written = 0
+
+    def add(self, state, result):
+        self.mats[self.n] = state.mat
+        self.types[self.n] = state.types
+        self.records[self.n]["color"] = state.get_player_color()
+        self.records[self.n]["result"] = result
+        self.n += 1
+        if self.n == len(self.records):
+            self.flush()
+
+    def flush(self):
+        records = self.records[: self.n]
+        records["board"] = encode_boards(self.mats[: self.n], self.types[: self.n])
+        records.tofile(self.file)
+        self.file.flush()
+        self.written += self.n
+        self.n = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_dataset(path):
+    """Records of a dataset file, memory-mapped"""
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r")
+
+
+def import_games(lines, writer, backend="array", skip_plies=0):
+    """Write every position of finished games, after their first skip_plies
+    plies, return the number of games read"""
+    state = create_state(backend)
+    n_games = 0
+    for tags, movetext in read_games(lines):
+        n_games += 1
+        result = game_result(tags, split_movetext(movetext)[1])
+        if result is None:
+            continue
+        for ply, _ in enumerate(play_game(state, tags, movetext)):
+            if ply + 1 >= skip_plies:
+                writer.add(state, result)
+    return n_games
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Position datasets")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("import", help="append the positions of a PGN file")
+    ingest.add_argument("pgn")
+    ingest.add_argument("dataset")
+    ingest.add_argument("--skip-plies", type=int, default=0)
+    ingest.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    info = commands.add_parser("info", help="summarize a dataset")
+    info.add_argument("dataset")
+    args = parser.parse_args()
+    if args.command == "import":
+        start = time.time()
+        with open(args.pgn, errors="replace") as f, DatasetWriter(args.dataset) as writer:
+            n_games = import_games(f, writer, args.backend, args.skip_plies)
+        elapsed = time.time() - start
+        print(
+            "{} games, {} positions, {:.0f} games/s".format(
+                n_games, writer.written, n_games / max(elapsed, 1e-6)
+            )
+        )
+    else:
+        records = open_dataset(args.dataset)
+        results = np.bincount(records["result"] + 1, minlength=3)
+        print(
+            "%d positions, %d white wins, %d draws, %d black wins"
+            % (len(records), results[2], results[1], results[0])
+        )
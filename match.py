@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+
+import argparse
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from state import MAX_MOVES, MAX_PLY, ONGOING, CHECKMATE, STALEMATE, FIFTY_MOVES, create_state
+from tt import create_table
+from ai import TT_SIZE_MB, alpha_beta, baseline_evaluator, jit_search, min_max
+from notation import legal_move
+from startup import warm_pool
+from tablebase import Tablebase
+
+# Games longer than this are adjudicated on material
+MAX_GAME_PLIES = 200
+# Material lead, in pawns, adjudicated as a win at the ply cap
+ADJUDICATION_MARGIN = 3
+OPENING_PLIES = 6
+# Pseudo-count added to the wins, draws and losses of the SPRT, so that small
+# or one-sided samples keep a realistic score variance
+SPRT_PRIOR = 0.5
+DEFAULT_ENGINE = {
+    "engine": "jit",
+    "depth": 3,
+    "tapered": False,
+    "quiesce": False,
+    "tablebase": None,
+}
+
+# Per-process transposition tables, one per engine, and tablebases by directory
+_worker = {"tablebases": {}}
+
+
+def parse_engine(text):
+    """Engine configuration of a "key=value,..." string, e.g. "depth=4,quiesce=1".
+    engine is one of jit, alpha_beta or min_max, tablebase a directory of
+    endgame tables, not used by min_max"""
+    config = dict(DEFAULT_ENGINE)
+    for item in filter(None, text.split(",")):
+        key, _, value = item.partition("=")
+        if key not in ("engine", "depth", "tapered", "quiesce", "max_time", "tablebase"):
+            raise ValueError("Unknown engine option %s" % key)
+        if key == "engine":
+            if value not in ("jit", "alpha_beta", "min_max"):
+                raise ValueError("Unknown engine %s" % value)
+            config[key] = value
+        elif key == "tablebase":
+            config[key] = value
+        elif key == "max_time":
+            config[key] = float(value)
+        elif key == "depth":
+            config[key] = int(value)
+        else:
+            config[key] = value.lower() in ("1", "true", "yes")
+    return config
+
+
+def engine_tablebase(config):
+    """tablebase.Tablebase of an engine configuration, opened once per process"""
+    directory = config.get("tablebase")
+    if directory is None:
+        return None
+    tablebases = _worker["tablebases"]
+    if directory not in tablebases:
+        tablebases[directory] = Tablebase(directory)
+    return tablebases[directory]
+
+
+def choose_move(state, config, table):
+    """Packed move chosen by an engine, None if it has no move"""
+    depth = config["depth"]
+    if config["engine"] == "min_max":
+        move, _ = min_max(state, depth, quiesce=config["quiesce"])
+        return move
+    options = {
+        "tapered": config["tapered"],
+        "quiesce": config["quiesce"],
+        "tablebase": engine_tablebase(config),
+    }
+    if config["engine"] == "alpha_beta":
+        move, _ = alpha_beta(state, depth, config.get("max_time"), table=table, **options)
+    else:
+        move, _ = jit_search(state, depth, table, **options)
+    return move
+
+
+def random_openings(n, plies=OPENING_PLIES, seed=0, backend="array"):
+    """n openings of random legal moves, as packed move lists"""
+    rng = np.random.default_rng(seed)
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    openings = []
+    while len(openings) < n:
+        state = create_state(backend)
+        opening = []
+        for _ in range(plies):
+            count = state.gen_moves(state.get_player_color(), moves)
+            if count == 0:
+                break
+            move = int(moves[rng.integers(count)])
+            state.push_move(move)
+            opening.append(move)
+        if state.game_status(state.get_player_color()) == ONGOING:
+            openings.append(opening)
+    return openings
+
+
+def read_openings(path):
+    """Openings of a file of move lists, e.g. "e2e4 e7e5" on each line, checked
+    for legality from the start position"""
+    openings = []
+    with open(path) as f:
+        for line in filter(str.strip, f):
+            state = create_state()
+            opening = []
+            for text in line.split():
+                opening.append(int(legal_move(state, text)))
+                state.push_move(opening[-1])
+            openings.append(opening)
+    return openings
+
+
+def game_over(state):
+    """(result for white, reason) once the game has ended, else None"""
+    color = state.get_player_color()
+    status = state.game_status(color)
+    if status == ONGOING:
+        return None
+    if status == CHECKMATE:
+        return (1 if color == 1 else -1), "mate"
+    if status == STALEMATE:
+        return 0, "stalemate"
+    return 0, "fifty moves" if status == FIFTY_MOVES else "insufficient material"
+
+
+def adjudicate(state):
+    value = baseline_evaluator(state, 0)
+    if abs(value) >= ADJUDICATION_MARGIN:
+        return (1 if value > 0 else -1), "material"
+    return 0, "ply cap"
+
+
+def init_worker(table_mb):
+    _worker["tables"] = [create_table(table_mb), create_table(table_mb)]
+
+
+def play_game(opening, white, black, max_plies=MAX_GAME_PLIES, backend="array"):
+    """Play a game from an opening, engine configurations white and black.
+    Returns (result for white, plies, reason, seconds)"""
+    start = time.perf_counter()
+    # Room for the game and the deepest search line
+    state = create_state(backend, max_plies + MAX_PLY)
+    for move in opening:
+        state.push_move(move)
+    tables = _worker["tables"]
+    for table in tables:
+        table.clear()
+    over = game_over(state)
+    while over is None and state.action_idx < max_plies:
+        color = state.get_player_color()
+        move = choose_move(state, (white, black)[color], tables[color])
+        if move is None:
+            over = (1 if color == 1 else -1), "resign"
+            break
+        state.push_move(move)
+        over = game_over(state)
+    result, reason = over if over is not None else adjudicate(state)
+    return result, state.action_idx, reason, time.perf_counter() - start
+
+
+def expected_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def sprt_bounds(alpha=0.05, beta=0.05):
+    """(lower, upper) log-likelihood ratio bounds"""
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    """Log-likelihood ratio of elo1 against elo0, from a normal approximation
+    of the trinomial score distribution"""
+    if wins + draws + losses == 0:
+        return 0.0
+    wins, draws, losses = wins + SPRT_PRIOR, draws + SPRT_PRIOR, losses + SPRT_PRIOR
+    n = wins + draws + losses
+    score = (wins + draws / 2) / n
+    var = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / n
+    s0, s1 = expected_score(elo0), expected_score(elo1)
+    return n * (s1 - s0) * (2 * score - s0 - s1) / (2 * var)
+
+
+def elo_difference(wins, draws, losses):
+    """Elo estimate of the first engine, None at a 0 or 100% score"""
+    n = wins + draws + losses
+    score = (wins + draws / 2) / n if n else 0.5
+    if score <= 0 or score >= 1:
+        return None
+    return 400 * math.log10(score / (1 - score))
+
+
+class Match:
+    """Games of engine a against engine b, each opening played with both color
+    assignments, spread over a process pool"""
+
+    def __init__(self, a, b, workers=None, backend="array", max_plies=MAX_GAME_PLIES):
+        self.engines = (a, b)
+        self.workers = workers or os.cpu_count()
+        self.backend = backend
+        self.max_plies = max_plies
+        self.wins = self.draws = self.losses = 0
+        self.games = []
+        self.llr = 0.0
+        self.elapsed = 0.0
+
+    def warmup(self):
+        """Compile every engine, run by warm_pool after init_worker"""
+        state = create_state(self.backend)
+        for config in self.engines:
+            warm = dict(config, depth=min(config["depth"], 2))
+            choose_move(state, warm, _worker["tables"][0])
+
+    def record(self, k, result, plies, reason, seconds):
+        """Result of game k, for white, in engine a's tally"""
+        score = result if k % 2 == 0 else -result
+        if score > 0:
+            self.wins += 1
+        elif score < 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+        game = {"game": k, "result": result, "plies": plies, "reason": reason, "time": seconds}
+        self.games.append(game)
+
+    def run(self, openings, sprt=None, on_game=None, table_mb=TT_SIZE_MB):
+        """Play two games per opening, engine a white in even games. sprt is an
+        optional (elo0, elo1, alpha, beta) ending the match once significant.
+        on_game is an optional callback receiving each game's dict"""
+        context = warm_pool(init_worker, (table_mb,), self.warmup)
+        start = time.perf_counter()
+        a, b = self.engines
+        bounds = sprt_bounds(*sprt[2:]) if sprt is not None else None
+        with ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=init_worker, initargs=(table_mb,)
+        ) as executor:
+            futures = {}
+            for k in range(2 * len(openings)):
+                white, black = (a, b) if k % 2 == 0 else (b, a)
+                args = (openings[k // 2], white, black, self.max_plies, self.backend)
+                futures[executor.submit(play_game, *args)] = k
+            for future in as_completed(futures):
+                self.record(futures[future], *future.result())
+                if on_game is not None:
+                    on_game(self.games[-1])
+                if bounds is not None:
+                    self.llr = sprt_llr(self.wins, self.draws, self.losses, *sprt[:2])
+                    if not bounds[0] < self.llr < bounds[1]:
+                        for f in futures:
+                            f.cancel()
+                        break
+        self.elapsed = time.perf_counter() - start
+        return self.summary(bounds)
+
+    def summary(self, bounds=None):
+        n = len(self.games)
+        times = [g["time"] for g in self.games]
+        summary = {
+            "games": n,
+            "wins": self.wins,
+            "draws": self.draws,
+            "losses": self.losses,
+            "elo": elo_difference(self.wins, self.draws, self.losses),
+            "games_per_minute": 60 * n / self.elapsed if self.elapsed else 0.0,
+            "mean_game_time": float(np.mean(times)) if times else 0.0,
+            "max_game_time": max(times, default=0.0),
+            "mean_plies": float(np.mean([g["plies"] for g in self.games])) if n else 0.0,
+        }
+        if bounds is not None:
+            summary["llr"] = self.llr
+            summary["sprt"] = None
+            if self.llr >= bounds[1]:
+                summary["sprt"] = "H1"
+            elif self.llr <= bounds[0]:
+                summary["sprt"] = "H0"
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Engine against engine match")
+    parser.add_argument("--a", default="", help='engine a options, e.g. "depth=3,quiesce=1"')
+    parser.add_argument("--b", default="", help="engine b options")
+    parser.add_argument("--games", type=int, default=100, help="games, two per opening")
+    parser.add_argument("--openings", help="file of opening move lists, random if not set")
+    parser.add_argument("--opening-plies", type=int, default=OPENING_PLIES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-plies", type=int, default=MAX_GAME_PLIES)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    parser.add_argument("--sprt", type=float, nargs=2, metavar=("ELO0", "ELO1"))
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--verbose", action="store_true", help="print every game")
+    args = parser.parse_args()
+    a, b = parse_engine(args.a), parse_engine(args.b)
+    n_openings = (args.games + 1) // 2
+    if args.openings:
+        openings = read_openings(args.openings)[:n_openings]
+    else:
+        openings = random_openings(n_openings, args.opening_plies, args.seed, args.backend)
+    sprt = (*args.sprt, args.alpha, args.beta) if args.sprt else None
+    match = Match(a, b, args.workers, args.backend, args.max_plies)
+
+    def on_game(game):
+        if args.verbose:
+            print(
+                "game {game}: {result:+d} after {plies} plies ({reason}), {time:.2f}s".format(
+                    **game
+                )
+            )
+
+    summary = match.run(openings, sprt, on_game)
+    print("a: %s\nb: %s" % (a, b))
+    print(
+        "{games} games: +{wins} ={draws} -{losses}, {games_per_minute:.1f} games/min, "
+        "{mean_game_time:.2f}s per game".format(**summary)
+    )
+    if summary["elo"] is not None:
+        print("elo difference {:+.1f}".format(summary["elo"]))
+    if sprt is not None:
+        print("llr {:.2f}, sprt result {}".format(summary["llr"], summary["sprt"] or "none"))
@@ -0,0 +1,59 @@
+import numpy as np
+from state import MAX_MOVES, PROMOTION, pack_move, pack_move_flag, unpack_move, move_flag
+
+# Row 0 is the 8th rank, black's back rank
+FILES = "abcdefgh"
+# Promotion suffixes, by type
+PROMOTION_LETTERS = "kqbnrp"
+
+
+def square_name(i, j):
+    """(i, j) -> e.g. "e2" """
+    return FILES[j] + str(8 - i)
+
+
+def parse_square(name):
+    """e.g. "e2" -> (i, j)"""
+    if len(name) != 2 or name[0] not in FILES or name[1] not in "12345678":
+        raise ValueError("Invalid square %s" % name)
+    return 8 - int(name[1]), FILES.index(name[0])
+
+
+def move_name(move):
+    """Packed move -> e.g. "e2e4", or "e7e8q" for a promotion"""
+    i, j, ip, jp = unpack_move(move)
+    flag = move_flag(move)
+    suffix = PROMOTION_LETTERS[flag - PROMOTION] if flag > PROMOTION else ""
+    return square_name(i, j) + square_name(ip, jp) + suffix
+
+
+def parse_move(text):
+    """e.g. "e2e4" or "e7e8q" -> packed move. Castling and en passant flags
+    depend on the position, legal_move sets them"""
+    i, j = parse_square(text[:2])
+    ip, jp = parse_square(text[2:4])
+    if len(text) == 5 and text[4] in PROMOTION_LETTERS[1:5]:
+        return pack_move_flag(i, j, ip, jp, PROMOTION + PROMOTION_LETTERS.index(text[4]))
+    if len(text) != 4:
+        raise ValueError("Invalid move %s" % text)
+    return pack_move(i, j, ip, jp)
+
+
+def legal_move(state, text, moves=None):
+    """Legal packed move of the player up written as text, e.g. "e1g1" """
+    parse_move(text)
+    if moves is None:
+        moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    n = state.gen_moves(state.get_player_color(), moves)
+    for move in moves[:n].tolist():
+        if move_name(move) == text:
+            return move
+    raise ValueError("Illegal move %s" % text)
+
+
+def play_moves(state, moves):
+    """Push space separated moves, e.g. "e2e4 e7e5", checking they are legal"""
+    buf = np.zeros(MAX_MOVES, dtype=np.int16)
+    for text in moves.split():
+        state.push_move(legal_move(state, text, buf))
+    return state
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from state import MAX_MOVES, MAX_PLY, NO_MOVE, ONGOING, create_state
+from tt import create_table
+from ai import INF, MAX_DEPTH, TT_SIZE_MB, jit_search, negamax, order_moves
+from ai import terminal_value
+from notation import parse_move, play_moves
+from pgn import START_FEN, load_fen, to_fen
+from startup import pool_context, warm_pool
+from tablebase import Tablebase
+
+# Per-process search context, set up by init_worker
+_worker = {}
+
+
+def init_worker(best, backend, table_mb, tablebase_dir):
+    _worker["best"] = best
+    _worker["backend"] = backend
+    _worker["table"] = create_table(table_mb)
+    _worker["tablebase"] = None
+    if tablebase_dir is not None:
+        _worker["tablebase"] = Tablebase(tablebase_dir).arrays()
+    _worker["search_id"] = -1
+    _worker["moves"] = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int16)
+    _worker["keys"] = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int64)
+
+
+def compile_worker():
+    """Compile the kernels with the argument types of search_move"""
+    child_value(START_FEN, parse_move("e2e4"), 2, -INF - 1)
+    _worker["table"].clear()
+
+
+def worker_pid(_):
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def child_value(fen, move, depth, alpha):
+    """Value of root move `move` of the FEN position, and the node count"""
+    state = load_fen(create_state(_worker["backend"]), fen)
+    state.push_move(move)
+    nodes = np.zeros(1, dtype=np.int64)
+    args = (_worker["moves"], _worker["keys"], nodes, False, False, _worker["tablebase"], None)
+    value = -negamax(state, _worker["table"], depth - 1, 1, -INF - 1, -alpha, *args)
+    return int(value), int(nodes[0])
+
+
+def search_move(search_id, fen, k, move, depth):
+    """Search root move k, return (k, move, value, nodes). The value is exact
+    unless it is below the shared best value, which is then raised to it"""
+    # Entries of an earlier search may hold bounds from another root
+    if _worker["search_id"] != search_id:
+        _worker["table"].clear()
+        _worker["search_id"] = search_id
+    best = _worker["best"]
+    # Lowered by one so that a tie with the best move is detected exactly
+    value, nodes = child_value(fen, move, depth, best.value - 1)
+    with best.get_lock():
+        if value > best.value:
+            best.value = value
+    return k, move, value, nodes
+
+
+class ParallelSearch:
+    """Root moves split across a process pool, serial for a single worker.
+    Positions in the tables of the optional tablebase_dir are scored exactly"""
+
+    def __init__(self, workers=None, backend="array", table_mb=TT_SIZE_MB, tablebase_dir=None):
+        self.workers = workers or os.cpu_count()
+        self.backend = backend
+        self.nodes = 0
+        self.searches = 0
+        self.executor = None
+        self.table = None
+        self.tablebase = None
+        if self.workers == 1:
+            self.table = create_table(table_mb)
+            if tablebase_dir is not None:
+                self.tablebase = Tablebase(tablebase_dir)
+            # Compile the serial search
+            self.search(play_moves(create_state(backend), "e2e4"), 2)
+            self.table.clear()
+            return
+        # Best root value found so far, shared by the workers
+        self.best = pool_context().Value("q", -INF)
+        initargs = (self.best, backend, table_mb, tablebase_dir)
+        context = warm_pool(init_worker, initargs, compile_worker)
+        self.executor = ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=init_worker, initargs=initargs
+        )
+        # Start every worker and compile the root code of this process, so
+        # compilation is not paid by the first search
+        list(self.executor.map(worker_pid, range(self.workers)))
+        self.search(play_moves(create_state(backend), "e2e4"), 1)
+
+    def search(self, state, depth=MAX_DEPTH):
+        """Same result as ai.jit_search"""
+        if self.executor is None:
+            return jit_search(state, depth, self.table, tablebase=self.tablebase)
+        color = state.get_player_color()
+        status = state.game_status(color)
+        if status != ONGOING:
+            return None, terminal_value(status, 0)
+        moves = np.zeros(MAX_MOVES, dtype=np.int16)
+        keys = np.zeros(MAX_MOVES, dtype=np.int64)
+        n = state.gen_moves(color, moves)
+        order_moves(state, moves, keys, n, NO_MOVE)
+        # The root position itself, so FEN and batch roots search the same
+        fen = to_fen(state)
+        self.searches += 1
+        self.best.value = -INF
+        futures = [
+            self.executor.submit(search_move, self.searches, fen, k, int(moves[k]), depth)
+            for k in (np.sort(keys[:n]) % MAX_MOVES).tolist()
+        ]
+        results = [f.result() for f in futures]
+        self.nodes = sum(r[3] for r in results)
+        # Ties go to the first move in generation order, like jit_search
+        k, move, value, _ = max(results, key=lambda r: (r[2], -r[0]))
+        return move, value
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def parallel_search(state, depth=MAX_DEPTH, workers=None, backend="array", tablebase_dir=None):
+    with ParallelSearch(workers, backend, tablebase_dir=tablebase_dir) as search:
+        return search.search(state, depth)
+
+
+# Benchmark positions: (name, moves from the start position)
+BENCH_POSITIONS = [
+    ("start", ""),
+    ("center", "e2e4 d7d5 e4d5 d8d5 b1c3"),
+    ("italian", "e2e4 e7e5 g1f3 b8c6 f1c4 g8f6 d2d3 f8c5 c1g5"),
+]
+
+
+def speedup_curve(depth=5, worker_counts=(1, 2, 4), backend="array"):
+    """Time searches over BENCH_POSITIONS for each pool size, pool start up
+    excluded. Speedups are relative to the first worker count"""
+    curve = []
+    for workers in worker_counts:
+        with ParallelSearch(workers, backend) as search:
+            elapsed = 0
+            for _, moves in BENCH_POSITIONS:
+                state = play_moves(create_state(backend), moves)
+                start = time.time()
+                search.search(state, depth)
+                elapsed += time.time() - start
+        curve.append({"workers": workers, "time": elapsed})
+    for point in curve:
+        point["speedup"] = curve[0]["time"] / point["time"]
+    return curve
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel root search speedup curve")
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--workers", type=int, nargs="*", default=None)
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    parser.add_argument("--output", help="write the curve as JSON")
+    args = parser.parse_args()
+    counts = args.workers
+    if not counts:
+        counts = [1] + [w for w in (2, 4, 8, 16, 32) if w <= os.cpu_count()]
+    curve = speedup_curve(args.depth, counts, args.backend)
+    print("{:>8}{:>10}{:>10}".format("workers", "time", "speedup"))
+    for point in curve:
+        print("{:>8}{:>10.3f}{:>10.2f}".format(point["workers"], point["time"], point["speedup"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(curve, f, indent=2)
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from numba import njit
+import numpy as np
+from state import MAX_MOVES, MAX_PLY, create_state
+from pgn import START_FEN, load_fen
+
+# (name, FEN, node counts from depth 1), the standard perft positions
+PERFT_POSITIONS = [
+    ("start", START_FEN, [20, 400, 8902, 197281, 4865609]),
+    (
+        "kiwipete",
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        [48, 2039, 97862, 4085603],
+    ),
+    ("endgame", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238, 674624]),
+    (
+        "promotions",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [6, 264, 9467, 422333],
+    ),
+    (
+        "castling",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        [44, 1486, 62379, 2103487],
+    ),
+    (
+        "middlegame",
+        "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        [46, 2079, 89890, 3894594],
+    ),
+]
+GENERATORS = ["moves", "reference"]
+
+
+@njit(cache=True)
+def perft_moves(state, depth, ply, moves):
+    """Leaf count below state, through gen_moves buffers"""
+    if depth == 0:
+        return 1
+    n = state.gen_moves(state.get_player_color(), moves[ply])
+    if depth == 1:
+        return n
+    nodes = 0
+    for k in range(n):
+        state.push_move(moves[ply, k])
+        nodes += perft_moves(state, depth - 1, ply + 1, moves)
+        state.pop_action()
+    return nodes
+
+
+@njit(cache=True)
+def perft_reference(state, depth, ply, moves):
+    """Leaf count below state, through the make/unmake reference generator"""
+    if depth == 0:
+        return 1
+    n = state.gen_moves_reference(state.get_player_color(), moves[ply])
+    if depth == 1:
+        return n
+    nodes = 0
+    for k in range(n):
+        state.push_move(moves[ply, k])
+        nodes += perft_reference(state, depth - 1, ply + 1, moves)
+        state.pop_action()
+    return nodes
+
+
+def perft(state, depth, generator="moves"):
+    moves = np.zeros((MAX_PLY, MAX_MOVES), dtype=np.int16)
+    if generator == "moves":
+        return perft_moves(state, depth, 0, moves)
+    if generator == "reference":
+        return perft_reference(state, depth, 0, moves)
+    raise ValueError("Unknown generator %s" % generator)
+
+
+def git_version():
+    try:
+        cmd = ["git", "describe", "--always", "--dirty"]
+        return subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(depth=4, backend="array", generator="moves", names=None):
+    """Run perft over PERFT_POSITIONS up to depth, return a JSON-able report"""
+    # The first call compiles every kernel involved
+    start = time.time()
+    perft(create_state(backend), 1, generator)
+    compile_time = time.time() - start
+
+    results = []
+    for name, fen, expected in PERFT_POSITIONS:
+        if names and name not in names:
+            continue
+        state = load_fen(create_state(backend), fen)
+        for d in range(1, min(depth, len(expected)) + 1):
+            start = time.time()
+            nodes = int(perft(state, d, generator))
+            elapsed = time.time() - start
+            results.append(
+                {
+                    "position": name,
+                    "depth": d,
+                    "nodes": nodes,
+                    "expected": expected[d - 1],
+                    "ok": nodes == expected[d - 1],
+                    "time": elapsed,
+                    "nps": nodes / elapsed if elapsed > 0 else None,
+                }
+            )
+    total_nodes = sum(r["nodes"] for r in results)
+    total_time = sum(r["time"] for r in results)
+    return {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "backend": backend,
+        "generator": generator,
+        "compile_time": compile_time,
+        "nodes": total_nodes,
+        "time": total_time,
+        "nps": total_nodes / total_time if total_time > 0 else None,
+        "ok": all(r["ok"] for r in results),
+        "results": results,
+    }
+
+
+def print_report(report):
+    header = "{:<10}{:>6}{:>12}{:>12}{:>6}{:>10}{:>14}"
+    row = "{:<10}{:>6}{:>12}{:>12}{:>6}{:>10.3f}{:>14}"
+    print(header.format("position", "depth", "nodes", "expected", "ok", "time", "nps"))
+    for r in report["results"]:
+        ok = "yes" if r["ok"] else "NO"
+        nps = "%.0f" % r["nps"] if r["nps"] else "-"
+        print(row.format(r["position"], r["depth"], r["nodes"], r["expected"], ok, r["time"], nps))
+    print("compile time {:.3f}s".format(report["compile_time"]))
+    nps = report["nps"] or 0
+    print("{} nodes in {:.3f}s, {:.0f} nps".format(report["nodes"], report["time"], nps))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move generator perft suite")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    parser.add_argument("--generator", choices=GENERATORS, default="moves")
+    parser.add_argument("--positions", nargs="*", help="subset of position names")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+    if args.generator == "reference" and args.backend != "array":
+        parser.error("the reference generator needs the array backend")
+    report = run_suite(args.depth, args.backend, args.generator, args.positions)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0 if report["ok"] else 1)
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+
+import argparse
+import re
+from numba import njit
+import numpy as np
+from state import PIECE_TYPE, MAX_MOVES, NO_MOVE, KING, PAWN, PROMOTION, create_state
+from state import unpack_move, move_flag
+from notation import FILES, move_name, parse_square, square_name
+
+# Piece letters by type, pawns have none in SAN
+PIECE_LETTERS = "KQBNRP"
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+RESULTS = {"1-0": 1, "0-1": -1, "1/2-1/2": 0}
+AMBIGUOUS = -2
+# Castling rights letters, by bit
+CASTLING_LETTERS = "KQkq"
+# Piece indices p of each type, in the order they are handed out
+TYPE_SLOTS = [[p for p in range(16) if PIECE_TYPE[p] == t] for t in range(6)]
+SAN_RE = re.compile(r"^([KQBNR])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([QBNR]))?$")
+CASTLING_SAN = {"O-O": 6, "O-O-O": 2, "0-0": 6, "0-0-0": 2}
+# Comments, variations, numeric annotations and move numbers
+NOISE_RE = re.compile(r"\{[^}]*\}|\$\d+|\d+\.+")
+
+
+def set_position(state, codes, color, castling=0, ep=-1, halfmove=0):
+    """Clear state and put the pieces of an 8x8 array of c * 6 + type codes,
+    -1 for empty squares, with color to move. Pieces beyond the slots of
+    their type go to free pawn slots, as promoted pawns"""
+    state.clear()
+    used = [[0] * 6 for _ in range(2)]
+    promoted = []
+    for i in range(8):
+        for j in range(8):
+            code = codes[i][j]
+            if code < 0:
+                continue
+            c, t = divmod(int(code), 6)
+            if used[c][t] == len(TYPE_SLOTS[t]):
+                promoted.append((c, t, i, j))
+                continue
+            state.set_piece(c, TYPE_SLOTS[t][used[c][t]], i, j, t)
+            used[c][t] += 1
+    for c, t, i, j in promoted:
+        if t == KING or used[c][PAWN] == len(TYPE_SLOTS[PAWN]):
+            raise ValueError("Too many %s pieces" % PIECE_LETTERS[t])
+        state.set_piece(c, TYPE_SLOTS[PAWN][used[c][PAWN]], i, j, t)
+        used[c][PAWN] += 1
+    state.set_player_color(color)
+    state.set_rights(castling, ep, halfmove)
+    return state
+
+
+def load_fen(state, fen):
+    """Set up the position of a FEN string. The move number is not part of
+    the state, so that field is ignored"""
+    fields = fen.split()
+    rows = fields[0].split("/")
+    if len(fields) < 2 or len(rows) != 8 or fields[1] not in ("w", "b"):
+        raise ValueError("Invalid FEN %s" % fen)
+    codes = []
+    for row in rows:
+        codes.append([])
+        for char in row:
+            if char.isdigit():
+                codes[-1] += [-1] * int(char)
+            elif char.upper() in PIECE_LETTERS:
+                c = 0 if char.isupper() else 1
+                codes[-1].append(c * 6 + PIECE_LETTERS.index(char.upper()))
+            else:
+                raise ValueError("Invalid FEN %s" % fen)
+        if len(codes[-1]) != 8:
+            raise ValueError("Invalid FEN %s" % fen)
+    castling, ep, halfmove = 0, -1, 0
+    if len(fields) > 2 and fields[2] != "-":
+        if any(char not in CASTLING_LETTERS for char in fields[2]):
+            raise ValueError("Invalid FEN %s" % fen)
+        castling = sum(1 << CASTLING_LETTERS.index(char) for char in set(fields[2]))
+    if len(fields) > 3 and fields[3] != "-":
+        i, j = parse_square(fields[3])
+        ep = i * 8 + j
+    if len(fields) > 4:
+        if not fields[4].isdigit():
+            raise ValueError("Invalid FEN %s" % fen)
+        halfmove = int(fields[4])
+    return set_position(state, codes, 0 if fields[1] == "w" else 1, castling, ep, halfmove)
+
+
+def to_fen(state):
+    """FEN of a state, the move number counting the plies of its history"""
+    rows = []
+    for row in state.mat.tolist():
+        text, empty = "", 0
+        for idx in row:
+            if idx < 0:
+                empty += 1
+                continue
+            letter = PIECE_LETTERS[state.types[idx]]
+            text += (str(empty) if empty else "") + (letter if idx < 16 else letter.lower())
+            empty = 0
+        rows.append(text + (str(empty) if empty else ""))
+    color = "wb"[state.get_player_color()]
+    castling = "".join(CASTLING_LETTERS[k] for k in range(4) if state.castling >> k & 1)
+    ep = "-" if state.ep < 0 else square_name(state.ep // 8, state.ep % 8)
+    fullmove = state.action_idx // 2 + 1
+    fields = ("/".join(rows), color, castling or "-", ep, state.halfmove, fullmove)
+    return "%s %s %s %s %d %d" % fields
+
+
+@njit(cache=True)
+def match_move(state, t, from_i, from_j, ip, jp, promotion, moves):
+    """Legal move of a piece of type t to (ip, jp), from row from_i and column
+    from_j unless -1, promoting to type promotion unless -1. Returns NO_MOVE
+    if there is none, AMBIGUOUS if several"""
+    n = state.gen_moves(state.get_player_color(), moves)
+    found = NO_MOVE
+    for k in range(n):
+        i, j, mi, mj = unpack_move(moves[k])
+        if mi != ip or mj != jp or state.get_type(i, j) != t:
+            continue
+        flag = move_flag(moves[k])
+        if (flag > PROMOTION or promotion > -1) and flag != PROMOTION + promotion:
+            continue
+        if (from_i >= 0 and i != from_i) or (from_j >= 0 and j != from_j):
+            continue
+        if found != NO_MOVE:
+            return AMBIGUOUS
+        found = moves[k]
+    return found
+
+
+def parse_san(state, san, moves=None):
+    """Packed legal move of a SAN string such as "Nbd2", "exd5+", "O-O" or
+    "e8=Q" in state"""
+    san = san.rstrip("+#!?")
+    if moves is None:
+        moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    if san in CASTLING_SAN:
+        # The king moves two columns from its home square
+        i = 7 if state.get_player_color() == 0 else 0
+        move = match_move(state, KING, i, 4, i, CASTLING_SAN[san], -1, moves)
+        if move == NO_MOVE:
+            raise ValueError("Illegal move %s" % san)
+        return move
+    match = SAN_RE.match(san)
+    if match is None:
+        raise ValueError("Unsupported move %s" % san)
+    letter, from_file, from_rank, target, promotion = match.groups()
+    t = PAWN if letter is None else PIECE_LETTERS.index(letter)
+    ip, jp = parse_square(target)
+    from_i = -1 if from_rank is None else 8 - int(from_rank)
+    from_j = -1 if from_file is None else FILES.index(from_file)
+    promotion = -1 if promotion is None else PIECE_LETTERS.index(promotion)
+    move = match_move(state, t, from_i, from_j, ip, jp, promotion, moves)
+    if move == NO_MOVE:
+        raise ValueError("Illegal move %s" % san)
+    if move == AMBIGUOUS:
+        raise ValueError("Ambiguous move %s" % san)
+    return move
+
+
+def split_movetext(text):
+    """SAN moves and result of a game's movetext"""
+    text = NOISE_RE.sub(" ", text)
+    # Drop variations, which may be nested
+    while "(" in text:
+        text, n = re.subn(r"\([^()]*\)", " ", text)
+        if n == 0:
+            break
+    tokens = text.split()
+    result = None
+    if tokens and (tokens[-1] in RESULTS or tokens[-1] == "*"):
+        result = tokens.pop()
+    return tokens, result
+
+
+def read_games(lines):
+    """Generate the (tags, movetext) of the games of a PGN file or any
+    iterable of lines, one game at a time"""
+    tags, movetext = {}, []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("["):
+            if movetext:
+                yield tags, " ".join(movetext)
+                tags, movetext = {}, []
+            match = re.match(r'\[(\w+)\s+"(.*)"\]', line)
+            if match:
+                tags[match.group(1)] = match.group(2)
+        elif line and not line.startswith("%"):
+            # Rest of line comments
+            movetext.append(line.split(";")[0])
+    if movetext or tags:
+        yield tags, " ".join(movetext)
+
+
+def game_result(tags, result):
+    """1, 0 or -1 from white's point of view, None if unfinished"""
+    return RESULTS.get(tags.get("Result", result), RESULTS.get(result))
+
+
+def play_game(state, tags, movetext):
+    """Set up the game's start position, then generate the packed moves of its
+    SAN moves as they are pushed. Stops at the first move that can't be played,
+    or once the undo stack of state is full"""
+    load_fen(state, tags.get("FEN", START_FEN))
+    sans, _ = split_movetext(movetext)
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    for san in sans:
+        if state.is_stack_full():
+            return
+        try:
+            move = parse_san(state, san, moves)
+        except ValueError:
+            return
+        state.push_move(move)
+        yield move
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the games of a PGN file")
+    parser.add_argument("pgn")
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    parser.add_argument("--moves", action="store_true", help="print the moves of each game")
+    args = parser.parse_args()
+    state = create_state(args.backend)
+    n_games = n_moves = 0
+    with open(args.pgn, errors="replace") as f:
+        for tags, movetext in read_games(f):
+            moves = [move_name(move) for move in play_game(state, tags, movetext)]
+            n_games += 1
+            n_moves += len(moves)
+            if args.moves:
+                print(" ".join(moves))
+    print("%d games, %d moves" % (n_games, n_moves))
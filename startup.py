@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+import time
+
+_start = time.perf_counter()
+import argparse
+import json
+import multiprocessing
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from state import MAX_MOVES, create_state
+from ai import jit_search
+from perft import perft
+
+# numba, the state module and the free kernels cached on disk
+IMPORT_TIME = time.perf_counter() - _start
+
+
+def pool_context():
+    """Fork context when available: workers started after warmup() inherit
+    the compiled kernels rather than loading them from the disk cache"""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def warm_pool(initializer=None, initargs=(), warmup=None):
+    """Multiprocessing context of a pool whose workers start compiled: calls
+    initializer(*initargs) then warmup() here, before any worker is forked.
+    Pass the same initializer to the pool for the workers' own set up"""
+    if initializer is not None:
+        initializer(*initargs)
+    if warmup is not None:
+        warmup()
+    return pool_context()
+
+
+def warmup(backend="array"):
+    """Compile the move generation and search kernels of a backend"""
+    state = create_state(backend)
+    state.gen_moves(state.get_player_color(), np.zeros(MAX_MOVES, dtype=np.int16))
+    perft(state, 2)
+    jit_search(state, 2)
+
+
+def timed(fun, *args):
+    start = time.perf_counter()
+    fun(*args)
+    return time.perf_counter() - start
+
+
+def first_and_steady(fun, args, repeat):
+    """First call time, then the median of repeat calls"""
+    first = timed(fun, *args)
+    return first, statistics.median(timed(fun, *args) for _ in range(repeat))
+
+
+def worker_task(backend):
+    return timed(jit_search, create_state(backend), 2)
+
+
+def worker_start(backend, context):
+    """Time from pool creation to the result of a first search in a worker"""
+    start = time.perf_counter()
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        executor.submit(worker_task, backend).result()
+    return time.perf_counter() - start
+
+
+def measure(backend="array", repeat=5, spawn=False):
+    """Import, first call and steady state timings, as a JSON-able report"""
+    first, steady = first_and_steady(create_state, (backend,), repeat)
+    results = [{"step": "create_state", "first": first, "steady": steady}]
+    state = create_state(backend)
+    buf = np.zeros(MAX_MOVES, dtype=np.int16)
+    steps = [
+        ("gen_moves", state.gen_moves, (0, buf)),
+        ("perft 3", perft, (state, 3)),
+        ("jit_search 3", jit_search, (state, 3)),
+    ]
+    for name, fun, args in steps:
+        first, steady = first_and_steady(fun, args, repeat)
+        results.append({"step": name, "first": first, "steady": steady})
+    report = {"backend": backend, "import": IMPORT_TIME, "results": results}
+    # The kernels are compiled by now, as after warmup()
+    report["fork_worker"] = worker_start(backend, pool_context())
+    if spawn:
+        report["spawn_worker"] = worker_start(backend, multiprocessing.get_context("spawn"))
+    return report
+
+
+def print_report(report):
+    print("import {:.3f}s".format(report["import"]))
+    print("{:<14}{:>10}{:>10}".format("step", "first", "steady"))
+    for r in report["results"]:
+        print("{:<14}{:>10.3f}{:>10.6f}".format(r["step"], r["first"], r["steady"]))
+    print("forked worker first search {:.3f}s".format(report["fork_worker"]))
+    if "spawn_worker" in report:
+        print("spawned worker first search {:.3f}s".format(report["spawn_worker"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kernel start up timings")
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--spawn", action="store_true", help="also time a spawned worker")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+    report = measure(args.backend, args.repeat, args.spawn)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
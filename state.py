@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 
 import math
-from utils import timeit
+from utils import bind_methods, timeit
 import numba as nb
-from numba import njit, jitclass, deferred_type
+from numba import njit
+from numba.experimental import structref
 import numpy as np
+from pst import MG_VALUE, EG_VALUE, MG_PST, EG_PST, PHASE_WEIGHT, MAX_PHASE
 
 
 # Colors
@@ -19,23 +21,85 @@ ROOK = 4
 PAWN = 5
 # Index to type map
 PIECE_TYPE = np.int8([4, 3, 2, 1, 0, 2, 3, 4, 5, 5, 5, 5, 5, 5, 5, 5])
+# Type of each of the 32 pieces before promotions
+IDX_TYPE = np.tile(PIECE_TYPE, 2)
 KING_IDX = 4
+# Game status of the player up
+ONGOING = 0
+CHECKMATE = 1
+STALEMATE = 2
+INSUFFICIENT_MATERIAL = 3
+FIFTY_MOVES = 4
+# Halfmove clock of a fifty-move rule draw
+FIFTY_MOVE_PLIES = 100
+# Piece order of has_legal_move, the most mobile pieces first and the king,
+# whose moves are checked by make/unmake, last
+LEGAL_MOVE_ORDER = np.int8([3, 1, 6, 0, 7, 2, 5, 8, 9, 10, 11, 12, 13, 14, 15, 4])
+# Packed moves are flag * 4096 + from square * 64 + to square, square i * 8 + j
+NO_MOVE = -1
+NORMAL = 0
+CASTLE = 1
+EN_PASSANT = 2
+# Promotion flags are PROMOTION + type, QUEEN to ROOK, so moves fit an int16
+PROMOTION = 3
+# Castling rights bits
+WHITE_KINGSIDE = 1
+WHITE_QUEENSIDE = 2
+BLACK_KINGSIDE = 4
+BLACK_QUEENSIDE = 8
+ALL_CASTLING = 15
+# Rights kept by a move from or to each square: moving the king or a rook, or
+# capturing a rook, loses them
+CASTLING_MASK = np.full(64, ALL_CASTLING, dtype=np.int8)
+CASTLING_MASK[[60, 63, 56, 4, 7, 0]] = [
+    ALL_CASTLING ^ (WHITE_KINGSIDE | WHITE_QUEENSIDE),
+    ALL_CASTLING ^ WHITE_KINGSIDE,
+    ALL_CASTLING ^ WHITE_QUEENSIDE,
+    ALL_CASTLING ^ (BLACK_KINGSIDE | BLACK_QUEENSIDE),
+    ALL_CASTLING ^ BLACK_KINGSIDE,
+    ALL_CASTLING ^ BLACK_QUEENSIDE,
+]
+# Undo records hold the move, then the captured idx + 1 (piece code + 1 in
+# bitboard.BitboardState) | castling rights << 6 | en passant file + 1 << 10,
+# then the halfmove clock, as before the move
+UNDO_SIZE = 3
+# Default undo stack size: plies of game and search a State can hold. The
+# actions array has one more slot, kept for the make/unmake legality probes
+STACK_SIZE = 512
+# Move buffer sizes: one piece, one position, plies of a search
+MAX_PIECE_MOVES = 32
+MAX_MOVES = 256
+MAX_PLY = 128
 # Moves
 DIAGONALS = np.int8([(1, 1), (-1, -1), (1, -1), (-1, 1)])
 LINEAR = np.int8([(0, 1), (0, -1), (1, 0), (-1, 0)])
 OMNIDIRECTIONAL = np.concatenate((DIAGONALS, LINEAR), axis=0)
 JUMPS = np.int8([(-2, -1), (-2, 1), (-1, -2), (-1, 2), (2, -1), (2, 1), (1, -2), (1, 2)])
+# Zobrist keys, by piece code c * 6 + type and square
+_rng = np.random.RandomState(20200406)
+ZOBRIST = _rng.randint(0, np.iinfo(np.uint64).max, (12, 8, 8), dtype=np.uint64)
+ZOBRIST_TURN = _rng.randint(0, np.iinfo(np.uint64).max, dtype=np.uint64)
+# Keys of the castling rights, none for no rights, and of the en passant file
+ZOBRIST_CASTLING = _rng.randint(0, np.iinfo(np.uint64).max, 16, dtype=np.uint64)
+ZOBRIST_CASTLING[0] = 0
+ZOBRIST_EP = _rng.randint(0, np.iinfo(np.uint64).max, 8, dtype=np.uint64)
+# Piece code to midgame / endgame value + piece-square score map, black rows mirrored
+_CODE_TYPE = np.tile(np.arange(6), 2)
+_CODE_ROWS = np.where(np.arange(12)[:, None] < 6, np.arange(8), 7 - np.arange(8))
+PST_MG = MG_VALUE[_CODE_TYPE, None, None] + MG_PST[_CODE_TYPE[:, None], _CODE_ROWS]
+PST_EG = EG_VALUE[_CODE_TYPE, None, None] + EG_PST[_CODE_TYPE[:, None], _CODE_ROWS]
+PHASE = PHASE_WEIGHT[_CODE_TYPE].astype(np.int32)
 
 
-@njit("int8(int8, int8)")
+@njit("int8(int8, int8)", cache=True)
 def pack(c, p):
     """(color, piece) -> idx"""
     return c * 16 + p
 
 
-@njit("UniTuple(int8, 3)(int8)")
+@njit("UniTuple(int8, 3)(int8)", cache=True)
 def unpack(idx):
-    """idx -> (color, piece, type)"""
+    """idx -> (color, piece, type before promotion)"""
     return (
         (math.floor(idx / 16), idx % 16, PIECE_TYPE[idx % 16])
         if idx >= 0 and idx < 32
@@ -43,245 +107,1015 @@ def unpack(idx):
     )
 
 
-# Not a njit to allow formatting
-def print_state(state):
-    line = (8 * 3 + 1) * "-"
-    print(line)
-    for i in range(8):
-        print("[" + ",".join("%2d" % p if p > -1 else "  " for p in state.mat[i, :]) + "]")
-    print(line)
+@njit("int16(int8, int8, int8, int8)", cache=True)
+def pack_move(i, j, ip, jp):
+    """(i, j) -> (ip, jp) squares -> move"""
+    return (i * 8 + j) * 64 + ip * 8 + jp
+
+
+@njit("int16(int8, int8, int8, int8, int8)", cache=True)
+def pack_move_flag(i, j, ip, jp, flag):
+    """pack_move of a castling, en passant or promotion move"""
+    return flag * 4096 + (i * 8 + j) * 64 + ip * 8 + jp
+
+
+@njit("UniTuple(int8, 4)(int16)", cache=True)
+def unpack_move(move):
+    """move -> (i, j, ip, jp)"""
+    src, dst = move % 4096 // 64, move % 64
+    return src // 8, src % 8, dst // 8, dst % 8
+
+
+@njit("int8(int16)", cache=True)
+def move_flag(move):
+    """NORMAL, CASTLE, EN_PASSANT or PROMOTION + type"""
+    return move // 4096
+
+
+@njit("boolean(int8[:, :], int8[:])", cache=True)
+def insufficient_material(pieces, types):
+    """Are only the kings left, with at most one knight or bishop"""
+    minors = 0
+    for idx in range(32):
+        if pieces[idx, 0] < 0:
+            continue
+        t = types[idx]
+        if t == KING:
+            continue
+        if (t != BISHOP and t != KNIGNT) or minors > 0:
+            return False
+        minors += 1
+    return True
+
+
+# State is a numba StructRef: its fields live in a struct and its methods are
+# free njit kernels taking the state first, bound by utils.bind_methods. Unlike
+# jitclass methods, the kernels and the functions calling them are cached on
+# disk. A cached function embeds the code of the kernels it calls, so delete
+# the __pycache__/*.nbi and *.nbc files after editing a kernel
+
+
+@structref.register
+class StateType(nb.types.StructRef):
+    """numba type of State"""
 
 
 spec = [
-    ("mat", nb.int8[:, :]),
-    ("pieces", nb.int8[:, :]),
-    ("actions", nb.int8[:, :]),
+    ("mat", nb.int8[:, ::1]),
+    ("pieces", nb.int8[:, ::1]),
+    ("types", nb.int8[::1]),
+    ("actions", nb.int16[:, ::1]),
     ("action_idx", nb.int16),
+    ("zobrist", nb.uint64),
+    ("castling", nb.int8),
+    ("ep", nb.int8),
+    ("halfmove", nb.int16),
+    ("pin_dirs", nb.int8[::1]),
+    ("check_mask", nb.boolean[:, ::1]),
+    ("n_checkers", nb.int8),
+    ("scratch", nb.int16[::1]),
+    ("check_tests", nb.int64),
+    ("count_checks", nb.boolean),
+    ("mg", nb.int32[::1]),
+    ("eg", nb.int32[::1]),
+    ("phase", nb.int32),
+    ("first_color", nb.int8),
 ]
+STATE_TYPE = StateType(spec)
+
+
+# Kernels shared by State and bitboard.BitboardState, which provide the
+# set_piece of init_position and the game_status of is_terminal
+
+
+@njit(cache=True)
+def in_bounds(state, i, j):
+    return i >= 0 and i < 8 and j >= 0 and j < 8
+
+
+@njit(cache=True)
+def init_position(state):
+    """Put the start position on an empty state"""
+    for c in range(2):
+        for j in range(8):
+            state.set_piece(c, j, 7 if c == 0 else 0, j, PIECE_TYPE[j])
+            state.set_piece(c, j + 8, 6 if c == 0 else 1, j, PAWN)
+    update_castling(state, ALL_CASTLING)
+
+
+@njit(cache=True)
+def set_player_color(state, color):
+    """Set the player up of a position without move history"""
+    if get_player_color(state) != color:
+        state.zobrist ^= ZOBRIST_TURN
+    state.first_color = color
+
+
+@njit(cache=True)
+def set_rights(state, castling, ep, halfmove):
+    """Set the castling rights, en passant square (-1 for none) and halfmove
+    clock of a position without move history"""
+    update_castling(state, castling)
+    update_ep(state, ep)
+    state.halfmove = halfmove
+
+
+@njit(cache=True)
+def update_castling(state, castling):
+    state.zobrist ^= ZOBRIST_CASTLING[state.castling] ^ ZOBRIST_CASTLING[castling]
+    state.castling = castling
+
+
+@njit(cache=True)
+def update_ep(state, ep):
+    if state.ep > -1:
+        state.zobrist ^= ZOBRIST_EP[state.ep % 8]
+    if ep > -1:
+        state.zobrist ^= ZOBRIST_EP[ep % 8]
+    state.ep = ep
+
+
+@njit(cache=True)
+def add_scores(state, code, i, j, sign):
+    """Add (sign 1) or remove (sign -1) the scores of piece code on (i, j)"""
+    c = code // 6
+    state.mg[c] += sign * PST_MG[code, i, j]
+    state.eg[c] += sign * PST_EG[code, i, j]
+    state.phase += sign * PHASE[code]
+
+
+@njit(cache=True)
+def tapered_score(state, color):
+    """Tapered material and piece-square score for color, same as
+    ai.batch_evaluator"""
+    phase = min(state.phase, MAX_PHASE)
+    mg = state.mg[0] - state.mg[1]
+    eg = state.eg[0] - state.eg[1]
+    score = (mg * phase + eg * (MAX_PHASE - phase)) // MAX_PHASE
+    return score if color == 0 else -score
+
+
+@njit(cache=True)
+def stack_full(state):
+    """Are the stack_size slots of the undo stack used, the last slot of
+    actions being kept for legality probes"""
+    return state.action_idx >= state.actions.shape[0] - 1
+
+
+@njit(cache=True)
+def get_player_color(state):
+    """Return next player up"""
+    return (state.first_color + state.action_idx) % 2
+
+
+@njit(cache=True)
+def is_terminal(state, color):
+    return state.game_status(color) != ONGOING
+
+
+# Fields of both backends read from Python, as properties of the proxies
+
+
+@njit(cache=True)
+def get_undo_stack(state):
+    return state.actions
+
+
+@njit(cache=True)
+def get_action_idx(state):
+    return state.action_idx
+
+
+@njit(cache=True)
+def get_zobrist(state):
+    return state.zobrist
+
+
+@njit(cache=True)
+def get_castling(state):
+    return state.castling
+
+
+@njit(cache=True)
+def get_ep(state):
+    return state.ep
+
+
+@njit(cache=True)
+def get_halfmove(state):
+    return state.halfmove
+
+
+@njit(cache=True)
+def get_phase(state):
+    return state.phase
+
+
+@njit(cache=True)
+def get_check_tests(state):
+    return state.check_tests
+
+
+@njit(cache=True)
+def get_count_checks(state):
+    return state.count_checks
+
+
+@njit(cache=True)
+def set_count_checks(state, count_checks):
+    state.count_checks = count_checks
+
+
+# Methods of both backends
+POSITION_METHODS = {
+    "in_bounds": in_bounds,
+    "init_board": init_position,
+    "set_player_color": set_player_color,
+    "set_rights": set_rights,
+    "set_castling": update_castling,
+    "set_ep": update_ep,
+    "add_eval": add_scores,
+    "evaluate": tapered_score,
+    "is_stack_full": stack_full,
+    "get_player_color": get_player_color,
+    "is_terminal": is_terminal,
+}
+
+
+class PositionProxy(structref.StructRefProxy):
+    """Fields of State and bitboard.BitboardState read from Python"""
+
+    actions = property(get_undo_stack)
+    action_idx = property(get_action_idx)
+    zobrist = property(get_zobrist)
+    castling = property(get_castling)
+    ep = property(get_ep)
+    halfmove = property(get_halfmove)
+    phase = property(get_phase)
+    check_tests = property(get_check_tests)
+    count_checks = property(get_count_checks, set_count_checks)
+
+
+# Array backend
+
+
+@njit(cache=True)
+def get_idx(state, i, j):
+    return state.mat[i, j] if (i >= 0 and i < 8 and j >= 0 and j < 8) else -1
+
+
+@njit(cache=True)
+def get_piece(state, i, j):
+    """(color, piece, type) on (i, j)"""
+    idx = get_idx(state, i, j)
+    c, p, _ = unpack(idx)
+    return c, p, state.types[idx] if idx > -1 else np.int8(-1)
+
+
+@njit(cache=True)
+def get_color(state, i, j):
+    c, _, _ = get_piece(state, i, j)
+    return c
+
+
+@njit(cache=True)
+def get_type(state, i, j):
+    """Type on (i, j), -1 if empty"""
+    idx = get_idx(state, i, j)
+    return state.types[idx] if idx > -1 else np.int8(-1)
+
+
+@njit(cache=True)
+def piece_code(state, idx):
+    """Piece code c * 6 + type of idx"""
+    return idx // 16 * 6 + state.types[idx]
+
+
+@njit(cache=True)
+def clear_position(state):
+    """Empty board and move history, white to move"""
+    state.mat[:, :] = -1
+    state.pieces[:, :] = -1
+    state.types[:] = IDX_TYPE
+    state.action_idx = 0
+    state.zobrist = 0
+    state.castling = 0
+    state.ep = -1
+    state.halfmove = 0
+    state.mg[:] = 0
+    state.eg[:] = 0
+    state.phase = 0
+    state.first_color = 0
+
+
+@njit(cache=True)
+def set_piece(state, c, p, i, j, t):
+    """Put piece p of color c on (i, j) with type t, PIECE_TYPE[p] unless it
+    stands for a promoted pawn"""
+    idx = pack(c, p)
+    state.types[idx] = t
+    state.place_piece(idx, i, j)
+
+
+@njit(cache=True)
+def copy_position(src, dst):
+    """Copy the position and move history of src to dst, of the same stack size"""
+    dst.mat[:, :] = src.mat
+    dst.pieces[:, :] = src.pieces
+    dst.types[:] = src.types
+    dst.actions[:, :] = src.actions
+    dst.action_idx = src.action_idx
+    dst.zobrist = src.zobrist
+    dst.castling = src.castling
+    dst.ep = src.ep
+    dst.halfmove = src.halfmove
+    dst.mg[:] = src.mg
+    dst.eg[:] = src.eg
+    dst.phase = src.phase
+    dst.first_color = src.first_color
+
+
+@njit(cache=True)
+def position_zobrist(state):
+    """Zobrist key computed from scratch"""
+    key = np.uint64(0)
+    for idx in range(32):
+        i, j = state.pieces[idx, :]
+        if i > -1:
+            key ^= ZOBRIST[piece_code(state, idx), i, j]
+    if get_player_color(state) == 1:
+        key ^= ZOBRIST_TURN
+    key ^= ZOBRIST_CASTLING[state.castling]
+    if state.ep > -1:
+        key ^= ZOBRIST_EP[state.ep % 8]
+    return key
+
+
+@njit(cache=True)
+def action_move(state, idx, ip, jp):
+    """Packed move of idx to (ip, jp): castling when the king moves two
+    columns, en passant when a pawn captures an empty square, and
+    promotion to a queen"""
+    i, j = state.pieces[idx, :]
+    t = state.types[idx]
+    flag = NORMAL
+    if t == KING and abs(jp - j) == 2:
+        flag = CASTLE
+    elif t == PAWN and jp != j and state.mat[ip, jp] == -1:
+        flag = EN_PASSANT
+    elif t == PAWN and (ip == 0 or ip == 7):
+        flag = PROMOTION + QUEEN
+    return pack_move_flag(i, j, ip, jp, flag)
+
+
+@njit(cache=True)
+def push_action(state, idx, action):
+    ip, jp = action
+    push_move(state, action_move(state, idx, ip, jp))
+
+
+@njit(cache=True)
+def push_move(state, move):
+    if stack_full(state):
+        raise IndexError("Undo stack full")
+    make_move(state, move)
 
-# State.class_type.instance_type
-@jitclass(spec)
-class State:
-    def __init__(self):
-        self.mat = np.int8([[-1 for j in range(8)] for i in range(8)])
-        self.pieces = np.int8([(-1, -1) for p in range(32)])
-        self.actions = np.zeros((10 ** 3, 4), dtype=np.int8)
-        self.action_idx = 0
-        self.init_board()
-
-    def get_idx(self, i, j):
-        return self.mat[i, j] if (i >= 0 and i < 8 and j >= 0 and j < 8) else -1
-
-    def get_piece(self, i, j):
-        idx = self.get_idx(i, j)
-        return unpack(idx)
-
-    def in_bounds(self, i, j):
-        return i >= 0 and i < 8 and j >= 0 and j < 8
-
-    def get_color(self, i, j):
-        c, _, _ = self.get_piece(i, j)
-        return c
-
-    def init_board(self):
-        for c in range(2):
-            for j in range(8):
-                self.set_piece(c, j, 7 if c == 0 else 0, j)
-                self.set_piece(c, j + 8, 6 if c == 0 else 1, j)
-
-    def set_piece(self, c, p, i, j):
-        idx = pack(c, p)
-        self.mat[i, j] = idx
-        self.pieces[idx, :] = (i, j)
-
-    def push_action(self, idx, action):
-        i, j = self.pieces[idx, :]
-        ip, jp = action
-        idxp = self.mat[ip, jp]
-        self.mat[i, j] = -1
-        self.mat[ip, jp] = idx
-        self.pieces[idx, :] = (ip, jp)
-        if idxp > -1:
-            self.pieces[idxp] = (-1, -1)
-        self.actions[self.action_idx, :] = np.int8((idx, ip - i, jp - j, idxp))
-        self.action_idx += 1
-
-    def pop_action(self):
-        if self.action_idx == 0:
-            print("Empty action stack")
-            return
-        self.action_idx -= 1
-        idx, di, dj, idxp = self.actions[self.action_idx, :]
-        i, j = self.pieces[idx, :]
-        self.mat[i, j] = idxp
-        if idxp > -1:
-            self.pieces[idxp, :] = (i, j)
-        i, j = (i - di, j - dj)
-        self.mat[i, j] = idx
-        self.pieces[idx, :] = (i, j)
-
-    def get_player_color(self):
-        """Return next player up"""
-        if self.action_idx == 0:
-            return 0
-        else:
-            idx = self.actions[self.action_idx, 0]
-            c, _, _ = unpack(idx)
-            return (c + 1) % 2
-
-    def is_pieced_checked(self, idx):
-        c, _, _ = unpack(idx)
-        i, j = self.pieces[idx, :]
+
+@njit(cache=True)
+def make_move(state, move):
+    """Play a packed move and push its undo record, without checking the
+    stack has room"""
+    i, j, ip, jp = unpack_move(move)
+    flag = move_flag(move)
+    idx = state.mat[i, j]
+    t = state.types[idx]
+    # En passant captures the pawn next to the moving one
+    idxp = state.mat[i if flag == EN_PASSANT else ip, jp]
+    ep_file = state.ep % 8 + 1 if state.ep > -1 else 0
+    record = state.actions[state.action_idx]
+    record[0] = move
+    record[1] = (idxp + 1) | np.int64(state.castling) << 6 | ep_file << 10
+    record[2] = state.halfmove
+    if idxp > -1:
+        state.remove_piece(idxp)
+    state.remove_piece(idx)
+    if flag > PROMOTION:
+        state.types[idx] = flag - PROMOTION
+    state.place_piece(idx, ip, jp)
+    if flag == CASTLE:
+        rook = state.mat[i, 7 if jp == 6 else 0]
+        state.remove_piece(rook)
+        state.place_piece(rook, i, 5 if jp == 6 else 3)
+    update_castling(state, state.castling & CASTLING_MASK[i * 8 + j] & CASTLING_MASK[ip * 8 + jp])
+    update_ep(state, (i + ip) // 2 * 8 + j if t == PAWN and abs(ip - i) == 2 else -1)
+    state.halfmove = 0 if t == PAWN or idxp > -1 else state.halfmove + 1
+    state.zobrist ^= ZOBRIST_TURN
+    state.action_idx += 1
+
+
+@njit(cache=True)
+def unmake_move(state):
+    """Pop the last undo record and restore the position before its move"""
+    if state.action_idx == 0:
+        print("Empty action stack")
+        return
+    state.action_idx -= 1
+    move, info, halfmove = state.actions[state.action_idx, :]
+    i, j, ip, jp = unpack_move(move)
+    flag = move_flag(move)
+    idx = state.mat[ip, jp]
+    c = idx // 16
+    state.remove_piece(idx)
+    if flag > PROMOTION:
+        state.types[idx] = PAWN
+    state.place_piece(idx, i, j)
+    if flag == CASTLE:
+        rook = state.mat[i, 5 if jp == 6 else 3]
+        state.remove_piece(rook)
+        state.place_piece(rook, i, 7 if jp == 6 else 0)
+    idxp = info % 64 - 1
+    if idxp > -1:
+        state.place_piece(idxp, i if flag == EN_PASSANT else ip, jp)
+    update_castling(state, info >> 6 & ALL_CASTLING)
+    # The en passant square is behind a pawn of the opponent of c
+    ep_file = info >> 10 & 15
+    update_ep(state, (2 if c == 0 else 5) * 8 + ep_file - 1 if ep_file > 0 else -1)
+    state.halfmove = halfmove
+    state.zobrist ^= ZOBRIST_TURN
+
+
+@njit(cache=True)
+def game_status(state, color):
+    """ONGOING, CHECKMATE, STALEMATE, INSUFFICIENT_MATERIAL or FIFTY_MOVES,
+    color to move"""
+    if insufficient_material(state.pieces, state.types):
+        return INSUFFICIENT_MATERIAL
+    if not state.has_legal_move(color):
+        return CHECKMATE if state.is_pieced_checked(pack(color, KING_IDX)) else STALEMATE
+    if state.halfmove >= FIFTY_MOVE_PLIES:
+        return FIFTY_MOVES
+    return ONGOING
+
+
+@njit(cache=True)
+def material(state, values, color):
+    """Sum of values[type] over the pieces of color, minus the opponent's"""
+    value = 0
+    for idx in range(32):
+        if state.pieces[idx, 0] < 0:
+            continue
+        t = state.types[idx]
+        value += values[t] if idx // 16 == color else -values[t]
+    return value
+
+
+@njit(cache=True)
+def place_piece(state, idx, i, j):
+    code = piece_code(state, idx)
+    state.mat[i, j] = idx
+    state.pieces[idx, 0] = i
+    state.pieces[idx, 1] = j
+    state.zobrist ^= ZOBRIST[code, i, j]
+    add_scores(state, code, i, j, 1)
+
+
+@njit(cache=True)
+def remove_piece(state, idx):
+    code = piece_code(state, idx)
+    i, j = state.pieces[idx, :]
+    state.mat[i, j] = -1
+    state.pieces[idx, 0] = -1
+    state.pieces[idx, 1] = -1
+    state.zobrist ^= ZOBRIST[code, i, j]
+    add_scores(state, code, i, j, -1)
+
+
+@njit(cache=True)
+def is_square_attacked(state, i, j, c):
+    """Is (i, j) attacked by the opponent of color c"""
+    if state.count_checks:
+        state.check_tests += 1
+    for l in range(OMNIDIRECTIONAL.shape[0]):
+        di, dj = OMNIDIRECTIONAL[l, :]
+        for k in range(1, 8):
+            ip, jp = i + di * k, j + dj * k
+            cp, _, tp = get_piece(state, ip, jp)
+            if not in_bounds(state, ip, jp) or cp == c:
+                break
+            checked = False
+            # King neighbor
+            checked |= tp == KING and k == 1
+            # Diagonal pawn
+            checked |= tp == PAWN and abs(dj * k) == 1 and di == (c * 2 - 1)
+            # Diagonal checks
+            checked |= (tp == BISHOP or tp == QUEEN) and abs(di) == abs(dj)
+            # Linear checked
+            checked |= (tp == ROOK or tp == QUEEN) and di * dj == 0
+            if checked:
+                return True
+            # Line of sight hit a piece, exit
+            if cp != -1:
+                break
+    # # Knight moves
+    for l in range(JUMPS.shape[0]):
+        di, dj = JUMPS[l, :]
+        ip, jp = i + di, j + dj
+        cp, _, tp = get_piece(state, ip, jp)
+        if not in_bounds(state, ip, jp) or cp == c:
+            continue
+        if tp == KNIGNT:
+            return True
+    return False
+
+
+@njit(cache=True)
+def is_pieced_checked(state, idx):
+    i, j = state.pieces[idx, :]
+    return is_square_attacked(state, i, j, idx // 16)
+
+
+@njit(cache=True)
+def update_pins(state, c):
+    """Find the pieces pinned to the king of color c, the number of checkers,
+    and when in check the squares that block or capture it"""
+    king_idx = pack(c, KING_IDX)
+    i, j = state.pieces[king_idx, :]
+    state.n_checkers = 0
+    for p in range(16):
+        state.pin_dirs[pack(c, p)] = -1
+    for l in range(OMNIDIRECTIONAL.shape[0]):
+        di, dj = OMNIDIRECTIONAL[l, :]
+        pinned = -1
+        for k in range(1, 8):
+            ip, jp = i + di * k, j + dj * k
+            if not in_bounds(state, ip, jp):
+                break
+            idxp = state.mat[ip, jp]
+            if idxp == -1:
+                continue
+            cp, tp = idxp // 16, state.types[idxp]
+            if cp == c:
+                # Second piece of ours shields the king
+                if pinned > -1:
+                    break
+                pinned = idxp
+                continue
+            slider = (tp == BISHOP or tp == QUEEN) and abs(di) == abs(dj)
+            slider |= (tp == ROOK or tp == QUEEN) and di * dj == 0
+            if pinned > -1:
+                if slider:
+                    state.pin_dirs[pinned] = l
+                break
+            pawn = tp == PAWN and k == 1 and abs(dj) == 1 and di == (c * 2 - 1)
+            if slider or pawn:
+                add_checker(state, i, j, di, dj, k)
+            break
+    for l in range(JUMPS.shape[0]):
+        di, dj = JUMPS[l, :]
+        ip, jp = i + di, j + dj
+        cp, _, tp = get_piece(state, ip, jp)
+        if in_bounds(state, ip, jp) and cp == 1 - c and tp == KNIGNT:
+            add_checker(state, i, j, di, dj, 1)
+
+
+@njit(cache=True)
+def add_checker(state, i, j, di, dj, k):
+    """Register a checker k steps away from the king at (i, j)"""
+    if state.n_checkers == 0:
+        state.check_mask[:, :] = False
+    state.n_checkers += 1
+    for s in range(1, k + 1):
+        state.check_mask[i + di * s, j + dj * s] = True
+
+
+@njit(cache=True)
+def get_actions(state, idx):
+    # list [(i, j)]
+    c, _, _ = unpack(idx)
+    update_pins(state, c)
+    n = write_actions(state, idx, False, False, state.scratch, 0, MAX_MOVES)
+    return actions_list(state, n)
+
+
+@njit(cache=True)
+def is_legal_action(state, idx, ip, jp, reference):
+    """Does moving idx to (ip, jp) keep the king safe, from update_pins unless
+    reference is set"""
+    c, t = idx // 16, state.types[idx]
+    king_idx = pack(c, KING_IDX)
+    if reference or t == KING:
+        # King moves are checked by make/unmake
+        i, j = state.pieces[idx, :]
+        return is_legal_move(state, king_idx, pack_move(i, j, ip, jp))
+    # Pinned pieces stay on the ray from the king to the pinner
+    pin_dir = state.pin_dirs[idx]
+    if pin_dir > -1:
+        ki, kj = state.pieces[king_idx, :]
+        di, dj = OMNIDIRECTIONAL[pin_dir, :]
+        if (ip - ki) * dj != (jp - kj) * di or (ip - ki) * di + (jp - kj) * dj <= 0:
+            return False
+    # Single check must be blocked or captured
+    if state.n_checkers == 1 and not state.check_mask[ip, jp]:
+        return False
+    return True
+
+
+@njit(cache=True)
+def is_legal_move(state, king_idx, move):
+    """Does move keep king_idx safe, by make/unmake"""
+    make_move(state, move)
+    checked = is_pieced_checked(state, king_idx)
+    unmake_move(state)
+    return not checked
+
+
+@njit(cache=True)
+def write_pawn_move(state, i, j, ip, jp, buf, n):
+    """Write a pawn move, as its four promotions on the last row"""
+    if ip == 0 or ip == 7:
+        for t in range(QUEEN, ROOK + 1):
+            buf[n] = pack_move_flag(i, j, ip, jp, PROMOTION + t)
+            n += 1
+    else:
+        buf[n] = pack_move(i, j, ip, jp)
+        n += 1
+    return n
+
+
+@njit(cache=True)
+def write_castles(state, c, reference, buf, n):
+    """Write the castling moves of color c: the king and rook are in place with
+    the right kept, the squares between them are empty, and the king is not in
+    check and doesn't cross an attacked square"""
+    i = 7 if c == 0 else 0
+    king_idx = pack(c, KING_IDX)
+    rights = state.castling >> 2 * c
+    if rights & 3 == 0 or state.pieces[king_idx, 0] != i or state.pieces[king_idx, 1] != 4:
+        return n
+    checked = is_pieced_checked(state, king_idx) if reference else state.n_checkers > 0
+    if checked:
+        return n
+    for side in range(2):
+        # Kingside, then queenside
+        rook_j, step = (7, 1) if side == 0 else (0, -1)
+        rook = state.mat[i, rook_j]
+        if rights & (1 << side) == 0 or rook < 0 or rook // 16 != c:
+            continue
+        if state.types[rook] != ROOK:
+            continue
+        empty = True
+        for jp in range(min(4, rook_j) + 1, max(4, rook_j)):
+            empty &= state.mat[i, jp] == -1
+        if not empty:
+            continue
+        # The king crosses one square and lands on the next
+        if is_square_attacked(state, i, 4 + step, c):
+            continue
+        if is_square_attacked(state, i, 4 + 2 * step, c):
+            continue
+        buf[n] = pack_move_flag(i, 4, i, 4 + 2 * step, CASTLE)
+        n += 1
+    return n
+
+
+@njit(cache=True)
+def write_actions(state, idx, reference, captures, buf, n, limit):
+    """Write the legal packed moves of idx to buf from index n, return the new
+    count. Uses update_pins unless reference is set, skips the quiet moves if
+    captures is set, returns early once the count reaches limit"""
+    c, t = idx // 16, state.types[idx]
+    i, j = state.pieces[idx, :]
+    # Captured pieces have no moves
+    if i < 0:
+        return n
+    # Only the king moves out of a double check
+    if not reference and t != KING and state.n_checkers > 1:
+        return n
+
+    # King
+    if t == 0:
+        for l in range(OMNIDIRECTIONAL.shape[0]):
+            di, dj = OMNIDIRECTIONAL[l, :]
+            ip, jp = i + di, j + dj
+            cp = get_color(state, ip, jp)
+            if not in_bounds(state, ip, jp) or cp == c:
+                continue
+            if (cp != -1 or not captures) and is_legal_action(state, idx, ip, jp, reference):
+                buf[n] = pack_move(i, j, ip, jp)
+                n += 1
+                if n >= limit:
+                    return n
+        if not captures:
+            n = write_castles(state, c, reference, buf, n)
+            if n >= limit:
+                return n
+    # Queen
+    if t == 1:
         for l in range(OMNIDIRECTIONAL.shape[0]):
             di, dj = OMNIDIRECTIONAL[l, :]
             for k in range(1, 8):
                 ip, jp = i + di * k, j + dj * k
-                cp, _, tp = self.get_piece(ip, jp)
-                if not self.in_bounds(ip, jp) or cp == c:
+                cp = get_color(state, ip, jp)
+                if not in_bounds(state, ip, jp) or cp == c:
+                    break
+                if (cp != -1 or not captures) and is_legal_action(state, idx, ip, jp, reference):
+                    buf[n] = pack_move(i, j, ip, jp)
+                    n += 1
+                    if n >= limit:
+                        return n
+                if cp != -1:
+                    break
+    # Bishop
+    if t == 2:
+        for l in range(DIAGONALS.shape[0]):
+            di, dj = DIAGONALS[l, :]
+            for k in range(1, 8):
+                ip, jp = i + di * k, j + dj * k
+                cp = get_color(state, ip, jp)
+                if not in_bounds(state, ip, jp) or cp == c:
                     break
-                checked = False
-                # King neighbor
-                checked |= tp == KING and k == 1
-                # Diagonal pawn
-                checked |= tp == PAWN and abs(dj * k) == 1 and di == (c * 2 - 1)
-                # Diagonal checks
-                checked |= (tp == BISHOP or tp == QUEEN) and abs(di) == abs(dj)
-                # Linear checked
-                checked |= (tp == ROOK or tp == QUEEN) and di * dj == 0
-                if checked:
-                    return True
-                # Line of sight hit a piece, exit
+                if (cp != -1 or not captures) and is_legal_action(state, idx, ip, jp, reference):
+                    buf[n] = pack_move(i, j, ip, jp)
+                    n += 1
+                    if n >= limit:
+                        return n
                 if cp != -1:
                     break
-        # # Knight moves
+    # Knight
+    if t == 3:
         for l in range(JUMPS.shape[0]):
             di, dj = JUMPS[l, :]
             ip, jp = i + di, j + dj
-            cp, _, tp = self.get_piece(ip, jp)
-            if not self.in_bounds(ip, jp) or cp == c:
+            cp = get_color(state, ip, jp)
+            if not in_bounds(state, ip, jp) or cp == c:
                 continue
-            if tp == KNIGNT:
-                return True
-        return False
-
-    def get_actions(self, idx):
-        # list [(i, j)]
-        c, p, t = unpack(idx)
-        i, j = self.pieces[idx, :]
-        pos = []  # [(np.int8(0), np.int8(0)) for _ in range(0)]
-
-        # Routine to append action if the king is safe
-        def append_if_not_checked(action):
-            action = np.int8(action)
-            c, _, _ = unpack(idx)
-            king_idx = pack(c, KING_IDX)
-            self.push_action(idx, action)
-            checked = self.is_pieced_checked(king_idx)
-            self.pop_action()
-            if not checked:
-                pos.append(action)
-
-        # King
-        if t == 0:
-            for l in range(OMNIDIRECTIONAL.shape[0]):
-                di, dj = OMNIDIRECTIONAL[l, :]
-                ip, jp = i + di, j + dj
-                cp = self.get_color(ip, jp)
-                if not self.in_bounds(ip, jp) or cp == c:
-                    continue
-                append_if_not_checked((ip, jp))
-        # Queen
-        if t == 1:
-            for l in range(OMNIDIRECTIONAL.shape[0]):
-                di, dj = OMNIDIRECTIONAL[l, :]
-                for k in range(1, 8):
-                    ip, jp = i + di * k, j + dj * k
-                    cp = self.get_color(ip, jp)
-                    if not self.in_bounds(ip, jp) or cp == c:
-                        break
-                    append_if_not_checked((ip, jp))
-                    if cp != -1:
-                        break
-        # Bishop
-        if t == 2:
-            for l in range(DIAGONALS.shape[0]):
-                di, dj = DIAGONALS[l, :]
-                for k in range(1, 8):
-                    ip, jp = i + di * k, j + dj * k
-                    cp = self.get_color(ip, jp)
-                    if not self.in_bounds(ip, jp) or cp == c:
-                        break
-                    append_if_not_checked((ip, jp))
-                    if cp != -1:
-                        break
-        # Knight
-        if t == 3:
-            for l in range(JUMPS.shape[0]):
-                di, dj = JUMPS[l, :]
-                ip, jp = i + di, j + dj
-                cp = self.get_color(ip, jp)
-                if not self.in_bounds(ip, jp) or cp == c:
-                    continue
-                append_if_not_checked((ip, jp))
-        # Rook
-        if t == 4:
-            for l in range(LINEAR.shape[0]):
-                di, dj = LINEAR[l, :]
-                for k in range(1, 8):
-                    ip, jp = i + di * k, j + dj * k
-                    cp = self.get_color(ip, jp)
-                    if not self.in_bounds(ip, jp) or cp == c:
-                        break
-                    append_if_not_checked((ip, jp))
-                    if cp != -1:
-                        break
-        # Pawn
-        if t == 5:
-            limit = 3 if (c == 0 and i == 6) or (c == 1 and i == 1) else 2
-            direction = c * 2 - 1
-            for di in range(1, limit):
-                ip = i + di * direction
-                cp = self.get_color(ip, j)
-                if not self.in_bounds(ip, j) or cp != -1:
+            if (cp != -1 or not captures) and is_legal_action(state, idx, ip, jp, reference):
+                buf[n] = pack_move(i, j, ip, jp)
+                n += 1
+                if n >= limit:
+                    return n
+    # Rook
+    if t == 4:
+        for l in range(LINEAR.shape[0]):
+            di, dj = LINEAR[l, :]
+            for k in range(1, 8):
+                ip, jp = i + di * k, j + dj * k
+                cp = get_color(state, ip, jp)
+                if not in_bounds(state, ip, jp) or cp == c:
                     break
-                append_if_not_checked((ip, j))
+                if (cp != -1 or not captures) and is_legal_action(state, idx, ip, jp, reference):
+                    buf[n] = pack_move(i, j, ip, jp)
+                    n += 1
+                    if n >= limit:
+                        return n
                 if cp != -1:
                     break
-            for di, dj in [(1, -1), (1, 1)]:
-                ip = i + di * direction
-                jp = j + dj
-                cp = self.get_color(ip, jp)
-                if cp == (c + 1) % 2:
-                    append_if_not_checked((ip, jp))
-        return pos
-
-    def is_terminal(self, color):
-        king_idx = pack(color, KING_IDX)
-        if not self.is_pieced_checked(king_idx):
-            return False
-        actions = self.get_actions(king_idx)
-        return len(actions) > 0
-
-    def get_player_actions(self, color):
-        player_actions = []
-        for p in range(16):
-            idx = pack(color, p)
-            actions = self.get_actions(idx)
-            if actions:
-                player_actions.append((idx, actions))
-        return player_actions
-
-    # def check_consistency(self):
-    #     for idx, p in enumerate(self.pieces):
-    #         if p != (-1, -1) and self.mat[p[0]][p[1]] != idx:
-    #             print("Pieces %d -> %s; Mat -> %d" % (idx, str(p), self.mat[p[0]][p[1]]))
-    #     indices = [(i, j) for i, j in product(range(8), range(8))]
-    #     for i, j in indices:
-    #         mat_idx = self.mat[i, j]
-    #         if mat_idx > -1 and self.pieces[mat_idx] != (i, j):
-    #             print(
-    #                 "Mat (%d, %d) -> %d; Pieces -> %s" % (i, j, mat_idx, str(self.pieces[mat_idx]))
-    #             )
+    # Pawn
+    if t == 5:
+        steps = 3 if (c == 0 and i == 6) or (c == 1 and i == 1) else 2
+        if captures:
+            steps = 1
+        direction = c * 2 - 1
+        for di in range(1, steps):
+            ip = i + di * direction
+            cp = get_color(state, ip, j)
+            if not in_bounds(state, ip, j) or cp != -1:
+                break
+            if is_legal_action(state, idx, ip, j, reference):
+                n = write_pawn_move(state, i, j, ip, j, buf, n)
+                if n >= limit:
+                    return n
+        for dj in (-1, 1):
+            ip = i + direction
+            jp = j + dj
+            cp = get_color(state, ip, jp)
+            if cp == (c + 1) % 2:
+                if is_legal_action(state, idx, ip, jp, reference):
+                    n = write_pawn_move(state, i, j, ip, jp, buf, n)
+                    if n >= limit:
+                        return n
+            elif ip == (2 if c == 0 else 5) and ip * 8 + jp == state.ep:
+                # The square is behind an opponent pawn, one row apart from any
+                # wrap around. En passant can uncover the king along the row,
+                # so it is always checked by make/unmake
+                move = pack_move_flag(i, j, ip, jp, EN_PASSANT)
+                if is_legal_move(state, pack(c, KING_IDX), move):
+                    buf[n] = move
+                    n += 1
+                    if n >= limit:
+                        return n
+    return n
+
+
+@njit(cache=True)
+def actions_list(state, n):
+    """Target squares of the first n scratch moves, as get_actions returns.
+    Promotions are listed once, as a queen promotion"""
+    pos = []  # [(np.int8(0), np.int8(0)) for _ in range(0)]
+    for k in range(n):
+        move = state.scratch[k]
+        if move_flag(move) > PROMOTION + QUEEN:
+            continue
+        dst = move % 64
+        pos.append(np.int8((dst // 8, dst % 8)))
+    return pos
+
+
+@njit(cache=True)
+def gen_moves(state, color, buf):
+    """Write all legal packed moves of color to buf, return the count"""
+    update_pins(state, color)
+    n = 0
+    for p in range(16):
+        n = write_actions(state, pack(color, p), False, False, buf, n, MAX_MOVES)
+    return n
+
+
+@njit(cache=True)
+def gen_moves_reference(state, color, buf):
+    """gen_moves checked by make/unmake, to cross-check it"""
+    n = 0
+    for p in range(16):
+        n = write_actions(state, pack(color, p), True, False, buf, n, MAX_MOVES)
+    return n
+
+
+@njit(cache=True)
+def gen_captures(state, color, buf):
+    """Write the legal captures of color to buf, return the count"""
+    update_pins(state, color)
+    n = 0
+    for p in range(16):
+        n = write_actions(state, pack(color, p), False, True, buf, n, MAX_MOVES)
+    return n
+
+
+@njit(cache=True)
+def has_legal_move(state, color):
+    """Does color have a legal move, stopping at the first one"""
+    update_pins(state, color)
+    for p in LEGAL_MOVE_ORDER:
+        if write_actions(state, pack(color, p), False, False, state.scratch, 0, 1) > 0:
+            return True
+    return False
+
+
+@njit(cache=True)
+def get_player_actions(state, color):
+    player_actions = []
+    update_pins(state, color)
+    for p in range(16):
+        idx = pack(color, p)
+        n = write_actions(state, idx, False, False, state.scratch, 0, MAX_MOVES)
+        actions = actions_list(state, n)
+        if actions:
+            player_actions.append((idx, actions))
+    return player_actions
+
+
+# def check_consistency(state):
+#     for idx, p in enumerate(state.pieces):
+#         if p != (-1, -1) and state.mat[p[0]][p[1]] != idx:
+#             print("Pieces %d -> %s; Mat -> %d" % (idx, str(p), state.mat[p[0]][p[1]]))
+#     indices = [(i, j) for i, j in product(range(8), range(8))]
+#     for i, j in indices:
+#         mat_idx = state.mat[i, j]
+#         if mat_idx > -1 and state.pieces[mat_idx] != (i, j):
+#             print("Mat (%d, %d) -> %d; Pieces -> %s" % (i, j, mat_idx, str(state.pieces[mat_idx])))
+
+
+@njit(cache=True)
+def alloc_state(stack_size):
+    """Empty State holding stack_size plies of moves"""
+    state = structref.new(STATE_TYPE)
+    state.mat = np.full((8, 8), -1, dtype=np.int8)
+    state.pieces = np.full((32, 2), -1, dtype=np.int8)
+    state.types = IDX_TYPE.copy()
+    state.actions = np.zeros((stack_size + 1, UNDO_SIZE), dtype=np.int16)
+    state.action_idx = 0
+    state.zobrist = 0
+    state.castling = 0
+    state.ep = -1
+    state.halfmove = 0
+    state.pin_dirs = np.full(32, -1, dtype=np.int8)
+    state.check_mask = np.zeros((8, 8), dtype=np.bool_)
+    state.n_checkers = 0
+    state.scratch = np.zeros(MAX_PIECE_MOVES, dtype=np.int16)
+    # In-check tests made while count_checks is set by a search with statistics
+    state.check_tests = 0
+    state.count_checks = False
+    state.mg = np.zeros(2, dtype=np.int32)
+    state.eg = np.zeros(2, dtype=np.int32)
+    state.phase = 0
+    state.first_color = 0
+    return state
+
+
+@njit(cache=True)
+def new_state(stack_size):
+    """State in the start position, holding stack_size plies of moves"""
+    state = alloc_state(stack_size)
+    init_position(state)
+    return state
+
+
+@njit(cache=True)
+def copy_state(state):
+    """Independent State with the same position, move history and stack size"""
+    dst = alloc_state(state.actions.shape[0] - 1)
+    copy_position(state, dst)
+    return dst
+
+
+@njit(cache=True)
+def get_mat(state):
+    return state.mat
+
+
+@njit(cache=True)
+def get_pieces(state):
+    return state.pieces
+
+
+@njit(cache=True)
+def get_types(state):
+    return state.types
+
+
+# Not a njit to allow formatting
+def print_state(state):
+    line = (8 * 3 + 1) * "-"
+    print(line)
+    for i in range(8):
+        print("[" + ",".join("%2d" % p if p > -1 else "  " for p in state.mat[i, :]) + "]")
+    print(line)
+
+
+class State(PositionProxy):
+    """Array backend: a board of piece indices, the squares of each piece and
+    pins found once per generation"""
+
+    def __new__(cls, stack_size=STACK_SIZE):
+        return new_state(stack_size)
+
+    mat = property(get_mat)
+    pieces = property(get_pieces)
+    types = property(get_types)
+
+
+structref.define_boxing(StateType, State)
+bind_methods(
+    StateType,
+    State,
+    dict(
+        POSITION_METHODS,
+        get_idx=get_idx,
+        get_piece=get_piece,
+        get_color=get_color,
+        get_type=get_type,
+        code=piece_code,
+        clear=clear_position,
+        set_piece=set_piece,
+        place_piece=place_piece,
+        remove_piece=remove_piece,
+        copy=copy_state,
+        compute_zobrist=position_zobrist,
+        action_move=action_move,
+        push_action=push_action,
+        push_move=push_move,
+        pop_action=unmake_move,
+        game_status=game_status,
+        material=material,
+        is_square_attacked=is_square_attacked,
+        is_pieced_checked=is_pieced_checked,
+        update_pins=update_pins,
+        add_checker=add_checker,
+        get_actions=get_actions,
+        is_legal_action=is_legal_action,
+        is_legal_move=is_legal_move,
+        write_pawn_move=write_pawn_move,
+        write_castles=write_castles,
+        write_actions=write_actions,
+        actions_list=actions_list,
+        gen_moves=gen_moves,
+        gen_moves_reference=gen_moves_reference,
+        gen_captures=gen_captures,
+        has_legal_move=has_legal_move,
+        get_player_actions=get_player_actions,
+    ),
+)
+
+
+def create_state(backend="array", stack_size=STACK_SIZE):
+    """New game state, with the "array" or "bitboard" backend, holding
+    stack_size plies of moves"""
+    if backend == "bitboard":
+        from bitboard import BitboardState
+
+        return BitboardState(stack_size)
+    if backend != "array":
+        raise ValueError("Unknown backend %s" % backend)
+    return State(stack_size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import time
+import numpy as np
+from numba.core import event
+from state import MAX_PLY
+
+# Rows of a counters array, which has one column per ply
+NODES = 0
+QS_NODES = 1
+GEN_CALLS = 2
+# Calls of State.is_square_attacked, the in-check tests of move generation included
+CHECK_TESTS = 3
+CUTOFFS = 4
+FIRST_CUTOFFS = 5
+TT_PROBES = 6
+TT_HITS = 7
+TT_CUTOFFS = 8
+COUNTER_NAMES = (
+    "nodes",
+    "qs_nodes",
+    "gen_calls",
+    "check_tests",
+    "cutoffs",
+    "first_cutoffs",
+    "tt_probes",
+    "tt_hits",
+    "tt_cutoffs",
+)
+
+
+# Time spent compiling numba functions in this process, left out of the
+# iteration times
+COMPILE_TIMER = event.TimingListener()
+event.register("numba:compile", COMPILE_TIMER)
+
+
+def compile_time():
+    return COMPILE_TIMER.duration if COMPILE_TIMER.done else 0.0
+
+
+def create_counters():
+    return np.zeros((len(COUNTER_NAMES), MAX_PLY), dtype=np.int64)
+
+
+class SearchStats:
+    """Search counters by ply and per-iteration totals. The search functions
+    take it as an optional stats argument and skip all counting without it.
+    on_iteration is an optional callback receiving each iteration's dict"""
+
+    def __init__(self, on_iteration=None):
+        self.on_iteration = on_iteration
+        self.counters = create_counters()
+        self.iterations = []
+        self.start = time.perf_counter()
+        self.compiled = compile_time()
+        self.totals = np.zeros(len(COUNTER_NAMES), dtype=np.int64)
+
+    def reset(self):
+        self.counters[:] = 0
+        self.iterations = []
+        self.start = time.perf_counter()
+        self.compiled = compile_time()
+        self.totals[:] = 0
+
+    def end_iteration(self, depth):
+        """Record the counts of the iteration of depth just completed"""
+        now = time.perf_counter()
+        compiled = compile_time()
+        totals = self.counters.sum(axis=1)
+        delta = totals - self.totals
+        info = {"depth": depth, "time": now - self.start - (compiled - self.compiled)}
+        info.update(zip(COUNTER_NAMES, delta.tolist()))
+        # Effective branching factor: node ratio of two successive iterations
+        previous = self.iterations[-1]["nodes"] if self.iterations else 0
+        info["ebf"] = info["nodes"] / previous if previous else None
+        self.iterations.append(info)
+        self.totals = totals
+        self.start = now
+        self.compiled = compiled
+        if self.on_iteration is not None:
+            self.on_iteration(info)
+        return info
+
+    def plies(self):
+        """Number of plies reached"""
+        reached = np.nonzero(self.counters[NODES] + self.counters[QS_NODES])[0]
+        return int(reached[-1]) + 1 if len(reached) else 0
+
+    def to_dict(self):
+        n = self.plies()
+        per_ply = {name: self.counters[k, :n].tolist() for k, name in enumerate(COUNTER_NAMES)}
+        return {"iterations": self.iterations, "per_ply": per_ply}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+def print_stats(stats):
+    print(
+        "{:>5}{:>9}{:>10}{:>10}{:>9}{:>7}".format(
+            "depth", "time", "nodes", "qs nodes", "cutoffs", "ebf"
+        )
+    )
+    for info in stats.iterations:
+        ebf = "" if info["ebf"] is None else "{:.2f}".format(info["ebf"])
+        print(
+            "{:>5}{:>9.3f}{:>10}{:>10}{:>9}{:>7}".format(
+                info["depth"], info["time"], info["nodes"], info["qs_nodes"], info["cutoffs"], ebf
+            )
+        )
+
+
+if __name__ == "__main__":
+    from state import create_state
+    from notation import play_moves
+    from ai import AlphaBeta, jit_search
+
+    parser = argparse.ArgumentParser(description="Search statistics of a position")
+    parser.add_argument("moves", nargs="?", default="", help='e.g. "e2e4 e7e5"')
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    parser.add_argument("--engine", choices=["jit", "python"], default="jit")
+    parser.add_argument("--tapered", action="store_true")
+    parser.add_argument("--quiesce", action="store_true")
+    parser.add_argument("--output", help="write the stats as JSON")
+    args = parser.parse_args()
+    state = play_moves(create_state(args.backend), args.moves)
+    options = {"tapered": args.tapered, "quiesce": args.quiesce}
+    stats = SearchStats()
+    if args.engine == "jit":
+        jit_search(state, args.depth, stats=stats, **options)
+    else:
+        AlphaBeta(state, stats=stats, **options).run(args.depth)
+    print_stats(stats)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(stats.to_json(indent=2))
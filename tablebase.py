@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from numba import njit
+import numpy as np
+from state import State, KING, QUEEN, BISHOP, KNIGNT, ROOK, PAWN, KING_IDX, MAX_MOVES, pack
+from ai import tablebase_index
+from startup import warm_pool
+
+# Results from the side to move, UNKNOWN only while solving
+WIN = 1
+DRAW = 0
+LOSS = -1
+UNKNOWN = 2
+ILLEGAL = -2
+# Successor placeholder of captures, which leave a drawn king against king,
+# and of the promotions to a bishop or knight, also drawn
+CAPTURE = -1
+# Sets a pawn promotes into. Successors in them are stored as
+# -(PROMOTED + k * TB_SIZE + index), k the position in the tuple
+PROMOTION_TABLES = ("KQK", "KRK")
+PROMOTED = 2
+TB_DIR = "tablebases"
+# Material sets: the name and type of the extra white piece. Positions are
+# indexed by side to move, then the squares of the white king, the black
+# king and the piece, with square = i * 8 + j
+MATERIALS = {"KQK": QUEEN, "KRK": ROOK, "KBK": BISHOP, "KNK": KNIGNT, "KPK": PAWN}
+TB_SIZE = 2 * 64 * 64 * 64
+# Piece index p of the first white piece of each type
+TYPE_SLOT = np.int8([KING_IDX, 3, 2, 1, 0, 8])
+# Material set of each type of the other piece, a king making no set
+TYPE_MATERIAL = ["K%sK" % letter for letter in "KQBNRP"]
+
+
+@njit(cache=True)
+def decode_index(index):
+    """index -> (color to move, white king, black king, piece) squares"""
+    return index // 64 ** 3, index // 64 ** 2 % 64, index // 64 % 64, index % 64
+
+
+@njit(cache=True)
+def position_index(state, slot):
+    """Index of a state of the material set of white piece slot, CAPTURE
+    once the piece is gone"""
+    i, j = state.pieces[slot]
+    if i < 0:
+        return CAPTURE
+    wi, wj = state.pieces[pack(0, KING_IDX)]
+    bi, bj = state.pieces[pack(1, KING_IDX)]
+    color = state.get_player_color()
+    return ((color * 64 + wi * 8 + wj) * 64 + bi * 8 + bj) * 64 + i * 8 + j
+
+
+@njit(cache=True)
+def setup(state, index, slot, t):
+    """Put the position of index on state, False if two pieces overlap, a
+    pawn stands on the first or last row or the side not to move is in check"""
+    color, wk, bk, sq = decode_index(index)
+    if wk == bk or wk == sq or bk == sq:
+        return False
+    if t == PAWN and (sq // 8 == 0 or sq // 8 == 7):
+        return False
+    state.clear()
+    state.set_piece(0, KING_IDX, wk // 8, wk % 8, KING)
+    state.set_piece(1, KING_IDX, bk // 8, bk % 8, KING)
+    state.set_piece(0, slot, sq // 8, sq % 8, t)
+    state.set_player_color(color)
+    return not state.is_pieced_checked(pack(1 - color, KING_IDX))
+
+
+@njit(cache=True)
+def successor_index(state, slot, t):
+    """position_index of a successor, encoded as PROMOTION_TABLES describes
+    after a promotion"""
+    tp = state.types[slot]
+    if tp == t:
+        return position_index(state, slot)
+    if tp == QUEEN or tp == ROOK:
+        k = 0 if tp == QUEEN else 1
+        return -(PROMOTED + k * TB_SIZE + position_index(state, slot))
+    return CAPTURE
+
+
+@njit(cache=True)
+def successors(state, slot, t, start, end, status, counts, succ):
+    """Solve the mates and stalemates of indices [start, end) and write the
+    successor indices of the others. Returns the number of successors"""
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    n_succ = 0
+    for index in range(start, end):
+        k = index - start
+        counts[k] = 0
+        if not setup(state, index, slot, t):
+            status[k] = ILLEGAL
+            continue
+        color = state.get_player_color()
+        n = state.gen_moves(color, moves)
+        if n == 0:
+            status[k] = LOSS if state.is_pieced_checked(pack(color, KING_IDX)) else DRAW
+            continue
+        status[k] = UNKNOWN
+        counts[k] = n
+        for m in range(n):
+            state.push_move(moves[m])
+            succ[n_succ] = successor_index(state, slot, t)
+            state.pop_action()
+            n_succ += 1
+    return n_succ
+
+
+def solve_chunk(material, start, end):
+    """(status, successor counts, successors) of indices [start, end)"""
+    state = State()
+    t = MATERIALS[material]
+    status = np.zeros(end - start, dtype=np.int8)
+    counts = np.zeros(end - start, dtype=np.int32)
+    succ = np.zeros((end - start) * 64, dtype=np.int32)
+    n = successors(state, TYPE_SLOT[t], t, start, end, status, counts, succ)
+    return status, counts, succ[:n].copy()
+
+
+@njit(cache=True)
+def retro_step(n, offsets, succ, wdl, dtm, found, promoted_wdl, promoted_dtm):
+    """Mark the positions won or lost in exactly n plies in found.
+    promoted_wdl and promoted_dtm are the PROMOTION_TABLES, concatenated"""
+    for index in range(wdl.shape[0]):
+        found[index] = UNKNOWN
+        if wdl[index] != UNKNOWN:
+            continue
+        all_won = True
+        for k in range(offsets[index], offsets[index + 1]):
+            s = succ[k]
+            if s == CAPTURE:
+                all_won = False
+                continue
+            if s < CAPTURE:
+                result, plies = promoted_wdl[-s - PROMOTED], promoted_dtm[-s - PROMOTED]
+            else:
+                result, plies = wdl[s], dtm[s]
+            if result == LOSS and plies == n - 1:
+                found[index] = WIN
+                break
+            elif result != WIN:
+                all_won = False
+        if found[index] == UNKNOWN and all_won:
+            found[index] = LOSS
+
+
+@njit(cache=True)
+def apply_step(n, wdl, dtm, found):
+    """Record the results of retro_step, return their number"""
+    count = 0
+    for index in range(wdl.shape[0]):
+        if found[index] != UNKNOWN:
+            wdl[index] = found[index]
+            dtm[index] = n
+            count += 1
+    return count
+
+
+def promotion_tables(material, directory=TB_DIR, workers=None):
+    """Concatenated (wdl, dtm) of the PROMOTION_TABLES of a pawn set, written
+    first when missing, and empty arrays for the other sets"""
+    if MATERIALS[material] != PAWN:
+        return np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int16)
+    tables = []
+    for promoted in PROMOTION_TABLES:
+        wdl_path, dtm_path = table_paths(promoted, directory)
+        if os.path.exists(wdl_path) and os.path.exists(dtm_path):
+            tables.append((np.load(wdl_path), np.load(dtm_path)))
+        else:
+            tables.append(write_table(promoted, directory, workers))
+    return np.concatenate([w for w, _ in tables]), np.concatenate([d for _, d in tables])
+
+
+def generate(material, workers=None, chunks=64, directory=TB_DIR):
+    """Solve a material set by retrograde analysis, return the (wdl, dtm)
+    arrays: results from the side to move and distances to mate in plies.
+    Pawn sets read the tables of their promotions from directory"""
+    promoted_wdl, promoted_dtm = promotion_tables(material, directory, workers)
+    # Promotions reach results up to the longest mate of their tables
+    horizon = int(promoted_dtm.max(initial=0)) + 1
+    context = warm_pool(warmup=lambda: solve_chunk(material, 0, 64))
+    bounds = np.linspace(0, TB_SIZE, chunks + 1).astype(np.int64)
+    with ProcessPoolExecutor(workers, mp_context=context) as executor:
+        args = ([material] * chunks, bounds[:-1], bounds[1:])
+        parts = list(executor.map(solve_chunk, *args))
+    wdl = np.concatenate([p[0] for p in parts])
+    counts = np.concatenate([p[1] for p in parts])
+    succ = np.concatenate([p[2] for p in parts])
+    offsets = np.zeros(TB_SIZE + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    dtm = np.zeros(TB_SIZE, dtype=np.int16)
+    found = np.zeros(TB_SIZE, dtype=np.int8)
+    n = 1
+    while True:
+        retro_step(n, offsets, succ, wdl, dtm, found, promoted_wdl, promoted_dtm)
+        if apply_step(n, wdl, dtm, found) == 0 and n > horizon:
+            break
+        n += 1
+    wdl[wdl == UNKNOWN] = DRAW
+    return wdl, dtm
+
+
+def empty_table(dtype):
+    """Stand-in of a missing table, read-only like the mapped ones"""
+    table = np.zeros(0, dtype=dtype)
+    table.flags.writeable = False
+    return table
+
+
+def table_paths(material, directory=TB_DIR):
+    base = os.path.join(directory, material)
+    return base + ".wdl.npy", base + ".dtm.npy"
+
+
+def write_table(material, directory=TB_DIR, workers=None):
+    wdl, dtm = generate(material, workers, directory=directory)
+    os.makedirs(directory, exist_ok=True)
+    wdl_path, dtm_path = table_paths(material, directory)
+    np.save(wdl_path, wdl)
+    np.save(dtm_path, dtm)
+    return wdl, dtm
+
+
+class Tablebase:
+    """Probes the tables of a directory, memory-mapped on first use"""
+
+    def __init__(self, directory=TB_DIR):
+        self.directory = directory
+        self.tables = {}
+
+    def table(self, material):
+        if material not in self.tables:
+            wdl_path, dtm_path = table_paths(material, self.directory)
+            if os.path.exists(wdl_path) and os.path.exists(dtm_path):
+                wdl = np.load(wdl_path, mmap_mode="r")
+                dtm = np.load(dtm_path, mmap_mode="r")
+                self.tables[material] = (wdl, dtm)
+            else:
+                self.tables[material] = None
+        return self.tables[material]
+
+    def probe(self, state):
+        """(WIN, DRAW or LOSS for the player up, plies to mate) of a state
+        with two kings and one other piece, None if no table covers it"""
+        t, index = tablebase_index(state)
+        if t < 0:
+            return None
+        tables = self.table(TYPE_MATERIAL[t])
+        if tables is None:
+            return None
+        wdl, dtm = tables
+        return int(wdl[index]), int(dtm[index])
+
+    def arrays(self):
+        """(wdl, dtm) tuples of the tables by type of the other piece, for the
+        nopython search. Missing tables are empty"""
+        wdl, dtm = [], []
+        for t in range(len(TYPE_MATERIAL)):
+            tables = self.table(TYPE_MATERIAL[t]) if TYPE_MATERIAL[t] in MATERIALS else None
+            if tables is None:
+                tables = empty_table(np.int8), empty_table(np.int16)
+            wdl.append(tables[0])
+            dtm.append(tables[1])
+        return tuple(wdl), tuple(dtm)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Endgame tablebase generator")
+    parser.add_argument("materials", nargs="*", default=["KQK", "KRK", "KPK"])
+    parser.add_argument("--directory", default=TB_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    for material in args.materials:
+        if material not in MATERIALS:
+            parser.error("unknown material set %s" % material)
+        start = time.time()
+        wdl, dtm = write_table(material, args.directory, args.workers)
+        legal = wdl != ILLEGAL
+        print(
+            "{}: {} positions, {} won, {} lost, longest mate {} plies, {:.1f}s".format(
+                material,
+                legal.sum(),
+                (wdl == WIN).sum(),
+                (wdl == LOSS).sum(),
+                dtm[legal].max(),
+                time.time() - start,
+            )
+        )
@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+
+import numpy as np
+from state import MAX_MOVES
+from batch import create_batch, random_games, seed_random
+
+
+def test_random_games_restart():
+    """Games are restarted once their stack is full, over more plies than it holds"""
+    n, max_plies = 4, 16
+    batch = create_batch(n, max_plies)
+    buf = np.zeros((n, MAX_MOVES), dtype=np.int16)
+    counts = np.zeros(n, dtype=np.int32)
+    moves = np.zeros(n, dtype=np.int16)
+    seed_random(0)
+    positions = random_games(batch, 3 * max_plies, buf, counts, moves)
+    assert positions > 2 * n * max_plies
+    assert (batch.action_idx <= max_plies).all()
+
+
+if __name__ == "__main__":
+    test_random_games_restart()
+    print("ok")
@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+
+from match import sprt_bounds, sprt_llr
+
+
+def test_sprt_llr():
+    """Lopsided samples cross the SPRT bounds, an empty one stays at 0"""
+    lower, upper = sprt_bounds()
+    assert sprt_llr(0, 0, 0, 0, 10) == 0.0
+    assert sprt_llr(30, 5, 0, 0, 10) > upper
+    assert sprt_llr(20, 0, 0, 0, 10) > upper
+    assert sprt_llr(0, 5, 30, 0, 10) < lower
+    assert sprt_llr(0, 0, 20, 0, 10) < lower
+    assert lower < sprt_llr(10, 10, 10, 0, 10) < upper
+    # A game or two is never decisive
+    for elo1 in (10, 50):
+        for sample in ((1, 0, 0), (0, 1, 0), (0, 2, 0), (0, 0, 1)):
+            assert lower < sprt_llr(*sample, 0, elo1) < upper, (sample, elo1)
+
+
+if __name__ == "__main__":
+    test_sprt_llr()
+    print("ok")
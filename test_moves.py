@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+import numpy as np
+from state import MAX_MOVES, EN_PASSANT, create_state, move_flag
+from pgn import load_fen
+from perft import PERFT_POSITIONS
+
+# Random plies played from each perft position
+WALK_PLIES = 40
+
+
+def walk_positions(backend="array", seed=0):
+    """Generate states along random games from the perft positions"""
+    rng = np.random.default_rng(seed)
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    for _, fen, _ in PERFT_POSITIONS:
+        state = load_fen(create_state(backend), fen)
+        for _ in range(WALK_PLIES):
+            yield state
+            n = state.gen_moves(state.get_player_color(), moves)
+            if n == 0:
+                break
+            state.push_move(moves[rng.integers(n)])
+
+
+def test_gen_moves_reference():
+    """Pin and check based generation matches the make/unmake reference"""
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    reference = np.zeros(MAX_MOVES, dtype=np.int16)
+    for state in walk_positions():
+        color = state.get_player_color()
+        n = state.gen_moves(color, moves)
+        m = state.gen_moves_reference(color, reference)
+        assert sorted(moves[:n].tolist()) == sorted(reference[:m].tolist())
+
+
+def test_gen_captures():
+    """gen_captures is gen_moves filtered to the captures, on both backends"""
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    captures = np.zeros(MAX_MOVES, dtype=np.int16)
+    for backend in ("array", "bitboard"):
+        for state in walk_positions(backend):
+            color = state.get_player_color()
+            n = state.gen_moves(color, moves)
+            expected = []
+            for move in moves[:n].tolist():
+                dst = move % 64
+                if state.mat[dst // 8, dst % 8] > -1 or move_flag(move) == EN_PASSANT:
+                    expected.append(move)
+            m = state.gen_captures(color, captures)
+            assert sorted(captures[:m].tolist()) == sorted(expected)
+
+
+def board_codes(state):
+    """Piece code by square of the mat and types arrays, -1 if empty"""
+    mat = state.mat.astype(np.int64)
+    return np.where(mat > -1, mat // 16 * 6 + state.types[mat], -1)
+
+
+def test_backends_agree():
+    """The bitboard backend follows the array walks with the same moves, pieces,
+    zobrist keys and scores, its piece arrays derived from the board"""
+    rng = np.random.default_rng(0)
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    bitboard_moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    for _, fen, _ in PERFT_POSITIONS:
+        state = load_fen(create_state("array"), fen)
+        other = load_fen(create_state("bitboard"), fen)
+        # Numbered as pgn.set_position does
+        assert (state.mat == other.mat).all() and (state.types == other.types).all()
+        for _ in range(WALK_PLIES):
+            color = state.get_player_color()
+            n = state.gen_moves(color, moves)
+            m = other.gen_moves(color, bitboard_moves)
+            assert sorted(moves[:n].tolist()) == sorted(bitboard_moves[:m].tolist())
+            assert (board_codes(state) == board_codes(other)).all()
+            assert state.zobrist == other.zobrist == other.compute_zobrist()
+            assert state.evaluate(color) == other.evaluate(color)
+            assert state.game_status(color) == other.game_status(color)
+            if n == 0:
+                break
+            move = moves[rng.integers(n)]
+            state.push_move(move)
+            other.push_move(move)
+        while other.action_idx > 0:
+            state.pop_action()
+            other.pop_action()
+            assert (board_codes(state) == board_codes(other)).all()
+            assert state.zobrist == other.zobrist
+
+
+def test_full_stack():
+    """A state with a full undo stack still generates its moves"""
+    moves = np.zeros(MAX_MOVES, dtype=np.int16)
+    for backend in ("array", "bitboard"):
+        # e2e4 a7a6 e4e5 d7d5, the en passant capture e5d6 is tested by make/unmake
+        state = create_state(backend, 4)
+        for move in (3364, 528, 2332, 731):
+            state.push_move(move)
+        assert state.is_stack_full()
+        n = state.gen_moves(state.get_player_color(), moves)
+        assert n == 31 and 10003 in moves[:n].tolist()
+
+
+if __name__ == "__main__":
+    test_gen_moves_reference()
+    test_gen_captures()
+    test_backends_agree()
+    test_full_stack()
+    print("ok")
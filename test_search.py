@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+
+from state import create_state
+from ai import min_max, alpha_beta, jit_search
+from pgn import START_FEN, load_fen
+
+# (FEN, depth) of the positions the searches are compared on
+SEARCH_POSITIONS = [
+    (START_FEN, 2),
+    ("r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3", 2),
+    ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", 2),
+    ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", 3),
+    ("6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1", 3),
+    ("4k3/P7/8/8/8/8/8/4K3 w - - 0 1", 3),
+]
+
+
+def test_search_agreement():
+    """alpha_beta and jit_search return the move and value of min_max"""
+    for backend in ("array", "bitboard"):
+        for fen, depth in SEARCH_POSITIONS:
+            for quiesce in (False, True):
+                state = load_fen(create_state(backend), fen)
+                expected = min_max(state, depth, quiesce=quiesce)
+                assert alpha_beta(state, depth, quiesce=quiesce) == expected, (fen, quiesce)
+                assert jit_search(state, depth, quiesce=quiesce) == expected, (fen, quiesce)
+
+
+if __name__ == "__main__":
+    test_search_agreement()
+    print("ok")
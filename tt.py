@@ -0,0 +1,204 @@
+import numba as nb
+from numba import njit
+from numba.experimental import structref
+import numpy as np
+from utils import bind_methods
+
+# Bound types
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+# Empty slot marker for the depth array
+EMPTY = -1
+# Bytes used by one entry: key, move, score, depth, bound
+ENTRY_SIZE = 8 + 2 + 4 + 1 + 1
+# Slots per bucket: depth-preferred, always-replace
+BUCKET_SIZE = 2
+
+
+@structref.register
+class TableType(nb.types.StructRef):
+    """numba type of TranspositionTable"""
+
+
+spec = [
+    ("keys", nb.uint64[::1]),
+    ("moves", nb.int16[::1]),
+    ("scores", nb.int32[::1]),
+    ("depths", nb.int8[::1]),
+    ("bounds", nb.int8[::1]),
+    ("mask", nb.uint64),
+    ("hits", nb.int64),
+    ("misses", nb.int64),
+    ("collisions", nb.int64),
+    ("stores", nb.int64),
+]
+TABLE_TYPE = TableType(spec)
+
+
+@njit(cache=True)
+def new_table(n_buckets):
+    """n_buckets must be a power of two"""
+    table = structref.new(TABLE_TYPE)
+    size = n_buckets * BUCKET_SIZE
+    table.keys = np.zeros(size, dtype=np.uint64)
+    table.moves = np.full(size, -1, dtype=np.int16)
+    table.scores = np.zeros(size, dtype=np.int32)
+    table.depths = np.full(size, EMPTY, dtype=np.int8)
+    table.bounds = np.zeros(size, dtype=np.int8)
+    table.mask = n_buckets - 1
+    table.hits = 0
+    table.misses = 0
+    table.collisions = 0
+    table.stores = 0
+    return table
+
+
+@njit(cache=True)
+def clear(table):
+    table.keys[:] = 0
+    table.moves[:] = -1
+    table.depths[:] = EMPTY
+    table.hits = 0
+    table.misses = 0
+    table.collisions = 0
+    table.stores = 0
+
+
+@njit(cache=True)
+def bucket(table, key):
+    return np.int64(key & table.mask) * BUCKET_SIZE
+
+
+@njit(cache=True)
+def probe(table, key):
+    """Return the slot holding key, or -1"""
+    slot = bucket(table, key)
+    occupied = False
+    for k in range(BUCKET_SIZE):
+        if table.depths[slot + k] != EMPTY:
+            if table.keys[slot + k] == key:
+                table.hits += 1
+                return slot + k
+            occupied = True
+    table.misses += 1
+    if occupied:
+        table.collisions += 1
+    return -1
+
+
+@njit(cache=True)
+def lookup(table, key):
+    """(found, depth, score, bound, move)"""
+    slot = probe(table, key)
+    if slot < 0:
+        return False, -1, 0, EXACT, -1
+    return True, table.depths[slot], table.scores[slot], table.bounds[slot], table.moves[slot]
+
+
+@njit(cache=True)
+def write(table, slot, key, depth, score, bound, move):
+    # Keep the previous best move when none was found this time
+    if move < 0 and table.keys[slot] == key and table.depths[slot] != EMPTY:
+        move = table.moves[slot]
+    table.keys[slot] = key
+    table.depths[slot] = depth
+    table.scores[slot] = score
+    table.bounds[slot] = bound
+    table.moves[slot] = move
+    table.stores += 1
+
+
+@njit(cache=True)
+def store(table, key, depth, score, bound, move):
+    slot = bucket(table, key)
+    # Depth-preferred slot: same position or a search at least as deep
+    if table.keys[slot] == key or depth >= table.depths[slot]:
+        # Demote the previous entry to the always-replace slot
+        if table.depths[slot] != EMPTY and table.keys[slot] != key:
+            write(
+                table,
+                slot + 1,
+                table.keys[slot],
+                table.depths[slot],
+                table.scores[slot],
+                table.bounds[slot],
+                table.moves[slot],
+            )
+        write(table, slot, key, depth, score, bound, move)
+    else:
+        write(table, slot + 1, key, depth, score, bound, move)
+
+
+@njit(cache=True)
+def hashfull(table):
+    """Used slots, per mille"""
+    return 1000 * np.sum(table.depths != EMPTY) // table.depths.shape[0]
+
+
+@njit(cache=True)
+def get_hits(table):
+    return table.hits
+
+
+@njit(cache=True)
+def get_misses(table):
+    return table.misses
+
+
+@njit(cache=True)
+def get_collisions(table):
+    return table.collisions
+
+
+@njit(cache=True)
+def get_stores(table):
+    return table.stores
+
+
+class TranspositionTable(structref.StructRefProxy):
+    """Two-slot buckets of (key, move, score, depth, bound) arrays, its
+    methods being the njit kernels above"""
+
+    def __new__(cls, n_buckets):
+        return new_table(n_buckets)
+
+    hits = property(get_hits)
+    misses = property(get_misses)
+    collisions = property(get_collisions)
+    stores = property(get_stores)
+
+
+structref.define_boxing(TableType, TranspositionTable)
+bind_methods(
+    TableType,
+    TranspositionTable,
+    {
+        "clear": clear,
+        "bucket": bucket,
+        "probe": probe,
+        "lookup": lookup,
+        "write": write,
+        "store": store,
+        "hashfull": hashfull,
+    },
+)
+
+
+def create_table(size_mb=16):
+    """Largest power-of-two table fitting in size_mb"""
+    n_buckets = max(1, int(size_mb * 2 ** 20) // (ENTRY_SIZE * BUCKET_SIZE))
+    n_buckets = 1 << (n_buckets.bit_length() - 1)
+    return TranspositionTable(n_buckets)
+
+
+def table_stats(table):
+    probes = table.hits + table.misses
+    return {
+        "hits": table.hits,
+        "misses": table.misses,
+        "collisions": table.collisions,
+        "stores": table.stores,
+        "hit_rate": table.hits / probes if probes else 0.0,
+        "hashfull": table.hashfull(),
+    }
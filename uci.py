@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from state import STACK_SIZE, create_state
+from tt import create_table
+from ai import INF, MATE_BOUND, TT_SIZE_MB, AlphaBeta, alpha_beta, principal_variation
+from notation import move_name, play_moves
+from pgn import START_FEN, load_fen
+
+ENGINE_NAME = "pychess"
+# Deepest iteration of a search without depth limit
+MAX_SEARCH_DEPTH = 64
+# Moves left assumed when the GUI sends no movestogo
+DEFAULT_MOVES_TO_GO = 30
+# Time kept for the GUI and process overhead, in seconds
+MOVE_OVERHEAD = 0.05
+# Share of the remaining time one move may use at most
+MAX_TIME_SHARE = 0.5
+# Material scores in pawns, reported in centipawns
+PAWN_CP = 100
+# Seconds between stop checks of a search waiting for the warm-up
+READY_POLL = 0.05
+
+
+def time_budget(params, color):
+    """Seconds to think about the next move from the parameters of "go", None
+    for no limit. Spreads the clock over the moves left, plus most of the
+    increment, and never uses more than a share of what is left"""
+    if "movetime" in params:
+        return max(params["movetime"] / 1000 - MOVE_OVERHEAD, 0.0)
+    clock = params.get("btime" if color else "wtime")
+    if clock is None:
+        return None
+    clock /= 1000
+    increment = params.get("binc" if color else "winc", 0) / 1000
+    moves_to_go = params.get("movestogo", DEFAULT_MOVES_TO_GO)
+    budget = clock / max(moves_to_go, 1) + 0.8 * increment
+    budget = min(budget, MAX_TIME_SHARE * clock)
+    return max(budget - MOVE_OVERHEAD, 0.0)
+
+
+def parse_go(tokens):
+    """Parameters of a "go" command, as a dict of ints and flags"""
+    params = {}
+    k = 0
+    while k < len(tokens):
+        name = tokens[k]
+        if name in ("infinite", "ponder"):
+            params[name] = True
+        elif name == "searchmoves":
+            # Restricting the root moves is not supported, skip the list
+            break
+        elif k + 1 < len(tokens):
+            try:
+                params[name] = int(tokens[k + 1])
+            except ValueError:
+                pass
+            k += 1
+        k += 1
+    return params
+
+
+def player_color(fen, moves):
+    """Color to move after moves from fen, without setting up the position"""
+    fields = fen.split()
+    first = 1 if len(fields) > 1 and fields[1] == "b" else 0
+    return (first + len(moves)) % 2
+
+
+def format_score(value, tapered):
+    """UCI score of a search value: mates by moves, otherwise centipawns"""
+    if abs(value) >= MATE_BOUND:
+        moves = (INF - abs(value) + 1) // 2
+        return "mate %d" % (moves if value > 0 else -moves)
+    return "cp %d" % (value if tapered else value * PAWN_CP)
+
+
+class SearchWorker(threading.Thread):
+    """AlphaBeta on the position of the engine, printing info lines as
+    iterations complete and bestmove at the end. The position is set up on
+    this thread, once the engine is warm"""
+
+    def __init__(self, engine, max_time, depth, max_nodes, infinite):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.position = engine.position
+        self.max_time = max_time
+        self.max_nodes = max_nodes
+        self.depth = depth
+        self.infinite = infinite
+        self.stop_event = threading.Event()
+        # Set when an infinite search may print its move
+        self.release = threading.Event()
+        self.best_move = None
+        self.start_time = time.perf_counter()
+        self.state = None
+        self.search = None
+        # ponderhit may come before the search is created
+        self.lock = threading.Lock()
+
+    def on_progress(self, info):
+        # Called between iterations, with the root position on the state
+        self.best_move = info["move"]
+        line = principal_variation(self.state, self.engine.table, info["move"], info["depth"])
+        elapsed = max(time.perf_counter() - self.start_time, 1e-6)
+        self.engine.send(
+            "info depth {} score {} nodes {} nps {} time {} pv {}".format(
+                info["depth"],
+                format_score(info["value"], self.engine.options["Tapered"]),
+                info["nodes"],
+                int(info["nodes"] / elapsed),
+                int(elapsed * 1000),
+                " ".join(move_name(m) for m in line),
+            )
+        )
+
+    def run(self):
+        while not self.engine.ready.wait(READY_POLL):
+            if self.stop_event.is_set():
+                self.engine.send("bestmove 0000")
+                return
+        try:
+            self.state = self.engine.setup(*self.position)
+        except ValueError as e:
+            self.engine.send("info string %s" % e)
+            self.engine.send("bestmove 0000")
+            return
+        with self.lock:
+            self.search = AlphaBeta(
+                self.state,
+                self.max_time,
+                self.max_nodes,
+                self.engine.table,
+                stop=self.stop_event,
+                on_progress=self.on_progress,
+                **self.engine.search_options(),
+            )
+        self.start_time = time.perf_counter()
+        move, _ = self.search.run(self.depth)
+        # Infinite searches and pondering report their move once released
+        if self.infinite:
+            self.release.wait()
+        if move is None or self.best_move is None:
+            self.engine.send("bestmove 0000")
+        else:
+            self.engine.send("bestmove " + move_name(self.best_move))
+
+    def stop(self):
+        self.stop_event.set()
+        self.release.set()
+
+    def ponderhit(self, max_time):
+        """The pondered move was played: finish within max_time seconds"""
+        self.infinite = False
+        with self.lock:
+            self.max_time = max_time
+            if max_time is not None and self.search is not None:
+                self.search.set_max_time(max_time)
+        self.release.set()
+
+
+class UciEngine:
+    """Handles UCI commands. Searches run on a worker thread, so the commands
+    are answered while the engine thinks. Compiled code only runs on the
+    worker and warm-up threads, so that compilation never holds up commands"""
+
+    def __init__(self, backend="array", output=None):
+        self.backend = backend
+        self.output = output or sys.stdout
+        self.output_lock = threading.Lock()
+        self.options = {"Hash": TT_SIZE_MB, "Tapered": True, "Quiesce": True}
+        # Created by the warm-up, under ready_lock
+        self.table = None
+        # (fen, moves) of the next search
+        self.position = (START_FEN, [])
+        self.worker = None
+        self.go_params = {}
+        # Compile in the background, a pending isready is answered once done
+        self.ready = threading.Event()
+        self.ready_lock = threading.Lock()
+        self.pending_ready = False
+        self.warm = threading.Thread(target=self.warm_up, daemon=True)
+        self.warm.start()
+
+    def warm_up(self):
+        """Compile the position and search code, create the table, then answer
+        a pending isready"""
+        state = self.setup(START_FEN, ["e2e4"])
+        alpha_beta(state.copy(), 2, **self.search_options())
+        create_table(1).clear()
+        with self.ready_lock:
+            self.table = create_table(self.options["Hash"])
+            self.ready.set()
+            if self.pending_ready:
+                self.pending_ready = False
+                self.send("readyok")
+
+    def setup(self, fen, moves):
+        """State of the position, with room for the game so far and a search"""
+        state = create_state(self.backend, len(moves) + STACK_SIZE)
+        load_fen(state, fen)
+        return play_moves(state, " ".join(moves))
+
+    def is_ready(self):
+        """readyok now, or from the warm-up thread once it is done"""
+        with self.ready_lock:
+            if self.ready.is_set():
+                self.send("readyok")
+            else:
+                self.pending_ready = True
+
+    def search_options(self):
+        return {"tapered": self.options["Tapered"], "quiesce": self.options["Quiesce"]}
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def handle(self, line):
+        """Process a command line, False once the engine should quit"""
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+        if command == "uci":
+            self.send("id name %s" % ENGINE_NAME)
+            self.send("id author %s authors" % ENGINE_NAME)
+            self.send("option name Hash type spin default %d min 1 max 1024" % TT_SIZE_MB)
+            self.send("option name Tapered type check default true")
+            self.send("option name Quiesce type check default true")
+            self.send("uciok")
+        elif command == "isready":
+            self.is_ready()
+        elif command == "setoption":
+            self.set_option(args)
+        elif command == "ucinewgame":
+            self.stop()
+            # Before the warm-up is done, the table to come is empty
+            with self.ready_lock:
+                if self.table is not None:
+                    self.table.clear()
+        elif command == "position":
+            self.stop()
+            self.set_position(args)
+        elif command == "go":
+            self.go(parse_go(args))
+        elif command == "stop":
+            self.stop()
+        elif command == "ponderhit":
+            if self.worker is not None:
+                params = dict(self.go_params)
+                params.pop("ponder", None)
+                self.worker.ponderhit(time_budget(params, player_color(*self.position)))
+        elif command == "quit":
+            self.stop()
+            return False
+        else:
+            self.send("info string unknown command %s" % command)
+        return True
+
+    def set_option(self, args):
+        if "name" not in args or "value" not in args:
+            return
+        name = " ".join(args[args.index("name") + 1 : args.index("value")])
+        value = " ".join(args[args.index("value") + 1 :])
+        if name == "Hash":
+            self.stop()
+            with self.ready_lock:
+                self.options["Hash"] = max(1, int(value))
+                if self.table is not None:
+                    self.table = create_table(self.options["Hash"])
+        elif name in ("Tapered", "Quiesce"):
+            self.options[name] = value.lower() == "true"
+
+    def set_position(self, args):
+        """position [startpos | fen <fen>] [moves <move> ...], checked when
+        the search sets it up"""
+        moves = args.index("moves") if "moves" in args else len(args)
+        fen = START_FEN
+        if args and args[0] == "fen":
+            fen = " ".join(args[1:moves])
+        self.position = (fen, args[moves + 1 :])
+
+    def go(self, params):
+        self.stop()
+        self.go_params = params
+        infinite = "infinite" in params or "ponder" in params
+        max_time = None if infinite else time_budget(params, player_color(*self.position))
+        depth = params.get("depth", MAX_SEARCH_DEPTH)
+        self.worker = SearchWorker(self, max_time, depth, params.get("nodes"), infinite)
+        self.worker.start()
+
+    def stop(self):
+        """Stop the running search, which then prints its bestmove"""
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker.join()
+            self.worker = None
+
+
+async def read_commands(engine, stream):
+    """Feed the lines of stream to the engine until quit or end of input.
+    Reading happens in a thread, so the loop is free while waiting"""
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, stream.readline)
+        if not line or not engine.handle(line):
+            break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UCI engine")
+    parser.add_argument("--backend", choices=["array", "bitboard"], default="array")
+    args = parser.parse_args()
+    engine = UciEngine(args.backend)
+    asyncio.run(read_commands(engine, sys.stdin))
+    engine.stop()
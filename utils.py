@@ -1,4 +1,5 @@
 import time
+from numba.core.extending import overload_method
 
 
 class Timer:
@@ -6,11 +7,11 @@ class Timer:
         self.tag = tag
 
     def __enter__(self):
-        self.start = time.clock()
+        self.start = time.perf_counter()
         return self
 
     def __exit__(self, *args):
-        self.end = time.clock()
+        self.end = time.perf_counter()
         self.interval = self.end - self.start
         print(self.tag, self.interval)
 
@@ -28,3 +29,19 @@ def timeit(fun, args, repeat=100):
         delta *= 1000
         delta_unit = unit
     print("Elapsed time {:.3f}{}".format(delta, delta_unit))
+
+
+def method_template(kernel):
+    def template(obj, *args):
+        return lambda obj, *args: kernel(obj, *args)
+
+    return template
+
+
+def bind_methods(struct_type, proxy, kernels):
+    """Make the njit kernels, taking the struct first, methods of its Python
+    proxy and of struct_type in njit code. The kernels stay free functions, so
+    they and their callers can be cached on disk, unlike jitclass methods"""
+    for name, kernel in kernels.items():
+        setattr(proxy, name, kernel)
+        overload_method(struct_type, name)(method_template(kernel))